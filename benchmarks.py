@@ -0,0 +1,812 @@
+"""
+Micro benchmarks for the DSLParser pipeline
+
+Usage:
+  python benchmarks.py tokenize stream depth width in_list memory cache ast_cache macros incremental store construct operators shapes multi evaluate
+  python benchmarks.py stages [--workloads depth in_list ...] [--save baseline.json]
+  python benchmarks.py stages --compare baseline.json [--threshold 1.25]
+  python benchmarks.py --compare baseline.json --against run.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+from dsl_parser import DEFAULT_FIELDS as FIELDS, DSLParser, Node, OperatorSpec, ParseContext
+from macros import MacroLibrary
+from utils import MACRO_CLAUSE_RE
+
+
+def legacy_tokenize(raw):
+  """
+  The original slicing based tokenizer, kept verbatim as the reference point for `bench_tokenize`
+  """
+  tokens = []
+
+  def has_flattenable_field(tokens):
+    return len(tokens) >= 3 and all([
+      tokens[-3][0] == 'DSL_OPEN_BRACKET',
+      tokens[-2][0] == 'DSL_FIELD',
+      tokens[-1][0] == 'DSL_CLOSE_BRACKET'
+    ])
+
+  i = 0
+  while i < len(raw):
+    if raw[i] == "[":
+      tokens.append(('DSL_OPEN_BRACKET', '['))
+      i += 1
+      continue
+    elif raw[i] == "]":
+      tokens.append(('DSL_CLOSE_BRACKET', ']'))
+      if has_flattenable_field(tokens):
+        field_token = tokens[-2]
+        tokens = tokens[:-3] + [field_token]
+      i += 1
+      continue
+    elif raw[i] == ":":
+      idx = raw[i:].find(' ')
+      tmp = raw[i:][:idx]
+      if tmp == ":field":
+        k = idx + 1
+        while k < len(raw) and raw[i:][k].isdigit():
+          k += 1
+        tokens.append(('DSL_FIELD', raw[i:][idx+1:k]))
+        i += k
+        continue
+      else:
+        tokens.append(('DSL_OP', tmp))
+        i += idx + 1
+    elif raw[i] == " ":
+      i += 1
+      continue
+    else:
+      k = i + 1
+      while k < len(raw) and raw[k] not in [x for x in " []{}"]:
+        k += 1
+      tmp = raw[i:k]
+      if tmp == "nil":
+        tokens.append(('DSL_NIL', tmp))
+      else:
+        tokens.append(('DSL_LITERAL', raw[i:k]))
+      i = k
+  return tokens
+
+
+def gen_and_chain(n):
+  """
+  Right nested chain of `n` equality conditions joined with :and
+  """
+  where = '[:= [:field 1] 0]'
+  for i in range(1, n):
+    where = f'[:and [:= [:field {i % 4 + 1}] "value-{i}"] {where}]'
+  return where
+
+
+def gen_in_list(n, literal_len = 8):
+  """
+  A single :in with `n` string literals of `literal_len` characters
+  """
+  values = " ".join(f'"{i:0{literal_len}d}"' for i in range(n))
+  return f'[:= [:field 2] {values}]'
+
+
+def _peak_memory(func):
+  tracemalloc.start()
+  try:
+    func()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def _best_of(func, repeat = 5, number = 1):
+  return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def bench_tokenize(sizes = (10, 100, 1000, 5000)):
+  """
+  Compare throughput of `DSLParser.tokenize` against `legacy_tokenize` on growing where-clauses
+  """
+  p = DSLParser()
+  print(f"{'terms':>8} {'bytes':>10} {'legacy MB/s':>12} {'scanner MB/s':>13} {'speedup':>8}")
+  for n in sizes:
+    raw = gen_and_chain(n)
+    assert p.tokenize(raw) == legacy_tokenize(raw)
+    legacy = _best_of(lambda: legacy_tokenize(raw))
+    scanner = _best_of(lambda: p.tokenize(raw))
+    mb = len(raw) / 1e6
+    print(f'{n:>8} {len(raw):>10} {mb / legacy:>12.2f} {mb / scanner:>13.2f} {legacy / scanner:>7.1f}x')
+
+
+def bench_stream(sizes = (1000, 10000, 100000)):
+  """
+  Peak memory and latency of `generate_sql` on huge IN lists, materialized tokens vs streamed spans
+  """
+  p = DSLParser()
+  print(f"{'values':>8} {'list peak KB':>13} {'stream peak KB':>15} {'list ms':>8} {'stream ms':>10}")
+  for n in sizes:
+    query = '{:where ' + gen_in_list(n, literal_len=32) + '}'
+    run_list = lambda: p.generate_sql('postgres', {2: 'name'}, query)
+    run_stream = lambda: p.generate_sql('postgres', {2: 'name'}, query, stream=True)
+    assert run_list() == run_stream()
+    list_peak = _peak_memory(run_list) / 1024
+    stream_peak = _peak_memory(run_stream) / 1024
+    list_ms = _best_of(run_list, repeat=3) * 1e3
+    stream_ms = _best_of(run_stream, repeat=3) * 1e3
+    print(f'{n:>8} {list_peak:>13.0f} {stream_peak:>15.0f} {list_ms:>8.1f} {stream_ms:>10.1f}')
+
+
+def bench_depth(depths = (10, 100, 1000, 5000, 20000)):
+  """
+  End to end `generate_sql` latency against :and nesting depth
+  """
+  p = DSLParser()
+  print(f"{'depth':>8} {'total ms':>10} {'us/level':>10}")
+  for depth in depths:
+    query = '{:where ' + gen_and_chain(depth) + '}'
+    elapsed = _best_of(lambda: p.generate_sql('postgres', FIELDS, query), repeat=3)
+    print(f'{depth:>8} {elapsed * 1e3:>10.2f} {elapsed * 1e6 / depth:>10.2f}')
+
+
+def gen_wide_and(n, op = ':and'):
+  """
+  A single n-ary :and (or `op`) over `n` comparisons
+  """
+  return f'[{op} ' + ' '.join(f'[:> [:field {i % 4 + 1}] {i}]' for i in range(n)) + ']'
+
+
+def bench_width(widths = (10, 100, 1000, 10000)):
+  """
+  End to end `generate_sql` latency against the number of operands of a single :and
+  """
+  p = DSLParser()
+  print(f"{'operands':>8} {'total ms':>10} {'us/operand':>11}")
+  for width in widths:
+    query = '{:where ' + gen_wide_and(width) + '}'
+    elapsed = _best_of(lambda: p.generate_sql('postgres', FIELDS, query), repeat=3)
+    print(f'{width:>8} {elapsed * 1e3:>10.2f} {elapsed * 1e6 / width:>11.2f}')
+
+
+def bench_in_list(n = 50000):
+  """
+  Serializing one :in of `n` values through each IN list strategy, inline and parameterized
+  """
+  p = DSLParser()
+  for strategy in ('list', 'chunk', 'any', 'values'):
+    p.add_dialect(f'in_{strategy}', {'in_strategy': strategy, 'in_threshold': 1})
+  ast, _ = p.parse_query('{:where ' + gen_in_list(n) + '}')
+  print(f'{n} values')
+  print(f"  {'strategy':<8} {'inline ms':>10} {'KB':>8} {'bound ms':>10} {'KB':>8} {'params':>7}")
+  for strategy in ('list', 'chunk', 'any', 'values'):
+    s = p.serializer.bind(f'in_{strategy}', FIELDS)
+    inline = _best_of(lambda: s.serialize_ast(ast), repeat=3)
+    bound = _best_of(lambda: s.serialize_ast(ast, parameterize=True), repeat=3)
+    sql, params = s.serialize_ast(ast, parameterize=True)
+    print(f'  {strategy:<8} {inline * 1e3:>10.2f} {len(s.serialize_ast(ast)) / 1024:>8.0f} '
+          f'{bound * 1e3:>10.2f} {len(sql) / 1024:>8.0f} {len(params):>7}')
+
+
+class DictNode:
+  """
+  Same shape as `Node` but with a per instance `__dict__`, i.e. what nodes looked like before `__slots__`
+  """
+
+  def __init__(self, type, value, children):
+    self.type = type
+    self.value = value
+    self.children = children
+
+
+def _copy_ast(root, make):
+  done = {}
+  stack = [root]
+  while stack:
+    n = stack[-1]
+    pending = [c for c in n.children if id(c) not in done]
+    if pending:
+      stack.extend(pending)
+      continue
+    stack.pop()
+    done[id(n)] = make(n.type, n.value, [done[id(c)] for c in n.children])
+  return done[id(root)]
+
+
+def _as_dict_nodes(root):
+  return _copy_ast(root, lambda type, value, children: DictNode(type, value, tuple(children)))
+
+
+def _as_slots_nodes(root):
+  return _copy_ast(root, lambda type, value, children: Node(type, value, *children))
+
+
+def _gc_ms(keep):
+  start = time.perf_counter()
+  gc.collect()
+  elapsed = time.perf_counter() - start
+  del keep
+  return elapsed * 1e3
+
+
+def bench_memory(sizes = (1000, 10000, 100000)):
+  """
+  Retained memory and full GC pass time of ASTs for large IN lists, `__slots__` nodes vs `__dict__` nodes
+  """
+  p = DSLParser()
+  print(f"{'terms':>8} {'slots KB':>9} {'dict KB':>9} {'saved':>6} {'slots gc ms':>12} {'dict gc ms':>11}")
+  for n in sizes:
+    query = '{:where ' + gen_in_list(n) + '}'
+    ast, _ = p.parse_query(query)
+    # Both copies share the literal strings of `ast`, so only the nodes themselves are counted
+    slots_kb = _retained_memory(lambda: _as_slots_nodes(ast)) / 1024
+    dict_kb = _retained_memory(lambda: _as_dict_nodes(ast)) / 1024
+    slots_gc = _gc_ms(_as_slots_nodes(ast))
+    dict_gc = _gc_ms(_as_dict_nodes(ast))
+    print(f'{n:>8} {slots_kb:>9.0f} {dict_kb:>9.0f} {1 - slots_kb / dict_kb:>6.0%} {slots_gc:>12.2f} {dict_gc:>11.2f}')
+
+
+def bench_cache(sizes = (1, 10, 100)):
+  """
+  `generate_sql` latency uncached vs on a warm compiled-query cache
+  """
+  plain = DSLParser()
+  cached = DSLParser(cache_size=1024)
+  print(f"{'terms':>8} {'uncached us':>12} {'cache hit us':>13} {'speedup':>8}")
+  for n in sizes:
+    query = '{:where ' + gen_and_chain(n) + '}'
+    cached.generate_sql('postgres', FIELDS, query)
+    uncached = _best_of(lambda: plain.generate_sql('postgres', FIELDS, query), number=100)
+    hit = _best_of(lambda: cached.generate_sql('postgres', FIELDS, query), number=100)
+    print(f'{n:>8} {uncached * 1e6:>12.1f} {hit * 1e6:>13.1f} {uncached / hit:>7.1f}x')
+
+
+def gen_saved_filters(n, shared = 20):
+  """
+  `n` distinct filters built from a small pool of `shared` predicates, like saved questions tend to be
+  """
+  preds = [f'[:= [:field {i % 4 + 1}] "value-{i}"]' for i in range(shared)]
+  return [
+    '{:where [:and ' + preds[i % shared] + f' [:or {preds[(i * 7) % shared]} [:> [:field 4] {i}]]]}}'
+    for i in range(n)
+  ]
+
+
+def _retained_memory(build):
+  tracemalloc.start()
+  try:
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    del kept
+    return size
+  finally:
+    tracemalloc.stop()
+
+
+def bench_ast_cache(n = 2000, dialects = ('postgres', 'mysql', 'sqlserver')):
+  """
+  Serving the same saved filters to several dialects, with and without the hash-consed AST cache
+  """
+  queries = gen_saved_filters(n)
+
+  def serve(p):
+    for dialect in dialects:
+      for q in queries:
+        p.generate_sql(dialect, FIELDS, q)
+
+  def parse_all(p):
+    return p, [p.parse_query(q) for q in queries]
+
+  def cache_all(interning):
+    p = DSLParser(ast_cache_size=n)
+    if not interning:
+      p.interner.intern = lambda root: root
+    for q in queries:
+      p.parse_query(q)
+    return p
+
+  plain_s = _best_of(lambda: serve(DSLParser()), repeat=3)
+  cached_s = _best_of(lambda: serve(DSLParser(ast_cache_size=n)), repeat=3)
+  plain_kb = _retained_memory(lambda: parse_all(DSLParser())) / 1024
+  unshared_kb = _retained_memory(lambda: cache_all(False)) / 1024
+  cached_kb = _retained_memory(lambda: cache_all(True)) / 1024
+  print(f'{n} filters x {len(dialects)} dialects')
+  print(f'  no AST cache      {plain_s * 1e3:>8.1f} ms')
+  print(f'  AST cache         {cached_s * 1e3:>8.1f} ms  ({plain_s / cached_s:.1f}x)')
+  print(f'  retained ASTs     {plain_kb:>8.0f} KB in a list')
+  print(f'  AST cache         {unshared_kb:>8.0f} KB without hash-consing, {cached_kb:.0f} KB with '
+        f'({1 - cached_kb / unshared_kb:.0%} less)')
+
+
+def bench_construct(repeat = 5):
+  """
+  Import time of dsl_parser in a fresh interpreter, cost of constructing a DSLParser, and compiling a small
+  filter with a new parser per request vs one shared parser
+  """
+  import subprocess
+
+  # Time imports from cached bytecode, the first run writes it
+  env = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+
+  def run(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True, env=env)
+    return time.perf_counter() - start
+
+  run('import dsl_parser')
+  startup = min(run('pass') for _ in range(repeat))
+  imported = min(run('import dsl_parser') for _ in range(repeat))
+  print(f'  import dsl_parser      {(imported - startup) * 1e3:>8.1f} ms (interpreter start excluded)')
+
+  query = '{:where [:and [:= [:field 4] 25] [:!= [:field 2] "x"]], :limit 10}'
+  shared = DSLParser()
+  custom = DSLParser()
+  custom.add_operator(':eq', ParseContext.parse_op_equals, lambda s, node, l, r: f'{l} = {r}')
+  timings = [
+    ('DSLParser()', lambda: DSLParser()),
+    ('DSLParser(caches)', lambda: DSLParser(cache_size=64, ast_cache_size=64)),
+    ('compile, new parser', lambda: DSLParser().generate_sql('postgres', FIELDS, query)),
+    ('compile, shared parser', lambda: shared.generate_sql('postgres', FIELDS, query)),
+    ('compile, custom op', lambda: custom.generate_sql('postgres', FIELDS, query.replace(':=', ':eq'))),
+  ]
+  for name, func in timings:
+    print(f'  {name:<22} {_best_of(func, number=2000) * 1e6:>8.1f} us')
+
+
+def _parse_lt_legacy(ctx):
+  l = ctx.parse_literal()
+  r = ctx.parse_literal()
+  return Node('DSL_OP', ':lt-legacy', l, r)
+
+
+def bench_operators(n = 2000):
+  """
+  Parsing and serializing a wide :and of `n` comparisons through the built-in `:<`, an `OperatorSpec` and a
+  hand written `add_operator` parse / serialize pair
+  """
+  p = DSLParser()
+  p.add_operators(OperatorSpec(':lt-spec', ('value', 'value'), '{0} < {1}'))
+  p.add_operator(':lt-legacy', _parse_lt_legacy, lambda s, node, l, r: f'{l} < {r}')
+  serializer = p.serializer.bind('postgres', FIELDS)
+  print(f"{'operator':>10} {'parse ms':>9} {'serialize ms':>13}")
+  for op in (':<', ':lt-spec', ':lt-legacy'):
+    q = '{:where [:and ' + ' '.join(f'[{op} [:field 4] {i}]' for i in range(n)) + ']}'
+    parsed = p.parse(q)
+    parse_s = _best_of(lambda: p.parse(q), number=5)
+    serialize_s = _best_of(lambda: serializer.serialize_query(parsed), number=5)
+    print(f'{op:>10} {parse_s * 1e3:>9.2f} {serialize_s * 1e3:>13.2f}')
+
+
+def bench_store(n = 5000, terms = (1, 50, 500)):
+  """
+  Loading precompiled ASTs from a `store.Store` vs parsing the raw queries again, for queries of growing size
+  """
+  import tempfile
+  from store import Store, StoreWriter
+
+  print(f"{'terms':>6} {'text KB':>8} {'store KB':>9} {'parse ms':>9} {'load ms':>8} {'speedup':>8} {'cold 1 us':>10}")
+  for t in terms:
+    queries = {f'q{i}': '{:where ' + gen_and_chain(t).replace('0]', f'{i}]', 1) + ', :limit 10}' for i in range(n // t or 1)}
+    p = DSLParser()
+    w = StoreWriter()
+    for key, q in queries.items():
+      w.add(key, p.parse(q))
+    with tempfile.TemporaryDirectory() as d:
+      path = f'{d}/queries.dslq'
+      w.write(path)
+      size = os.path.getsize(path)
+
+      def load():
+        with Store(path) as store:
+          for key in queries:
+            store[key]
+
+      def cold():
+        with Store(path) as store:
+          store.generate_sql('postgres', FIELDS, 'q0', parser=p)
+
+      parse_s = _best_of(lambda: [p.parse(q) for q in queries.values()], repeat=3)
+      load_s = _best_of(load, repeat=3)
+      cold_s = _best_of(cold, repeat=5, number=20)
+    text = sum(len(q) for q in queries.values())
+    print(f'{t:>6} {text / 1024:>8.0f} {size / 1024:>9.0f} {parse_s * 1e3:>9.1f} {load_s * 1e3:>8.1f} '
+          f'{parse_s / load_s:>7.1f}x {cold_s * 1e6:>10.0f}')
+
+
+def bench_incremental(sizes = (100, 1000, 5000), edits = 20):
+  """
+  Recompiling a query after editing one leaf: `generate_sql` vs `compile(..., previous=...)`, and the
+  serialize stage on its own, with and without the AST cache
+  """
+  def query(n, edited):
+    return '{:where [:and ' + ' '.join(
+      f'[:or [:= [:field 1] {i}] [:< [:field 4] {i + 1 if i == edited else i}]]' for i in range(n)) + ']}'
+
+  print(f"{'terms':>6} {'ast_cache':>9} {'generate ms':>12} {'compile ms':>11} {'serialize ms':>13} {'memo ms':>8}")
+  for n in sizes:
+    qs = [query(n, i * n // edits) for i in range(edits)]
+    for ast_cache_size in (None, 2 * edits):
+      p = DSLParser(ast_cache_size=ast_cache_size)
+      start = time.perf_counter()
+      for q in qs:
+        p.generate_sql('postgres', FIELDS, q)
+      full = (time.perf_counter() - start) / edits
+
+      p = DSLParser(ast_cache_size=ast_cache_size)
+      res = p.compile('postgres', FIELDS, query(n, -1))
+      start = time.perf_counter()
+      for q in qs:
+        res = p.compile('postgres', FIELDS, q, previous=res)
+      incremental = (time.perf_counter() - start) / edits
+
+      s = p.serializer.bind('postgres', FIELDS)
+      asts = [p.parse_query(q)[0] for q in qs]
+      start = time.perf_counter()
+      for ast in asts:
+        s.postorder_ast(ast)
+      serialize = (time.perf_counter() - start) / edits
+      start = time.perf_counter()
+      for ast in asts:
+        s.postorder_memo(ast, res.memo)
+      memo = (time.perf_counter() - start) / edits
+      print(f'{n:>6} {str(ast_cache_size is not None):>9} {full * 1e3:>12.2f} {incremental * 1e3:>11.2f} '
+            f'{serialize * 1e3:>13.2f} {memo * 1e3:>8.2f}')
+
+
+def bench_shapes(n = 2000, terms = (2, 10, 100)):
+  """
+  `generate_sql` over queries of one shape with distinct literals: uncached vs through the shape cache,
+  inlined and parameterized
+  """
+  def query(n, i):
+    return '{:where [:and ' + ' '.join(
+      f'[:= [:field 1] "v{i}-{j}"] [:> [:field 4] {i + j}]' for j in range(n)) + '] :limit ' + str(i % 50) + '}'
+
+  print(f"{'terms':>6} {'parameterize':>12} {'uncached us':>12} {'shaped us':>10} {'speedup':>8}")
+  for t in terms:
+    qs = [query(t, i) for i in range(n)]
+    for parameterize in (False, True):
+      plain = DSLParser()
+      start = time.perf_counter()
+      for q in qs:
+        plain.generate_sql('postgres', FIELDS, q, parameterize=parameterize)
+      uncached = (time.perf_counter() - start) / n
+
+      shaped = DSLParser(shape_cache_size=64)
+      start = time.perf_counter()
+      for q in qs:
+        shaped.generate_sql('postgres', FIELDS, q, parameterize=parameterize)
+      hit = (time.perf_counter() - start) / n
+      print(f'{t:>6} {str(parameterize):>12} {uncached * 1e6:>12.1f} {hit * 1e6:>10.1f} {uncached / hit:>7.1f}x')
+
+
+def bench_multi(sizes = (10, 100, 1000), dialects = ('postgres', 'mysql', 'sqlserver')):
+  """
+  Rendering a query for every dialect: `generate_sql` once per dialect vs one `generate_sql_multi`, and the
+  where-clause traversals on their own
+  """
+  p = DSLParser()
+  print(f"{'terms':>6} {'per dialect ms':>15} {'multi ms':>9} {'speedup':>8} {'traversals ms':>14} {'lanes ms':>9}")
+  for n in sizes:
+    query = '{:where ' + gen_and_chain(n) + ', :limit 10}'
+    per_dialect = _best_of(lambda: [p.generate_sql(d, FIELDS, query) for d in dialects], number=5) / 5
+    multi = _best_of(lambda: p.generate_sql_multi(dialects, FIELDS, query), number=5) / 5
+    ast = p.parse(query).where
+    lanes = [p.serializer.bind(d, FIELDS) for d in dialects]
+    traversals = _best_of(lambda: [s.postorder_ast(ast) for s in lanes], number=5) / 5
+    shared = _best_of(lambda: p.serializer.postorder_lanes(ast, lanes), number=5) / 5
+    print(f'{n:>6} {per_dialect * 1e3:>15.2f} {multi * 1e3:>9.2f} {per_dialect / multi:>7.1f}x '
+          f'{traversals * 1e3:>14.2f} {shared * 1e3:>9.2f}')
+
+
+def bench_evaluate(rows = 1000000):
+  """
+  Filtering `rows` rows in process: row at a time `Evaluator.evaluate_rows` vs a compiled `Predicate` over
+  dict-of-lists and (when installed) NumPy columns, with ~10% NULLs
+  """
+  from evaluator import Evaluator, np
+  rnd = random.Random(0)
+  ages = [None if rnd.random() < 0.1 else rnd.randrange(100) for _ in range(rows)]
+  names = [None if rnd.random() < 0.1 else f'name-{rnd.randrange(50)}' for _ in range(rows)]
+  ids = list(range(rows))
+  columns = {'id': ids, 'name': names, 'age': ages}
+  p = DSLParser()
+  ast = p.parse('{:where [:and [:> [:field 4] 30] [:or [:= [:field 2] "name-1" "name-2" "name-3"] '
+                '[:not [:< [:field 1] 1000]]] [:not-empty [:field 2]]]}').where
+  ev = Evaluator(FIELDS)
+  pred = ev.compile(ast)
+
+  start = time.perf_counter()
+  rows_iter = ({'id': i, 'name': n, 'age': a} for i, n, a in zip(ids, names, ages))
+  expected = sum(v is True for v in ev.evaluate_rows(ast, rows_iter))
+  row_at_a_time = time.perf_counter() - start
+  start = time.perf_counter()
+  matched = sum(pred(columns))
+  lists = time.perf_counter() - start
+  assert matched == expected
+  print(f"{'rows':>8} {'backend':>12} {'ms':>9} {'speedup':>8}")
+  print(f'{rows:>8} {"row":>12} {row_at_a_time * 1e3:>9.1f} {1:>7.1f}x')
+  print(f'{rows:>8} {"lists":>12} {lists * 1e3:>9.1f} {row_at_a_time / lists:>7.1f}x')
+  if np is None:
+    print('NumPy not installed, skipping the array backend')
+    return
+  arrays = {
+    'id': np.array(ids),
+    'name': np.array(names, dtype=object),
+    'age': np.array([np.nan if a is None else a for a in ages]),
+  }
+  start = time.perf_counter()
+  matched = int(pred(arrays).sum())
+  numpy = time.perf_counter() - start
+  assert matched == expected
+  print(f'{rows:>8} {"numpy":>12} {numpy * 1e3:>9.1f} {row_at_a_time / numpy:>7.1f}x')
+
+
+def gen_macros(n, depth = 8, fan_out = 2):
+  """
+  `n` macros in blocks of `depth`, each one combining a predicate with up to `fan_out` lower numbered
+  macros of its block. Bodies share references, so textual expansion grows much faster than the DAG
+  """
+  macros = {}
+  for i in range(n):
+    refs = ' '.join(f'[:macro "m{j}"]' for j in range(max(i - i % depth, i - fan_out), i))
+    macros[f'm{i}'] = f'[:or [:= [:field {i % 4 + 1}] {i}] {refs}]' if refs else f'[:= [:field 1] {i}]'
+  return macros
+
+
+def bench_macros(n = 2000, queries = 200):
+  """
+  Queries referencing a shared macro set: textual substitution vs a dict compiled per call vs a MacroLibrary
+  """
+  macros = gen_macros(n)
+  qs = [f'{{:where [:and [:macro "m{(i * 37) % n}"] [:macro "m{(i * 91) % n}"]]}}' for i in range(queries)]
+  p = DSLParser()
+
+  def text():
+    for q in qs:
+      p.parse_query(p.resolve_macros(q, macros))
+
+  def per_call():
+    for q in qs:
+      p.parse_query(q, macros)
+
+  lib = MacroLibrary(macros)
+  def library():
+    for q in qs:
+      p.parse_query(q, lib)
+
+  library()
+  print(f'{n} macros, {queries} queries')
+  for name, func in (('text substitution', text), ('dict per call', per_call), ('MacroLibrary', library)):
+    print(f'  {name:<18} {_best_of(func, repeat=3) * 1e3:>8.1f} ms')
+
+
+def gen_macro_query(n, depth = 8, refs = 4):
+  """
+  A where-clause referencing the top macro of the first `refs` blocks of `gen_macros(n, depth)`
+  """
+  tops = [f'm{i}' for i in range(depth - 1, n, depth)][:refs] or ['m0']
+  return '[:and ' + ' '.join(f'[:macro "{m}"]' for m in tops) + ']'
+
+
+def stage_workloads():
+  """
+  {name: (where-clause, macros)} of the `stages` suite, one synthetic generator parameter varied at a time
+  """
+  w = {}
+  for n in (10, 100, 1000):
+    w[f'depth={n}'] = (gen_and_chain(n), None)
+  for n in (10, 100, 1000):
+    w[f'and_width={n}'] = (gen_wide_and(n), None)
+    w[f'or_width={n}'] = (gen_wide_and(n, op=':or'), None)
+  for n in (10, 1000, 10000):
+    w[f'in_list={n}'] = (gen_in_list(n), None)
+  for n in (8, 512, 8192):
+    w[f'literal_len={n}'] = (gen_in_list(10, literal_len=n), None)
+  for n in (10, 100, 1000):
+    w[f'macro_count={n}'] = (gen_macro_query(n), gen_macros(n))
+  # DAG shape: blocks of `depth` macros each referencing the `fan_out` below it, 1 is a chain
+  for depth, fan_out in ((16, 1), (16, 2), (8, 4)):
+    w[f'macro_dag={depth}x{fan_out}'] = (gen_macro_query(64, depth), gen_macros(64, depth, fan_out))
+  return w
+
+
+def _percentile(sorted_values, q):
+  return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def measure(func, budget = 0.2, min_runs = 5, max_runs = 2000):
+  """
+  Time `func` on its own `min_runs`..`max_runs` times, within roughly `budget` seconds
+
+  :returns: A dict of throughput (ops_per_s), latency percentiles in microseconds and the peak memory
+    in KB traced over one more run
+  """
+  func()
+  times = []
+  start = time.perf_counter()
+  while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() - start < budget):
+    t = time.perf_counter_ns()
+    func()
+    times.append(time.perf_counter_ns() - t)
+  times.sort()
+  return {
+    'runs': len(times),
+    'ops_per_s': round(1e9 * len(times) / sum(times), 2),
+    'p50_us': round(_percentile(times, 0.5) / 1e3, 2),
+    'p90_us': round(_percentile(times, 0.9) / 1e3, 2),
+    'p99_us': round(_percentile(times, 0.99) / 1e3, 2),
+    'peak_kb': round(_peak_memory(func) / 1024, 1),
+  }
+
+
+def stage_funcs(p, where, macros, dialect = 'postgres'):
+  """
+  {stage: zero argument callable} running one stage of `generate_sql` on inputs prepared by the previous ones
+  """
+  query = '{:where ' + where + '}'
+  lib = None
+  if macros:
+    # Warm library, so that parsing below doesn't include parsing macro bodies
+    lib = MacroLibrary(macros)
+    for m in MACRO_CLAUSE_RE.findall(where):
+      lib.resolve(m, p)
+    # The figures of the where-clause itself, collected while parsing it
+    ctx = ParseContext(p, p.scan(where), macros=lib)
+    ctx.parse_where()
+    own = (len(where) - ctx.macro_chars, ctx.nodes, ctx.macro_refs)
+  tokens = list(p.scan(query))
+  parsed = ParseContext(p, tokens, macros=lib).parse_clauses()
+  serializer = p.serializer.bind(dialect, FIELDS)
+
+  def resolve_macros():
+    fresh = MacroLibrary(macros, validate=False)
+    for m in MACRO_CLAUSE_RE.findall(where):
+      fresh.resolve(m, p)
+    fresh.check_expansion(*own)
+
+  stages = {
+    'tokenize': lambda: list(p.scan(query)),
+    'parse': lambda: ParseContext(p, tokens, macros=lib).parse_clauses(),
+  }
+  if macros:
+    stages['macros'] = resolve_macros
+  stages['serialize'] = lambda: serializer.serialize_query(parsed)
+  return stages
+
+
+def run_stages(workloads = None, budget = 0.2):
+  """
+  Measure every stage of every workload (or of those whose name starts with one of `workloads`)
+
+  :returns: The machine readable run, {"meta": {...}, "results": {workload: {stage: measure(...)}}}
+  """
+  p = DSLParser()
+  results = {}
+  for name, (where, macros) in stage_workloads().items():
+    if workloads and not any(name.startswith(w) for w in workloads):
+      continue
+    results[name] = {stage: measure(func, budget=budget) for stage, func in stage_funcs(p, where, macros).items()}
+  return {
+    'meta': {
+      'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'machine': platform.machine(),
+    },
+    'results': results,
+  }
+
+
+def print_stages(run):
+  print(f"{'workload':<22} {'stage':<10} {'ops/s':>12} {'p50 us':>10} {'p90 us':>10} {'p99 us':>10} {'peak KB':>9}")
+  for name, stages in run['results'].items():
+    for stage, m in stages.items():
+      print(f"{name:<22} {stage:<10} {m['ops_per_s']:>12.1f} {m['p50_us']:>10.1f} {m['p90_us']:>10.1f} "
+            f"{m['p99_us']:>10.1f} {m['peak_kb']:>9.1f}")
+
+
+def compare_runs(baseline, run, threshold = 1.25, min_delta_us = 1.0):
+  """
+  Print the p50 latency and peak memory of `run` relative to `baseline`
+
+  Latencies that moved by less than `min_delta_us` are timer noise and never count as a regression
+
+  :returns: The list of (workload, stage, metric, ratio) that got worse by more than `threshold` times
+  """
+  regressions = []
+  print(f"{'workload':<22} {'stage':<10} {'base p50':>10} {'p50':>10} {'ratio':>6} {'base KB':>9} {'KB':>9} {'ratio':>6}")
+  for name, stages in run['results'].items():
+    for stage, m in stages.items():
+      base = baseline['results'].get(name, {}).get(stage)
+      if base is None:
+        print(f'{name:<22} {stage:<10} (not in baseline)')
+        continue
+      time_ratio = m['p50_us'] / base['p50_us'] if base['p50_us'] else 1.0
+      mem_ratio = m['peak_kb'] / base['peak_kb'] if base['peak_kb'] else 1.0
+      flags = []
+      if time_ratio > threshold and m['p50_us'] - base['p50_us'] > min_delta_us:
+        regressions.append((name, stage, 'p50_us', time_ratio))
+        flags.append('SLOWER')
+      if mem_ratio > threshold:
+        regressions.append((name, stage, 'peak_kb', mem_ratio))
+        flags.append('MORE MEMORY')
+      print(f"{name:<22} {stage:<10} {base['p50_us']:>10.1f} {m['p50_us']:>10.1f} {time_ratio:>6.2f} "
+            f"{base['peak_kb']:>9.1f} {m['peak_kb']:>9.1f} {mem_ratio:>6.2f} {' '.join(flags)}")
+  return regressions
+
+
+def bench_stages(workloads = None, save = None, compare = None, threshold = 1.25, budget = 0.2):
+  """
+  Throughput, latency percentiles and peak memory of each pipeline stage over the synthetic workloads
+
+  :param save: Path to write the run to as a JSON baseline
+  :param compare: Path of a JSON baseline to compare the run against, exits with 1 on regressions
+  """
+  run = run_stages(workloads, budget=budget)
+  if save:
+    with open(save, 'w') as f:
+      json.dump(run, f, indent=2)
+  if compare:
+    with open(compare) as f:
+      baseline = json.load(f)
+    if compare_runs(baseline, run, threshold):
+      sys.exit(1)
+  else:
+    print_stages(run)
+
+
+BENCHMARKS = {
+  'tokenize': bench_tokenize,
+  'stream': bench_stream,
+  'depth': bench_depth,
+  'width': bench_width,
+  'in_list': bench_in_list,
+  'memory': bench_memory,
+  'cache': bench_cache,
+  'ast_cache': bench_ast_cache,
+  'macros': bench_macros,
+  'incremental': bench_incremental,
+  'store': bench_store,
+  'construct': bench_construct,
+  'operators': bench_operators,
+  'shapes': bench_shapes,
+  'multi': bench_multi,
+  'evaluate': bench_evaluate,
+  'stages': bench_stages,
+}
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('benchmarks', nargs='*', help=f'Any of: {", ".join(BENCHMARKS)} (default: all)')
+  parser.add_argument('--workloads', nargs='+', help='stages: only run workloads starting with these, e.g. depth in_list')
+  parser.add_argument('--budget', type=float, default=0.2, help='stages: seconds spent timing each stage (default: 0.2)')
+  parser.add_argument('--save', help='stages: write the run to this JSON baseline')
+  parser.add_argument('--compare', help='stages: compare the run against this JSON baseline, exit 1 on regressions')
+  parser.add_argument('--against', help='compare the saved run in this JSON file instead of running the suite')
+  parser.add_argument('--threshold', type=float, default=1.25, help='slowdown / memory growth ratio counted as a regression (default: 1.25)')
+  args = parser.parse_args()
+  unknown = [x for x in args.benchmarks if x not in BENCHMARKS]
+  if unknown:
+    parser.error(f'Unknown benchmark(s): {", ".join(unknown)}')
+
+  if args.against:
+    if not args.compare:
+      parser.error('--against needs a --compare baseline')
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    with open(args.against) as f:
+      run = json.load(f)
+    sys.exit(1 if compare_runs(baseline, run, args.threshold) else 0)
+
+  for name in args.benchmarks or BENCHMARKS:
+    print(f'== {name}')
+    if name == 'stages':
+      bench_stages(args.workloads, save=args.save, compare=args.compare, threshold=args.threshold, budget=args.budget)
+    else:
+      BENCHMARKS[name]()
@@ -0,0 +1,345 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+
+def _canonical(obj):
+  """
+  Deterministic repr of nested dicts / lists / scalars, dict items are ordered by the repr of their key
+  """
+  if isinstance(obj, dict):
+    items = sorted((repr(k), _canonical(v)) for k, v in obj.items())
+    return '{' + ','.join(f'{k}:{v}' for k, v in items) + '}'
+  if isinstance(obj, (list, tuple)):
+    return '[' + ','.join(_canonical(x) for x in obj) + ']'
+  return repr(obj)
+
+
+def fingerprint(*parts):
+  """
+  Stable (across processes and runs) 128 bit hex digest of the given parts
+  """
+  h = hashlib.blake2b(digest_size=16)
+  for part in parts:
+    h.update(_canonical(part).encode('utf-8'))
+    h.update(b'\x00')
+  return h.hexdigest()
+
+
+class LRUCache:
+  """
+  Thread safe, bounded, least recently used cache
+
+  Bounded by number of entries and / or by the sum of the `size` given for each entry on `put`.
+  Keeps hit / miss / eviction counters that can be scraped through `stats()`
+  """
+
+  def __init__(self, max_entries = 1024, max_bytes = None):
+    if max_entries is None and max_bytes is None:
+      raise ValueError('LRUCache needs at least one of max_entries / max_bytes')
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+    self._bytes = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._data)
+
+  def __contains__(self, key):
+    return key in self._data
+
+  def get(self, key, default = None):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, size = 0):
+    with self._lock:
+      old = self._data.pop(key, None)
+      if old is not None:
+        self._bytes -= old[1]
+      if self.max_bytes is not None and size > self.max_bytes:
+        # Would evict everything else and still not fit
+        return
+      self._data[key] = (value, size)
+      self._bytes += size
+      while ((self.max_entries is not None and len(self._data) > self.max_entries)
+          or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+        _, (_, evicted_size) = self._data.popitem(last=False)
+        self._bytes -= evicted_size
+        self.evictions += 1
+
+  def values(self):
+    """
+    Snapshot of the cached values, least recently used first
+    """
+    with self._lock:
+      return [value for value, _ in self._data.values()]
+
+  def clear(self):
+    """
+    Drop every entry, e.g. when whatever the cached values were derived from has changed
+    """
+    with self._lock:
+      self._data.clear()
+      self._bytes = 0
+      self.invalidations += 1
+
+  def stats(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations,
+        'entries': len(self._data),
+        'bytes': self._bytes,
+      }
+
+
+def value_key(value):
+  # Span values are materialized so canonical nodes don't keep whole query strings alive
+  if value is None or isinstance(value, str):
+    return value
+  return str(value)
+
+
+# Node types whose values come from a small set, e.g. operator names, interned as strings by `NodeInterner`
+_SHARED_VALUE_TYPES = frozenset(('DSL_OP', 'DSL_FIELD'))
+
+
+class NodeInterner:
+  """
+  Hash-conses AST nodes so structurally identical subtrees share one Node instance. Interned ASTs are
+  shared, so they must be treated as immutable from then on
+
+  The table maps a structural hash of each canonical node to the node, checked against the candidate on
+  lookup: a (type, value, child ids) key tuple and a weak reference per canonical node cost about as much
+  memory as the duplicates they save. Instead of weak references, the table is rebuilt from the ASTs still
+  in use (see `live`) whenever it doubled in size, so canonical nodes of evicted ASTs don't pile up.
+  Operator and field id values are interned too, so every `:and` node shares one string
+  """
+
+  def __init__(self, live = None, min_prune = 1024):
+    """
+    :param live: Callable returning the roots of the interned ASTs still in use, e.g. those of a cache
+      ASTs get evicted from. Without one the table only ever grows
+    :param min_prune: Don't rebuild tables smaller than this
+    """
+    self.hits = 0
+    self.misses = 0
+    self.live = live
+    self.min_prune = min_prune
+    self._table = {}
+    self._prune_at = min_prune
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._table)
+
+  @staticmethod
+  def _key(type, value, children):
+    # Canonical children are kept alive by their canonical parents so their ids are stable
+    return hash((type, value, *map(id, children)))
+
+  def prune(self):
+    """
+    Rebuild the table from the `live` ASTs, dropping canonical nodes no live AST references anymore
+    """
+    with self._lock:
+      self._prune()
+
+  def _prune(self):
+    table = {}
+    seen = set()
+    stack = [root for root in self.live() if root is not None]
+    while stack:
+      node = stack.pop()
+      if id(node) in seen:
+        continue
+      seen.add(id(node))
+      table.setdefault(self._key(node.type, node.value, node.children), node)
+      stack.extend(node.children)
+    self._table = table
+    self._prune_at = max(self.min_prune, 2 * len(table))
+
+  def intern(self, root):
+    """
+    Return the canonical version of the AST `root`, nodes of `root` may be reused in the process
+    """
+    if root is None:
+      return None
+
+    with self._lock:
+      if self.live is not None and len(self._table) >= self._prune_at:
+        self._prune()
+      canonical = {}
+      stack = [(root, False)]
+      while stack:
+        node, expanded = stack.pop()
+        if id(node) in canonical:
+          continue
+        if not expanded:
+          # Post order, children get canonicalized before their parent
+          stack.append((node, True))
+          for child in node.children:
+            if id(child) not in canonical:
+              stack.append((child, False))
+          continue
+
+        children = tuple(canonical[id(c)] for c in node.children)
+        value = value_key(node.value)
+        if value is not None and node.type in _SHARED_VALUE_TYPES:
+          value = sys.intern(value)
+        key = self._key(node.type, value, children)
+        found = self._table.get(key)
+        if found is None or not (found.type == node.type and found.value == value and
+                                 len(found.children) == len(children) and
+                                 all(a is b for a, b in zip(found.children, children))):
+          # A miss, or a hash collision in which case the node stays as is rather than displacing the
+          # canonical one
+          self.misses += 1
+          node.value, node.children = value, children
+          self._table.setdefault(key, node)
+          found = node
+        else:
+          self.hits += 1
+        canonical[id(node)] = found
+      return canonical[id(root)]
+
+
+class SubtreeMemo:
+  """
+  Serialized SQL of AST subtrees, matched on their structure, for recompiling edited queries
+
+  Every distinct subtree structure (type, value, structural ids of its children) gets a structural id, so
+  equal subtrees of different ASTs get the same id without touching the nodes themselves. The SQL of
+  operator subtrees is kept as (where-clause, start, end) offsets into the where-clause it was emitted in
+  rather than copied out per subtree
+
+  Fragments are only valid for the `context` (dialect, quoted fields) they were serialized in
+  """
+
+  def __init__(self, context, max_unused = 4):
+    """
+    :param context: What the fragments depend on, compared by `matches`
+    :param max_unused: Drop entries of subtrees that are no longer used once the number of entries grew
+      `max_unused` times over since the last time
+    """
+    self.context = context
+    self.max_unused = max_unused
+    # {(type, value, child structural ids): structural id}
+    self.ids = {}
+    # {structural id: (where-clause, start, end)}
+    self.fragments = {}
+    self._next = 0
+    self._root = None
+    self._numbers = {}
+    self._limit = 1024
+    self.lock = threading.Lock()
+
+  def matches(self, context):
+    return all(a is b or a == b for a, b in zip(self.context, context))
+
+  def number(self, root):
+    """
+    {id(node): structural id} for every operator node of the AST `root`, leaves are keyed on their
+    (type, value) directly
+
+    Nodes of the previously numbered AST, e.g. spliced macros or subtrees hash-consed by the AST cache,
+    keep their ids without being walked again
+    """
+    prev = self._numbers
+    numbers = {}
+    if id(root) in prev:
+      numbers[id(root)] = prev[id(root)]
+      order = []
+    else:
+      order = self._order(root, prev, numbers)
+
+    ids = self.ids
+    for node in order:
+      key = (node.type, node.value, tuple([
+        numbers[id(c)] if c.children else (c.type, value_key(c.value)) for c in node.children
+      ]))
+      n = ids.get(key)
+      if n is None:
+        n = ids[key] = self._next
+        self._next += 1
+      numbers[id(node)] = n
+    # The previous root keeps its nodes, and so the ids in `_numbers`, alive
+    self._root = root
+    self._numbers = numbers
+    return numbers
+
+  def _order(self, root, prev, numbers):
+    # The operator nodes of `root` to number, children before parents. Nodes found in `prev` go straight
+    # into `numbers` and aren't descended into. Reversed pre order does for trees, ASTs sharing nodes
+    # (e.g. a macro referenced twice) need a proper post order
+    order = []
+    seen = set()
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      if id(node) in seen:
+        break
+      seen.add(id(node))
+      order.append(node)
+      for c in node.children:
+        if c.children:
+          n = prev.get(id(c))
+          if n is None:
+            stack.append(c)
+          else:
+            numbers[id(c)] = n
+    else:
+      order.reverse()
+      return order
+
+    order = []
+    done = set()
+    stack = [(root, False)]
+    while stack:
+      node, expanded = stack.pop()
+      if expanded:
+        order.append(node)
+        continue
+      if id(node) in done:
+        continue
+      done.add(id(node))
+      n = prev.get(id(node))
+      if n is not None:
+        numbers[id(node)] = n
+        continue
+      stack.append((node, True))
+      stack.extend([(c, False) for c in node.children if c.children])
+    return order
+
+  def record(self, sql, spans, numbers):
+    """
+    Keep the (structural id, start, end) `spans` of the where-clause `sql` just serialized from an AST
+    numbered `numbers`
+    """
+    for n, start, end in spans:
+      self.fragments[n] = (sql, start, end)
+    if len(self.ids) > self._limit:
+      # Forget subtrees that are gone from the query, and fragments pointing into older where-clauses
+      # so that those can be freed
+      live = set(numbers.values())
+      self.ids = {k: n for k, n in self.ids.items() if n in live}
+      self.fragments = {n: f for n, f in self.fragments.items() if n in live and f[0] is sql}
+      # Carried over ids may have lost their fragment, number the next AST from scratch
+      self._root = None
+      self._numbers = {}
+      self._limit = self.max_unused * len(self.ids) + 1024
@@ -0,0 +1,274 @@
+"""
+Translate a stream of JSONL queries to SQL
+
+Every input line is a JSON object of `generate_sql` arguments: `dialect`, `fields`, `query` and optionally
+`macros`, `parameterize`, `optimize`, `shared` and an `id` which is echoed back. Every output line is
+{"line": <input line number>, "id": ..., "sql": ...} (plus "params" when parameterizing), or
+{"line": ..., "id": ..., "error": <message>, "error_type": <exception class>} for a record that failed.
+Output lines come in input order, blank input lines are skipped
+
+Usage:
+  python cli.py queries.jsonl -o out.jsonl --jobs 8
+  cat queries.jsonl | python cli.py --dialect snowflake --dialects dialects.json > out.jsonl
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import LRUCache
+from dsl_parser import DSLParser
+from macros import MacroLibrary
+
+
+# Keys of an input record passed on to `generate_sql`
+REQUIRED_KEYS = ('dialect', 'fields', 'query')
+OPTIONAL_KEYS = ('macros', 'parameterize', 'optimize', 'shared')
+
+
+class Translator:
+  """
+  Compiles JSONL records with a DSLParser, one output line per input line
+
+  Records of a corpus mostly share a handful of fields mappings and macro sets, equal ones are interned
+  into a single dict / `MacroLibrary` so their identifier tables and parsed macro bodies get reused across
+  records rather than rebuilt for every line
+  """
+
+  def __init__(self, parser = None, dialect = None, intern_size = 256):
+    """
+    :param parser: The DSLParser to compile with, a fresh one by default
+    :param dialect: Compile every record to this dialect, ignoring the records' own `dialect`
+    :param intern_size: Max number of distinct fields mappings / macro sets kept around
+    """
+    self.parser = parser or DSLParser()
+    self.dialect = dialect
+    self._fields = LRUCache(max_entries=intern_size)
+    self._macros = LRUCache(max_entries=intern_size)
+
+  def _intern_fields(self, fields):
+    key = tuple(fields.items())
+    res = self._fields.get(key)
+    if res is None:
+      # JSON object keys are always strings, field ids are ints
+      res = {int(k): name for k, name in fields.items()}
+      self._fields.put(key, res)
+    return res
+
+  def _intern_macros(self, macros):
+    if not macros:
+      return {}
+    key = tuple(macros.items())
+    res = self._macros.get(key)
+    if res is None:
+      res = MacroLibrary(macros, validate=False)
+      self._macros.put(key, res)
+    return res
+
+  def _request(self, record):
+    if not isinstance(record, dict):
+      raise RuntimeError('Expected a JSON object')
+    if self.dialect is not None:
+      record['dialect'] = self.dialect
+    missing = [k for k in REQUIRED_KEYS if k not in record]
+    if missing:
+      raise RuntimeError(f'Missing {", ".join(missing)}')
+    req = {k: record[k] for k in REQUIRED_KEYS}
+    req.update((k, record[k]) for k in OPTIONAL_KEYS if k in record)
+    req['fields'] = self._intern_fields(req['fields'])
+    if 'macros' in req:
+      req['macros'] = self._intern_macros(req['macros'])
+    return req
+
+  def translate(self, line, lineno):
+    """
+    :returns: A tuple of (output JSON line, whether the record failed)
+    """
+    out = {'line': lineno}
+    try:
+      record = json.loads(line)
+      if isinstance(record, dict) and 'id' in record:
+        out['id'] = record['id']
+      res = self.parser.generate_sql(**self._request(record))
+      if isinstance(res, tuple):
+        res, params = res
+        out['params'] = list(params)
+      # generate_sql wraps the statement in double quotes
+      out['sql'] = res[1:-1]
+      failed = False
+    except Exception as e:
+      out['error'] = str(e)
+      out['error_type'] = type(e).__name__
+      failed = True
+    return json.dumps(out), failed
+
+  def translate_chunk(self, start, lines):
+    """
+    Translate consecutive input `lines`, the first one being line number `start`
+
+    :returns: A tuple of (output text, number of records, number of failed records)
+    """
+    out = []
+    records = 0
+    errors = 0
+    for lineno, line in enumerate(lines, start):
+      if not line.strip():
+        continue
+      res, failed = self.translate(line, lineno)
+      out.append(res)
+      records += 1
+      errors += failed
+    return ''.join(f'{o}\n' for o in out), records, errors
+
+
+# The Translator of a worker process, see `_init_worker`
+_translator = None
+
+
+def _init_worker(parser, dialect):
+  # Runs once per worker, so the parser (and with it the dialect / operator registry) is pickled once per
+  # process rather than once per chunk
+  global _translator
+  _translator = Translator(parser, dialect)
+
+
+def _translate_chunk(start, lines):
+  # Module level so that process pools can pickle it
+  return _translator.translate_chunk(start, lines)
+
+
+def _chunks(infile, chunksize):
+  lineno = 1
+  it = iter(infile)
+  while True:
+    lines = list(itertools.islice(it, chunksize))
+    if not lines:
+      return
+    yield lineno, lines
+    lineno += len(lines)
+
+
+class Progress:
+  """
+  Running totals of a `run`, reported on `stream` every `interval` seconds and once at the end
+  """
+
+  def __init__(self, stream = None, interval = None):
+    self.stream = stream
+    self.interval = interval
+    self.records = 0
+    self.errors = 0
+    self.start = time.perf_counter()
+    self._last = self.start
+
+  @property
+  def elapsed(self):
+    return time.perf_counter() - self.start
+
+  def update(self, records, errors):
+    self.records += records
+    self.errors += errors
+    if self.interval is not None and self.stream is not None:
+      now = time.perf_counter()
+      if now - self._last >= self.interval:
+        self._last = now
+        self.report()
+
+  def report(self):
+    if self.stream is None:
+      return
+    elapsed = self.elapsed
+    rate = self.records / elapsed if elapsed else 0.0
+    print(f'{self.records} records, {self.errors} errors in {elapsed:.1f} s ({rate:.0f} records/s)',
+          file=self.stream, flush=True)
+
+  def summary(self):
+    return {'records': self.records, 'errors': self.errors, 'elapsed': self.elapsed}
+
+
+def run(infile, outfile, parser = None, dialect = None, jobs = 1, chunksize = 256, progress = None):
+  """
+  Translate every JSONL record of `infile` to `outfile`, see the module docstring for the formats
+
+  Input is read and output written a chunk at a time, with at most a few chunks per worker in flight, so
+  memory stays bounded whatever the size of the input
+
+  :param parser: The DSLParser to compile with (and to ship to the workers), a fresh one by default
+  :param dialect: Compile every record to this dialect, ignoring the records' own `dialect`
+  :param jobs: Number of worker processes, 1 to compile in the calling process
+  :param chunksize: Number of input lines per task
+  :param progress: A `Progress` to report on
+  :returns: A dict of the `records` and `errors` counts and the `elapsed` seconds
+  """
+  parser = parser or DSLParser()
+  progress = progress or Progress()
+
+  def write(res):
+    text, records, errors = res
+    outfile.write(text)
+    progress.update(records, errors)
+
+  if jobs <= 1:
+    translator = Translator(parser, dialect)
+    for start, lines in _chunks(infile, chunksize):
+      write(translator.translate_chunk(start, lines))
+  else:
+    window = jobs * 4
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(parser, dialect)) as ex:
+      pending = deque()
+      for start, lines in _chunks(infile, chunksize):
+        pending.append(ex.submit(_translate_chunk, start, lines))
+        if len(pending) >= window:
+          write(pending.popleft().result())
+      while pending:
+        write(pending.popleft().result())
+  outfile.flush()
+  return progress.summary()
+
+
+def main(argv = None):
+  """
+  :returns: The process exit code, 1 if any record failed
+  """
+  ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  ap.add_argument('input', nargs='?', default='-', help='JSONL file of records (default: stdin)')
+  ap.add_argument('-o', '--output', default='-', help='JSONL file to write results to (default: stdout)')
+  ap.add_argument('-j', '--jobs', type=int, default=1, help='worker processes, 0 for one per CPU (default: 1)')
+  ap.add_argument('--chunksize', type=int, default=256, help='input lines per task (default: 256)')
+  ap.add_argument('--dialect', help='compile every record to this dialect, ignoring their own')
+  ap.add_argument('--dialects', help='JSON file of {name: rules} dialects to add before compiling')
+  ap.add_argument('--progress', type=float, metavar='SECONDS', help='report throughput on stderr every SECONDS')
+  ap.add_argument('-q', '--quiet', action='store_true', help='no summary on stderr')
+  args = ap.parse_args(argv)
+  if args.chunksize < 1:
+    ap.error('--chunksize must be at least 1')
+
+  parser = DSLParser()
+  if args.dialects:
+    with open(args.dialects) as f:
+      for name, rules in json.load(f).items():
+        parser.add_dialect(name, rules)
+  if args.dialect is not None and args.dialect not in parser.serializer.dialects:
+    ap.error(f'Unsupported dialect "{args.dialect}"')
+
+  jobs = args.jobs or os.cpu_count() or 1
+  progress = Progress(None if args.quiet else sys.stderr, args.progress)
+  infile = sys.stdin if args.input == '-' else open(args.input)
+  outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+  try:
+    summary = run(infile, outfile, parser, args.dialect, jobs, args.chunksize, progress)
+  finally:
+    if infile is not sys.stdin:
+      infile.close()
+    if outfile is not sys.stdout:
+      outfile.close()
+  progress.report()
+  return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
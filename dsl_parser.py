@@ -1,4 +1,13 @@
 
+import os
+import re
+from collections import namedtuple
+from operator import itemgetter
+from string import Formatter
+from time import perf_counter
+from types import MappingProxyType
+
+from cache import LRUCache, NodeInterner, SubtreeMemo, fingerprint
 from utils import has_cycle, reduce_macros
 
 
@@ -10,276 +19,1851 @@ DEFAULT_FIELDS = {
 }
 
 
-class ASTSerializer():
+# Master regex for the query scanner, every alternative has exactly one named group so that
+# `match.lastgroup` tells us the token kind. Order matters, e.g. fields must be tried before brackets.
+# Commas are whitespace, as in EDN, so they may separate the clauses of the top-level map
+_TOKEN_RE = re.compile(r'''
+    \[:field\s+(?P<field>\d+)\]
+  | :field\s+(?P<bare_field>\d+)
+  | (?P<open>\[)
+  | (?P<close>\])
+  | (?P<open_brace>\{)
+  | (?P<close_brace>\})
+  | (?P<op>:[^\s,\[\]{}]+)
+  | (?P<ws>[\s,]+)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<literal>[^\s,\[\]{}]+)
+  | (?P<mismatch>.)
+''', re.VERBOSE | re.DOTALL)
+
+# (min, max) number of nested where-clauses taken by the logical operators, None for unbounded
+LOGICAL_ARITY = {
+  ':and': (1, None),
+  ':or': (1, None),
+  ':not': (1, 1),
+}
+
+# SQL keyword of each direction accepted by :order-by, e.g. `:order-by [[:asc [:field 1]] [:desc [:field 2]]]`
+ORDER_DIRECTIONS = {
+  ':asc': 'ASC',
+  ':desc': 'DESC',
+}
+
+# Token types that end up as AST nodes
+_NODE_TOKENS = frozenset(('DSL_FIELD', 'DSL_OP', 'DSL_LITERAL', 'DSL_NIL'))
+
+_TOKEN_TYPES = {
+  'field': 'DSL_FIELD',
+  'bare_field': 'DSL_FIELD',
+  'open': 'DSL_OPEN_BRACKET',
+  'close': 'DSL_CLOSE_BRACKET',
+  'open_brace': 'DSL_OPEN_BRACE',
+  'close_brace': 'DSL_CLOSE_BRACE',
+  'op': 'DSL_OP',
+  'string': 'DSL_LITERAL',
+  'literal': 'DSL_LITERAL',
+}
+
+
+_NUMBER_RE = re.compile(r'-?\d+(\.\d*)?([eE][-+]?\d+)?')
+
+
+# Backslash escapes of "quoted" strings, as in EDN. Any other escaped character stands for itself
+_ESCAPES = {'"': '"', '\\': '\\', 'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}
+_ESCAPE_RE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)', re.DOTALL)
+
+
+def _unescape(m):
+  esc = m.group(1)
+  if len(esc) == 5:
+    return chr(int(esc[1:], 16))
+  return _ESCAPES.get(esc, esc)
+
+
+def decode_string(text):
   """
-  ASTSerializer takes an Abstract Syntax Tree (AST) built by DSLParser and outputs
-  its sql query string representation with respect to the configured dialect
+  Decode the backslash escapes of a "quoted" string token, e.g. `"a\\"b"` -> `"a"b"`, keeping the quotes
+  around it. Done once, when the literal node is built, so node values hold the string's actual text
+  """
+  if '\\' not in text or len(text) < 2 or not text.endswith('"'):
+    return text
+  return '"' + _ESCAPE_RE.sub(_unescape, text[1:-1]) + '"'
+
+
+def string_value(text):
+  """
+  Text of a decoded "quoted" string literal, without its quotes
+  """
+  return text[1:-1] if len(text) > 1 and text.endswith('"') else text[1:]
+
+
+def escape_string(text):
+  """
+  Text of a string literal as it goes between the single quotes of standard SQL, quotes inside it are doubled
+  """
+  return text.replace("'", "''")
+
+
+def escape_string_backslash(text):
+  """
+  `escape_string` for databases that read a backslash in a string literal as an escape character, like
+  MySQL by default, backslashes are doubled too so none can escape the closing quote
+  """
+  return text.replace('\\', '\\\\').replace("'", "''")
+
+
+# Escaping of inlined string literals by the `string_escape` rule of a dialect, every inlined string literal
+# goes through the one of its dialect (`Dialect.escape`)
+STRING_ESCAPES = {
+  'standard': escape_string,
+  'backslash': escape_string_backslash,
+}
+
+
+def literal_value(text):
+  """
+  Python value of a DSL literal, "quoted" strings become str, numerals int / float, anything else is kept as is
   """
+  if text.startswith('"'):
+    return string_value(text)
+  m = _NUMBER_RE.fullmatch(text)
+  if m is None:
+    return text
+  if m.group(1) is None and m.group(2) is None:
+    return int(text)
+  return float(text)
+
+
+# Field delimiters that are SQL identifier quotes, and so need escaping inside identifiers
+_QUOTE_CHARS = ('"', '`')
 
-  DEFAULT_DIALECT_PARAMS = {
+
+class Dialect:
+  """
+  Immutable, compiled form of a dialect's rules
+
+  Everything the serializer needs per node is resolved once here: the spaced `neq` operator, the field
+  delimiter and the query template, pre-split into words so that empty parts (no joins / where / order /
+  limit / offset) are simply dropped when rendering
+  """
+  __slots__ = ('name', 'rules', 'fingerprint', 'neq', 'field_delim', 'placeholder', 'limit_template',
+               'offset_template', 'offset_limit_template', 'unbounded_limit', 'default_order', 'shared_join',
+               'shared_ref', 'in_strategy', 'in_threshold', 'in_chunk_size', 'values_sep', 'in_templates',
+               'escape', '_template', '_parts')
+
+  # Rules holding templates of IN list strategies, see `ASTSerializer.serialize_in`
+  IN_TEMPLATES = ('in_any', 'not_in_any', 'array_literal', 'in_values', 'not_in_values')
+
+  DEFAULTS = {
     'neq': '<>',
     'field-delim': '"',
-    'template': "SELECT * FROM data {where_str} {limit_str}",
-    'limit_template': 'LIMIT {limit}'
+    'template': "SELECT {columns} FROM data {join_str} {where_str} {order_str} {limit_str} {offset_str}",
+    'limit_template': 'LIMIT {limit}',
+    'offset_template': 'OFFSET {offset}',
+    # When set, a limit that comes with an offset is emitted after it through this template, not `limit_template`
+    'offset_limit_template': None,
+    # Limit emitted for an offset without a limit, for dialects that only take an offset after a limit
+    'unbounded_limit': None,
+    # Order clause emitted for an offset without an :order-by, for dialects that only page ordered results
+    'default_order': None,
+    'placeholder': '?',
+    'shared_join': 'CROSS JOIN LATERAL (SELECT ({expr}) AS p) AS _s{index}',
+    'shared_ref': '_s{index}.p',
+    # IN lists of `in_threshold` or more values (None for never) are emitted through `in_strategy`, one of
+    # `list`, `chunk` (OR-ed IN lists of `in_chunk_size` values), `any` (one array) or `values` (a VALUES
+    # table, always inlined so the number of bound parameters stays bounded)
+    'in_strategy': 'list',
+    'in_threshold': None,
+    'in_chunk_size': 1000,
+    'in_any': '{left} = ANY({array})',
+    'not_in_any': '{left} <> ALL({array})',
+    'array_literal': 'ARRAY[{values}]',
+    'in_values': '{left} IN (SELECT v FROM (VALUES ({values})) AS _v(v))',
+    'not_in_values': '{left} NOT IN (SELECT v FROM (VALUES ({values})) AS _v(v))',
+    'values_sep': '), (',
+    # How quotes (and backslashes) inside inlined string literals are escaped, see `STRING_ESCAPES`
+    'string_escape': 'standard',
   }
 
-  def __init__(self, dialect = 'postgres', fields = DEFAULT_FIELDS):
-    self.dialect = dialect
-    self.fields = fields
-    self.added_operators = []
-
-    self.dialect_rules = {
-      'postgres': {
-        'neq': '<>',
-        'field-delim': '"',
-        'template': "SELECT * FROM data {where_str} {limit_str}",
-        'limit_template': 'LIMIT {limit}',
-      },
-      'mysql': {
-        'neq': '<>',
-        'field-delim': "`",
-        'template': "SELECT * FROM data {where_str} {limit_str}",
-        'limit_template': 'LIMIT {limit}',
-      },
-      'sqlserver': {
-        'neq': '<>',
-        'field-delim': '"',
-        'template': "SELECT {limit_str} * FROM data {where_str}",
-        'limit_template': 'TOP {limit}',
-      }
-    }
+  def __init__(self, name, rules):
+    """
+    :param name: The dialect name, e.g. `postgres`
+    :param rules: Dialect rules, missing ones are taken from `Dialect.DEFAULTS`
+    """
+    rules = {**Dialect.DEFAULTS, **rules}
+    init = super().__setattr__
+    init('name', name)
+    init('rules', MappingProxyType(rules))
+    init('fingerprint', fingerprint(name, rules))
+    init('neq', f" {rules['neq']} ")
+    init('field_delim', rules['field-delim'])
+    init('placeholder', rules['placeholder'])
+    init('limit_template', rules['limit_template'])
+    init('offset_template', rules['offset_template'])
+    init('offset_limit_template', rules['offset_limit_template'])
+    init('unbounded_limit', rules['unbounded_limit'])
+    init('default_order', rules['default_order'])
+    init('shared_join', rules['shared_join'])
+    init('shared_ref', rules['shared_ref'])
+    init('in_strategy', rules['in_strategy'])
+    init('in_threshold', rules['in_threshold'])
+    init('in_chunk_size', rules['in_chunk_size'])
+    init('values_sep', rules['values_sep'])
+    if rules['string_escape'] not in STRING_ESCAPES:
+      raise RuntimeError(f'Unsupported string escape "{rules["string_escape"]}"')
+    init('escape', STRING_ESCAPES[rules['string_escape']])
+    # {rule: ((literal text, field name or None), ...)}, so that list values can be spliced in unjoined
+    init('in_templates', MappingProxyType({
+      rule: tuple((lit, field) for lit, field, _, _ in Formatter().parse(rules[rule]))
+      for rule in Dialect.IN_TEMPLATES
+    }))
+    # Each word of the template is a tuple of (literal text, field name or None) pieces
+    template = tuple(tuple(Formatter().parse(word)) for word in rules['template'].split())
+    init('_template', template)
+    init('_parts', frozenset(field for word in template for _, field, _, _ in word if field))
+
+  def __setattr__(self, name, value):
+    raise AttributeError(f'Dialect "{self.name}" is immutable')
+
+  def __reduce__(self):
+    return (Dialect, (self.name, dict(self.rules)))
+
+  def quote_fields(self, fields):
+    """
+    {field id str: quoted identifier} for a {field id: column name} mapping
+    """
+    d = self.field_delim
+    if d not in _QUOTE_CHARS:
+      return {str(k): f'{d}{name}{d}' for k, name in fields.items()}
+    # Quote characters inside a quoted identifier are escaped by doubling them
+    return {str(k): f'{d}{name.replace(d, d + d)}{d}' for k, name in fields.items()}
 
-    self.leaf_to_str_map = {
-      'DSL_FIELD': self.serialize_field,
-      'DSL_LITERAL': self.serialize_literal,
-      'DSL_NIL': self.serialize_nil,
-      'DSL_LIST': self.serialize_list,
-    }
+  def render(self, defaults = (), **parts):
+    """
+    Fill the template in with `parts`, words that come out empty are dropped
 
-    self.node_to_str_map = {
-      'DSL_OP': self.serialize_op,
-    }
+    Raises a RuntimeError for a non empty part the template has no place for, e.g. an :order-by with a
+    custom template predating it, rather than silently dropping it
 
-    self.operator_to_str_map = {
-      ':and': self.serialize_and,
-      ':or': self.serialize_or,
-      ':not': self.serialize_not,
-      ':=': self.serialize_eq,
-      ':!=': self.serialize_neq,
-      ':<': self.serialize_lt,
-      ':>': self.serialize_gt,
-      ':in': self.serialize_in,
-      ':not-in': self.serialize_not_in,
-      ':is-empty': self.serialize_is_empty,
-      ':not-empty': self.serialize_not_empty,
-    }
+    :param defaults: Names of the parts that hold what the statement means anyway rather than content of
+      the query, e.g. `*` columns. Templates without a place for them, like `SELECT * FROM data ...`
+      predating {columns}, go without
+    """
+    for field, text in parts.items():
+      if text and field not in self._parts and field not in defaults:
+        raise RuntimeError(f'Dialect "{self.name}" template has no {{{field}}}')
+    words = []
+    for word in self._template:
+      text = ''.join(lit + parts[field] if field else lit for lit, field, _, _ in word)
+      if text:
+        words.append(text)
+    return ' '.join(words) + ';'
+
+  def limit(self, limit):
+    if limit is None:
+      return ""
+    return self.limit_template.format(limit=limit)
+
+  def paging(self, limit, offset):
+    """
+    The (limit_str, offset_str) parts for a limit and / or offset, either of which may be None
+    """
+    if offset is None:
+      return self.limit(limit), ""
+    if limit is None:
+      limit = self.unbounded_limit
+    offset_str = self.offset_template.format(offset=offset)
+    if self.offset_limit_template is None:
+      return self.limit(limit), offset_str
+    if limit is not None:
+      offset_str += " " + self.offset_limit_template.format(limit=limit)
+    return "", offset_str
+
+
+# Pushed after the parts of a node `postorder_memo` serializes, marks where its SQL ends
+_END = object()
+
+
+class _Values:
+  """
+  A run of list values `postorder_ast` writes straight to its output buffer, one fragment per value
+  """
+  __slots__ = ('nodes', 'sep', 'inline')
+
+  def __init__(self, nodes, sep = ", ", inline = False):
+    self.nodes = nodes
+    self.sep = sep
+    # Inline literals even when parameterizing
+    self.inline = inline
+
+
+# {(Dialect, fields key): quoted identifiers}, see `ASTSerializer.quoted_fields`
+_IDENTIFIER_TABLES = LRUCache(max_entries=1024)
+
+
+def _fields_key(fields):
+  # Keyed on the contents of a fields mapping rather than its identity, so a mapping edited in place
+  # (e.g. a renamed column) doesn't hit what was derived from its previous contents
+  return tuple(fields.items())
+
+# Rules of the dialects `Registry.builtin` comes with, rules they don't set are taken from `Dialect.DEFAULTS`
+BUILTIN_DIALECTS = {
+  'postgres': {
+    'neq': '<>',
+    'field-delim': '"',
+    'template': "SELECT {columns} FROM data {join_str} {where_str} {order_str} {limit_str} {offset_str}",
+    'limit_template': 'LIMIT {limit}',
+    'offset_template': 'OFFSET {offset}',
+    'placeholder': '${index}',
+    'in_strategy': 'any',
+    'in_threshold': 1000,
+    'shared_join': 'CROSS JOIN LATERAL (SELECT ({expr}) AS p) AS _s{index}',
+    'shared_ref': '_s{index}.p',
+  },
+  'mysql': {
+    'neq': '<>',
+    'field-delim': "`",
+    'template': "SELECT {columns} FROM data {join_str} {where_str} {order_str} {limit_str} {offset_str}",
+    'limit_template': 'LIMIT {limit}',
+    'offset_template': 'OFFSET {offset}',
+    'unbounded_limit': '18446744073709551615',
+    'placeholder': '%s',
+    'string_escape': 'backslash',
+    'in_strategy': 'chunk',
+    'in_threshold': 1000,
+    'in_values': '{left} IN (SELECT column_0 FROM (VALUES ROW({values})) AS _v)',
+    'not_in_values': '{left} NOT IN (SELECT column_0 FROM (VALUES ROW({values})) AS _v)',
+    'values_sep': '), ROW(',
+    'shared_join': 'CROSS JOIN LATERAL (SELECT ({expr}) AS p) AS _s{index}',
+    'shared_ref': '_s{index}.p',
+  },
+  'sqlserver': {
+    'neq': '<>',
+    'field-delim': '"',
+    'template': "SELECT {limit_str} {columns} FROM data {join_str} {where_str} {order_str} {offset_str}",
+    'limit_template': 'TOP {limit}',
+    # TOP doesn't mix with OFFSET, paged results are fetched after the offset and have to be ordered
+    'offset_template': 'OFFSET {offset} ROWS',
+    'offset_limit_template': 'FETCH NEXT {limit} ROWS ONLY',
+    'default_order': 'ORDER BY (SELECT NULL)',
+    'placeholder': '@p{index}',
+    # Statements take at most 2100 parameters
+    'in_strategy': 'values',
+    'in_threshold': 1000,
+    # No boolean columns, predicates are carried over as 1 / 0 / NULL
+    'shared_join': 'CROSS APPLY (SELECT CASE WHEN {expr} THEN 1 WHEN NOT ({expr}) THEN 0 END AS p) AS _s{index}',
+    'shared_ref': '_s{index}.p = 1',
+  }
+}
+
+
+class _StrOperator:
+  """
+  Adapts the serialize_func of a custom operator to the interface of the built-in operator serializers
+
+  Custom operators keep the simpler string in / string out interface, `func(serializer, node, l_str, r_str)`
+  with one string per child, padded with None for unary operators
+  """
+  __slots__ = ('func',)
+
+  def __init__(self, func):
+    self.func = func
+
+  def __call__(self, serializer, node):
+    strs = [serializer.postorder_ast(c) for c in node.children]
+    strs += [None] * (2 - len(strs))
+    return (self.func(serializer, node, *strs),)
+
+
+class OperatorSpec:
+  """
+  Declarative definition of a where-clause operator, an alternative to hand written parse / serialize
+  functions for `DSLParser.add_operator`
+
+  OperatorSpec(':between', ('field', 'literal', 'literal'), '{0} BETWEEN {1} AND {2}')
+  OperatorSpec(':starts-with', ('field', 'literal'), "{0} LIKE {1} || '%'", {'mysql': "{0} LIKE CONCAT({1}, '%')"})
+
+  Specs are compiled once, templates pre-split like the `Dialect` ones, into a parse function driven by the
+  table of argument kinds and a serializer returning the template's text and argument nodes as fragments
+  for `ASTSerializer.postorder_ast` to expand, the same way the built-in operators do
+
+  Arguments are spliced into the template as is, except nested `where` arguments which get parenthesized
+  like the operands of :and / :or. Parenthesize templates that wouldn't bind tighter than AND / OR
+  """
+  __slots__ = ('op_id', 'args', 'variadic', 'template', 'dialects', '_parsers', '_default', '_templates')
+
+  # Marks a template with {args} / {rest} or a `where` argument, see `_compile`
+  _GENERIC = object()
+
+  # Argument kinds, {kind: ParseContext function parsing one argument of that kind, None when absent}
+  ARG_KINDS = {
+    'field': lambda ctx: ctx.parse_field(),
+    'literal': lambda ctx: ctx.parse_scalar(),
+    'value': lambda ctx: ctx.parse_literal(),
+    'where': lambda ctx: ctx.parse_where(),
+  }
+
+  def __init__(self, op_id, args, template, dialects = None, variadic = False):
+    """
+    :param op_id: The operator id, e.g. `:between`
+    :param args: The kind of every argument, `field`, `literal` (a string or number), `value` (a field,
+      literal or nil) or `where` (a nested where-clause)
+    :param template: The SQL template, `{0}`, `{1}`, ... are replaced by the SQL of each argument, `{args}` by
+      all of them comma separated and `{rest}` by the repeated ones of a variadic operator
+    :param dialects: {dialect name: template} overriding `template` in those dialects
+    :param variadic: The last argument may be repeated, at least once
+    """
+    init = super().__setattr__
+    args = tuple(args)
+    if not args:
+      raise RuntimeError(f'Operator "{op_id}" takes no arguments')
+    unknown = [k for k in args if k not in OperatorSpec.ARG_KINDS]
+    if unknown:
+      raise RuntimeError(f'Unsupported argument kind(s) {", ".join(unknown)} of operator "{op_id}"')
+    init('op_id', op_id)
+    init('args', args)
+    init('variadic', variadic)
+    init('template', template)
+    init('dialects', MappingProxyType(dict(dialects or {})))
+    init('_parsers', tuple(OperatorSpec.ARG_KINDS[k] for k in args))
+    init('_default', self._compile(template))
+    init('_templates', MappingProxyType({name: self._compile(t) for name, t in self.dialects.items()}))
+
+  def __setattr__(self, name, value):
+    raise AttributeError(f'OperatorSpec "{self.op_id}" is immutable')
+
+  def __reduce__(self):
+    return (OperatorSpec, (self.op_id, self.args, self.template, dict(self.dialects), self.variadic))
+
+  def _compile(self, template):
+    # A template of fixed arguments that don't need parenthesizing compiles down to one itemgetter picking
+    # the fragments out of the node's children followed by the template's literal text. Any other one to
+    # `_GENERIC` and its ((literal text, argument index | 'args' | 'rest' | None), ...) pieces
+    pieces = []
+    for lit, field, _, _ in Formatter().parse(template):
+      if field is not None:
+        if field.isdigit() and int(field) < len(self.args):
+          field = int(field)
+        elif field not in ('args', 'rest') or (field == 'rest' and not self.variadic):
+          raise RuntimeError(f'Operator "{self.op_id}" template has no argument {{{field}}}')
+      pieces.append((lit, field))
+    pieces = tuple(pieces)
+    if self.variadic or 'where' in self.args or any(field.__class__ is str for _, field in pieces):
+      return (OperatorSpec._GENERIC, pieces)
+    lits = []
+    plan = []
+    for lit, field in pieces:
+      if lit:
+        plan.append(len(self.args) + len(lits))
+        lits.append(lit)
+      if field is not None:
+        plan.append(field)
+    if len(plan) == 1:
+      # itemgetter of a single index returns the item, not a tuple
+      plan.append(len(self.args) + len(lits))
+      lits.append('')
+    return (itemgetter(*plan), tuple(lits))
+
+  def parse(self, ctx):
+    """
+    The parse_func of the operator, called with the `ParseContext` positioned after the operator token
+    """
+    args = []
+    for parse_arg in self._parsers:
+      n = parse_arg(ctx)
+      if n is None:
+        raise SyntaxError(f'Expected {self._arity()} arg(s) to "{self.op_id}" ({", ".join(self.args)})')
+      args.append(n)
+    if self.variadic:
+      parse_arg = self._parsers[-1]
+      n = parse_arg(ctx)
+      while n is not None:
+        args.append(n)
+        n = parse_arg(ctx)
+    return Node('DSL_OP', self.op_id, *args)
+
+  def _arity(self):
+    return f'{len(self.args)}+' if self.variadic else len(self.args)
+
+  def _arg(self, serializer, node, i):
+    if self.args[min(i, len(self.args) - 1)] == 'where':
+      return serializer._wrap_nested(node)
+    return (node,)
+
+  def serialize(self, serializer, node):
+    """
+    The serializer of the operator, returns fragments in the same way as the built-in operator serializers
+    """
+    compiled, pieces = self._templates.get(serializer.dialect, self._default)
+    children = node.children
+    if compiled is not OperatorSpec._GENERIC:
+      return compiled(children + pieces)
+    parts = []
+    for lit, field in pieces:
+      if lit:
+        parts.append(lit)
+      if field is None:
+        continue
+      if field.__class__ is int:
+        parts.extend(self._arg(serializer, children[field], field))
+        continue
+      start = 0 if field == 'args' else len(self.args) - 1
+      for i in range(start, len(children)):
+        if i > start:
+          parts.append(", ")
+        parts.extend(self._arg(serializer, children[i], i))
+    return parts
+
+
+class Registry:
+  """
+  Immutable set of the operators and dialects parsers and serializers compile with
+
+  A registry is built once and then shared by every DSLParser / ASTSerializer using it, so constructing
+  those costs next to nothing. `with_operator` / `with_dialect` return an extended copy, leaving the
+  registry (and every parser sharing it) as it was
+
+  Custom operators are wrapped into the interface of the built-in ones when they are added, so every
+  operator, built-in or custom, is dispatched through a single dict lookup
+  """
+  __slots__ = ('serializer_cls', 'parse_operators', 'operator_to_str_map', 'custom_operators', 'dialects',
+               'leaf_to_str_map', 'node_to_str_map', 'in_strategy_map')
+
+  # {ASTSerializer class: its built-in registry}
+  _builtin = {}
+
+  def __init__(self, serializer_cls, parse_operators, operator_to_str_map, dialects, custom_operators = frozenset()):
+    """
+    :param serializer_cls: The ASTSerializer class whose node serializers are dispatched to
+    :param parse_operators: {op_id: parse_func}, see `DSLParser.add_operator`
+    :param operator_to_str_map: {op_id: func(serializer, node)}
+    :param dialects: {name: Dialect}
+    :param custom_operators: Ids of the operators added through `with_operator`
+    """
+    cls = serializer_cls
+    init = super().__setattr__
+    init('serializer_cls', cls)
+    init('parse_operators', MappingProxyType(dict(parse_operators)))
+    init('operator_to_str_map', MappingProxyType(dict(operator_to_str_map)))
+    init('custom_operators', frozenset(custom_operators))
+    init('dialects', MappingProxyType(dict(dialects)))
+    # Dispatch maps hold plain functions rather than bound methods so that they can be shared by every
+    # serializer, they are called as `func(serializer, node)`
+    init('leaf_to_str_map', MappingProxyType({
+      'DSL_FIELD': cls.serialize_field,
+      'DSL_LITERAL': cls.serialize_literal,
+      'DSL_NIL': cls.serialize_nil,
+      'DSL_TRUE': cls.serialize_true,
+      'DSL_FALSE': cls.serialize_false,
+    }))
+    init('node_to_str_map', MappingProxyType({
+      'DSL_OP': cls.serialize_op,
+      'DSL_LIST': cls.serialize_list,
+    }))
+    # IN list strategies, called as `func(serializer, left, values, negate)`, see `serialize_in`
+    init('in_strategy_map', MappingProxyType({
+      'list': cls.serialize_in_list,
+      'chunk': cls.serialize_in_chunks,
+      'any': cls.serialize_in_any,
+      'values': cls.serialize_in_values,
+    }))
+
+  @classmethod
+  def builtin(cls, serializer_cls = None):
+    """
+    The registry of the built-in operators and dialects, built on first use and shared from then on
+
+    :param serializer_cls: ASTSerializer or a subclass of it, whose (overridden) node serializers to dispatch to
+    """
+    serializer_cls = serializer_cls or ASTSerializer
+    registry = cls._builtin.get(serializer_cls)
+    if registry is None:
+      s = serializer_cls
+      registry = cls._builtin[serializer_cls] = cls(
+        serializer_cls,
+        {
+          ':and': ParseContext.parse_and,
+          ':or': ParseContext.parse_or,
+          ':not': ParseContext.parse_not,
+          ':=': ParseContext.parse_op_equals,
+          ':!=': ParseContext.parse_op_not_equals,
+          ':<': ParseContext.parse_op_lt,
+          ':>': ParseContext.parse_op_gt,
+          ':<=': ParseContext.parse_op_lte,
+          ':>=': ParseContext.parse_op_gte,
+          ':is-empty': ParseContext.parse_is_empty,
+          ':not-empty': ParseContext.parse_not_empty,
+        },
+        {
+          ':and': s.serialize_and,
+          ':or': s.serialize_or,
+          ':not': s.serialize_not,
+          ':=': s.serialize_eq,
+          ':!=': s.serialize_neq,
+          ':<': s.serialize_lt,
+          ':>': s.serialize_gt,
+          ':<=': s.serialize_lte,
+          ':>=': s.serialize_gte,
+          ':in': s.serialize_in,
+          ':not-in': s.serialize_not_in,
+          ':is-empty': s.serialize_is_empty,
+          ':not-empty': s.serialize_not_empty,
+        },
+        {name: Dialect(name, rules) for name, rules in BUILTIN_DIALECTS.items()},
+      )
+    return registry
+
+  def __setattr__(self, name, value):
+    raise AttributeError('Registry is immutable, see `with_operator` / `with_dialect`')
+
+  def __reduce__(self):
+    if Registry._builtin.get(self.serializer_cls) is self:
+      # Unpickled as the built-in registry of the receiving process, so it stays shared there too
+      return (Registry.builtin, (self.serializer_cls,))
+    return (Registry, (self.serializer_cls, dict(self.parse_operators), dict(self.operator_to_str_map),
+                       dict(self.dialects), self.custom_operators))
+
+  def with_operator(self, op_id, parse_func = None, serialize_func = None):
+    """
+    Copy of this registry with the operator `op_id` added, see `DSLParser.add_operator`. Either function
+    may be None to only extend parsing or serializing
+    """
+    parse_operators = self.parse_operators
+    if parse_func is not None:
+      if op_id in parse_operators:
+        raise Exception(f'DSLOperator operator exists with id: "{op_id}"')
+      parse_operators = {**parse_operators, op_id: parse_func}
+    operator_to_str_map = self.operator_to_str_map
+    custom_operators = self.custom_operators
+    if serialize_func is not None:
+      if op_id in operator_to_str_map:
+        raise Exception(f'ASTSerializer operator exists with id: "{op_id}"')
+      operator_to_str_map = {**operator_to_str_map, op_id: _StrOperator(serialize_func)}
+      custom_operators = custom_operators | {op_id}
+    return Registry(self.serializer_cls, parse_operators, operator_to_str_map, self.dialects, custom_operators)
+
+  def with_operators(self, *specs):
+    """
+    Copy of this registry with the operators of the `OperatorSpec`s `specs` added
+    """
+    parse_operators = dict(self.parse_operators)
+    operator_to_str_map = dict(self.operator_to_str_map)
+    for spec in specs:
+      if spec.op_id in parse_operators:
+        raise Exception(f'DSLOperator operator exists with id: "{spec.op_id}"')
+      if spec.op_id in operator_to_str_map:
+        raise Exception(f'ASTSerializer operator exists with id: "{spec.op_id}"')
+      parse_operators[spec.op_id] = spec.parse
+      operator_to_str_map[spec.op_id] = spec.serialize
+    return Registry(self.serializer_cls, parse_operators, operator_to_str_map, self.dialects,
+                    self.custom_operators | {spec.op_id for spec in specs})
+
+  def with_dialect(self, name, params):
+    """
+    Copy of this registry with `params` compiled into the `Dialect` `name`, rules it doesn't set are taken
+    from `Dialect.DEFAULTS`
+    """
+    if name in self.dialects:
+      raise RuntimeWarning(f'Overwriting dialect rules for {name}')
+    dialect = Dialect(name, params)
+    if dialect.in_strategy not in self.in_strategy_map:
+      raise RuntimeError(f'Unsupported IN list strategy "{dialect.in_strategy}"')
+    return Registry(self.serializer_cls, self.parse_operators, self.operator_to_str_map,
+                    {**self.dialects, name: dialect}, self.custom_operators)
+
+
+class _OnLanes:
+  """
+  A fragment `postorder_lanes` emits in some of its lanes only
+  """
+  __slots__ = ('item', 'lanes')
+
+  def __init__(self, item, lanes):
+    self.item = item
+    self.lanes = lanes
+
+
+def _same_fragment(a, b):
+  # Whether two fragments returned by operator serializers emit the same SQL
+  if a is b:
+    return True
+  if a.__class__ is str:
+    return a == b
+  if a.__class__ is _Values and b.__class__ is _Values:
+    return (a.sep == b.sep and a.inline == b.inline and len(a.nodes) == len(b.nodes)
+            and all(x is y for x, y in zip(a.nodes, b.nodes)))
+  return False
+
+
+def _merge_fragments(per_lane, on, every):
+  """
+  Merge the fragments an operator serialized to in each of the lanes `on` into one sequence, strings that
+  differ between lanes becoming a tuple of the text of every lane. None when the fragments differ in more
+  than their text
+  """
+  first = per_lane[0]
+  if any(len(frags) != len(first) for frags in per_lane):
+    return None
+  merged = []
+  for pos, a in enumerate(first):
+    column = [frags[pos] for frags in per_lane]
+    if all(_same_fragment(a, b) for b in column):
+      merged.append(a)
+    elif all(b.__class__ is str for b in column):
+      texts = dict(zip(on, column))
+      merged.append(tuple(texts.get(i, "") for i in every))
+    else:
+      return None
+  return merged
+
+
+class ASTSerializer():
+  """
+  ASTSerializer takes an Abstract Syntax Tree (AST) built by DSLParser and outputs
+  its sql query string representation with respect to the configured dialect
+  """
+
+  DEFAULT_DIALECT_PARAMS = Dialect.DEFAULTS
+
+  # Built-in operators whose serializers don't look at the dialect, `postorder_lanes` builds their fragments
+  # once for all dialects. Take an operator out when overriding its serializer with one that does
+  DIALECT_FREE_OPERATORS = frozenset((':and', ':or', ':not', ':=', ':<', ':>', ':<=', ':>=', ':is-empty', ':not-empty'))
+
+  def __init__(self, dialect = 'postgres', fields = DEFAULT_FIELDS, registry = None):
+    """
+    :param registry: The `Registry` of operators and dialects to serialize with, the built-in one by default
+    """
+    self.dialect = dialect
+    self.fields = fields
+    self.set_registry(registry or Registry.builtin(type(self)))
+    self._dialect = self.dialects[dialect]
+    self._quoted = self.quoted_fields(self._dialect, fields)
+
+    # Bound parameters collected by serialize_ast(..., parameterize=True), None when inlining literals
+    self.params = None
+    # {id(node): SQL reference} of the subtrees serialize_ast(..., shared=True) emitted once up front
+    self.shared = None
+    # Number of subtrees the last postorder_memo call took from its memo
+    self.reused = 0
+
+  def set_registry(self, registry):
+    """
+    Switch to the operators and dialects of the `Registry` `registry`, its maps are used as they are
+    """
+    self.registry = registry
+    self.dialects = registry.dialects
+    self.leaf_to_str_map = registry.leaf_to_str_map
+    self.node_to_str_map = registry.node_to_str_map
+    self.in_strategy_map = registry.in_strategy_map
+    self.operator_to_str_map = registry.operator_to_str_map
+
+  def __getstate__(self):
+    # The dispatch maps are read only views into the registry, which gets pickled on its own
+    state = self.__dict__.copy()
+    for name in ('dialects', 'leaf_to_str_map', 'node_to_str_map', 'in_strategy_map', 'operator_to_str_map'):
+      del state[name]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.set_registry(self.registry)
+
+  @property
+  def added_operators(self):
+    return self.registry.custom_operators
+
+  @property
+  def dialect_rules(self):
+    # Read only view of the rules of every dialect, kept for backwards compatibility
+    return {name: d.rules for name, d in self.dialects.items()}
+
+  def quoted_fields(self, dialect, fields):
+    """
+    {field id str: quoted identifier} table of `fields` in the `Dialect` `dialect`
+
+    Built once per (dialect, fields mapping contents) and then reused across calls, serializers and parsers
+    """
+    key = (dialect, _fields_key(fields))
+    table = _IDENTIFIER_TABLES.get(key)
+    if table is None:
+      table = dialect.quote_fields(fields)
+      _IDENTIFIER_TABLES.put(key, table)
+    return table
 
   def set_dialect(self, dialect):
-    if dialect not in self.dialect_rules:
+    if dialect not in self.dialects:
       raise RuntimeError(f'Unsupported dialect "{dialect}"')
     self.dialect = dialect
+    self._dialect = self.dialects[dialect]
+    self._quoted = self.quoted_fields(self._dialect, self.fields)
 
   def set_fields(self, fields):
     self.fields = fields
+    self._quoted = self.quoted_fields(self._dialect, fields)
+
+  def bind(self, dialect, fields):
+    """
+    Per call copy of this serializer holding its own dialect, fields and bound params
+
+    The dialect rules and operator maps are shared with (not copied from) this serializer, so concurrent
+    `generate_sql` calls can't step on each other's state
+    """
+    if dialect not in self.dialects:
+      raise RuntimeError(f'Unsupported dialect "{dialect}"')
+    bound = object.__new__(type(self))
+    bound.__dict__.update(self.__dict__)
+    bound.dialect = dialect
+    bound.fields = fields
+    bound._dialect = self.dialects[dialect]
+    bound._quoted = self.quoted_fields(bound._dialect, fields)
+    bound.params = None
+    bound.shared = None
+    bound.reused = 0
+    return bound
 
   def add_dialect(self, name, params):
-    if name in self.dialect_rules:
-      raise RuntimeWarning(f'Overwriting dialect rules for {name}')
-    self.dialect_rules[name] = {
-      **ASTSerializer.DEFAULT_DIALECT_PARAMS,
-      **params,
-    }
+    """
+    Compile `params` into a `Dialect`, rules it doesn't set are taken from `DEFAULT_DIALECT_PARAMS`
+    """
+    # Swaps in an extended registry rather than mutating the one bound copies and other serializers share
+    self.set_registry(self.registry.with_dialect(name, params))
 
   def add_operator(self, op_id, serialize_func):
-    if op_id in self.operator_to_str_map:
-      raise Exception(f'ASTSerializer operator exists with id: "{op_id}"')
-    self.added_operators.append(op_id)
-    self.operator_to_str_map[op_id] = serialize_func
-
-  def _get_field_delim(self):
-    return self.dialect_rules.get(self.dialect, {}).get('field-delim', "'")
+    self.set_registry(self.registry.with_operator(op_id, serialize_func=serialize_func))
 
-  def serialize_op(self, node, l_str, r_str):
-    if node.value in self.added_operators:
-      return self.operator_to_str_map[node.value](self, node, l_str, r_str)
-    return self.operator_to_str_map[node.value](node, l_str, r_str)
+  def serialize_op(self, node):
+    """
+    Operator serializers return a sequence of string fragments and child nodes, see `postorder_ast`
+    """
+    return self.operator_to_str_map[node.value](self, node)
 
   def serialize_field(self, node):
-    d = self._get_field_delim()
-    return(f'{d}{self.fields[int(node.value)]}{d}')
+    quoted = self._quoted.get(node.value)
+    if quoted is None:
+      raise SyntaxError(f'Unknown field id {node.value}')
+    return quoted
+
+  def _bind(self, text):
+    self.params.append(literal_value(text))
+    return self._dialect.placeholder.format(index=len(self.params))
 
   def serialize_literal(self, node):
     # @TODO: Improve robustness of string literal checking
-    if node.value.startswith('"'):
-      tmp = node.value.strip('"')
-      return(f"'{tmp}'")
-    return(node.value)
+    # @NOTE: In streaming mode node.value is a Span, this is the only place its text gets copied out
+    value = str(node.value)
+    if self.params is not None:
+      return self._bind(value)
+    if value.startswith('"'):
+      return f"'{self._dialect.escape(string_value(value))}'"
+    return(value)
 
   def serialize_nil(self, node):
     return("NULL")
+
+  def serialize_true(self, node):
+    # Constant predicates only come out of the optimizer
+    return("1 = 1")
+
+  def serialize_false(self, node):
+    return("1 = 0")
   
   def serialize_list(self, node):
-    tmp = ", ".join(node.value)
-    return(f"({tmp})")
+    # Values are literal nodes, so they get quoted / bound like any other literal
+    return ("(", _Values(node.children), ")")
+
+  def _inline_literal(self, node):
+    if node.type != 'DSL_LITERAL':
+      return self.leaf_to_str_map[node.type](self, node)
+    value = str(node.value)
+    if value.startswith('"'):
+      return f"'{self._dialect.escape(string_value(value))}'"
+    return value
+
+  def _write_values(self, values, out):
+    # Leaves only, so no need to go through the traversal stack
+    leaf_to_str_map = self.leaf_to_str_map
+    inline = values.inline and self.params is not None
+    sep = values.sep
+    first = True
+    for c in values.nodes:
+      if first:
+        first = False
+      else:
+        out.append(sep)
+      if inline:
+        out.append(self._inline_literal(c))
+      else:
+        out.append(leaf_to_str_map[c.type](self, c))
 
   def _has_nested(self, node):
-    # @TODO: Document usage
+    # Nested :and / :or need parentheses to keep their precedence inside another :and / :or
     if not node:
       return False
     return node.value in [':or', ':and']
 
-  def serialize_and(self, node, l_str, r_str):
-    if self._has_nested(node.left):
-      l_str = f"({l_str})"
-    if self._has_nested(node.right):
-      r_str = f"({r_str})"
-    return l_str + " AND " + r_str
-
-  def serialize_or(self, node, l_str, r_str):
-    if self._has_nested(node.left):
-      l_str = f"({l_str})"
-    if self._has_nested(node.right):
-      r_str = f"({r_str})"
-    return l_str + " OR " + r_str
-
-  def serialize_not(self, node, l_str, r_str):
-    # @NOTE: Code smell, this depends on the fact that our AST parser only populates left child for :not
-    return " NOT " + l_str
-
-  def serialize_eq(self, node, l_str, r_str):
+  def _wrap_nested(self, node):
+    if self._has_nested(node):
+      return ('(', node, ')')
+    return (node,)
+
+  def _join_operands(self, node, sep):
+    parts = []
+    for c in node.children:
+      if parts:
+        parts.append(sep)
+      parts.extend(self._wrap_nested(c))
+    return parts
+
+  def serialize_and(self, node):
+    return self._join_operands(node, " AND ")
+
+  def serialize_or(self, node):
+    return self._join_operands(node, " OR ")
+
+  def serialize_not(self, node):
+    return ("NOT ",) + self._wrap_nested(node.left)
+
+  def _is_nil(self, node):
+    return node is not None and node.type == 'DSL_NIL'
+
+  def serialize_eq(self, node):
     # @TODO: Handle if both children of :eq are NULL?
-    if (l_str and l_str != "NULL") and r_str == "NULL":
-      return l_str + " IS NULL"
-    elif l_str == "NULL" and (r_str and r_str != "NULL"):
-      return r_str + " IS NULL"
-    return l_str + " = " + r_str
+    if not self._is_nil(node.left) and self._is_nil(node.right):
+      return (node.left, " IS NULL")
+    elif self._is_nil(node.left) and not self._is_nil(node.right):
+      return (node.right, " IS NULL")
+    return (node.left, " = ", node.right)
+
+  def serialize_neq(self, node):
+    if not self._is_nil(node.left) and self._is_nil(node.right):
+      return (node.left, " IS NOT NULL")
+    elif self._is_nil(node.left) and not self._is_nil(node.right):
+      return (node.right, " IS NOT NULL")
+    return (node.left, self._dialect.neq, node.right)
+
+  def serialize_is_empty(self, node):
+    return (node.left, " IS NULL")
 
-  def serialize_neq(self, node, l_str, r_str):
-    if (l_str and l_str != "NULL") and r_str == "NULL":
-      return l_str + " IS NOT NULL"
-    elif l_str == "NULL" and (r_str and r_str != "NULL"):
-      return r_str + " IS NOT NULL"
-    neq = self.dialect_rules[self.dialect].get('neq', '<>')
-    return " ".join([l_str, neq, r_str])
+  def serialize_not_empty(self, node):
+    return (node.left, " IS NOT NULL")
 
-  def serialize_is_empty(self, node, l_str, r_str):
-    # @NOTE: Code smell, this depends on the fact that our AST parser only populates left child for :is-empty
-    return "IS NULL " + l_str
+  def serialize_lt(self, node):
+    return (node.left, " < ", node.right)
 
-  def serialize_not_empty(self, node, l_str, r_str):
-    # @NOTE: Code smell, this depends on the fact that our AST parser only populates left child for :not-empty
-    return "IS NOT NULL " + l_str
+  def serialize_gt(self, node):
+    return (node.left, " > ", node.right)
 
-  def serialize_lt(self, node, l_str, r_str):
-    return l_str + " < " + r_str
+  def serialize_lte(self, node):
+    return (node.left, " <= ", node.right)
 
-  def serialize_gt(self, node, l_str, r_str):
-    return l_str + " > " + r_str
+  def serialize_gte(self, node):
+    return (node.left, " >= ", node.right)
 
-  def serialize_in(self, node, l_str, r_str):
-    return l_str + " IN " + r_str
+  def serialize_in(self, node):
+    return self._serialize_in(node, False)
 
-  def serialize_not_in(self, node, l_str, r_str):
-    return l_str + " NOT IN " + r_str
+  def serialize_not_in(self, node):
+    return self._serialize_in(node, True)
+
+  def _serialize_in(self, node, negate):
+    """
+    Lists of the dialect's `in_threshold` or more values go through its `in_strategy`, which keeps huge
+    lists from turning into statements the database chokes on (or rejects, for too many parameters)
+    """
+    values = node.right.children if node.right.type == 'DSL_LIST' else None
+    threshold = self._dialect.in_threshold
+    if values and threshold is not None and len(values) >= threshold:
+      return self.in_strategy_map[self._dialect.in_strategy](self, node.left, values, negate)
+    return (node.left, " NOT IN " if negate else " IN ", node.right)
+
+  def _fill(self, rule, **parts):
+    # Fragments of one of the dialect's `in_templates`, parts may be nodes, strings or fragment lists
+    res = []
+    for lit, field in self._dialect.in_templates[rule]:
+      if lit:
+        res.append(lit)
+      if field:
+        part = parts[field]
+        if part.__class__ is list:
+          res.extend(part)
+        else:
+          res.append(part)
+    return res
+
+  def serialize_in_list(self, left, values, negate):
+    return (left, " NOT IN (" if negate else " IN (", _Values(values), ")")
+
+  def serialize_in_chunks(self, left, values, negate):
+    # x IN (1, 2) OR x IN (3, 4), or x NOT IN (1, 2) AND x NOT IN (3, 4)
+    size = self._dialect.in_chunk_size
+    op = " NOT IN (" if negate else " IN ("
+    sep = " AND " if negate else " OR "
+    parts = ["("]
+    for i in range(0, len(values), size):
+      if i:
+        parts.append(sep)
+      parts += [left, op, _Values(values[i:i + size]), ")"]
+    parts.append(")")
+    return parts
+
+  def serialize_in_any(self, left, values, negate):
+    # x = ANY(<array>), bound as a single array parameter when parameterizing
+    if self.params is not None:
+      if any(c.type not in ('DSL_LITERAL', 'DSL_NIL') for c in values):
+        # Field references can't go in a bound array
+        return self.serialize_in_chunks(left, values, negate)
+      self.params.append([None if c.type == 'DSL_NIL' else literal_value(str(c.value)) for c in values])
+      array = self._dialect.placeholder.format(index=len(self.params))
+    else:
+      array = self._fill('array_literal', values=_Values(values))
+    return self._fill('not_in_any' if negate else 'in_any', left=left, array=array)
+
+  def serialize_in_values(self, left, values, negate):
+    # x IN (SELECT v FROM (VALUES (1), (2)) AS _v(v)), a semi-join the planner can hash
+    rows = _Values(values, self._dialect.values_sep, inline=True)
+    return self._fill('not_in_values' if negate else 'in_values', left=left, values=rows)
 
   def postorder_ast(self, node):
     """
-    Post order AST traversal for serializing SQL query with respect to selected dialect
+    AST traversal for serializing SQL query with respect to selected dialect
     This is the meat of this class
+
+    The traversal uses an explicit stack so deeply nested where-clauses can't hit the recursion limit.
+    Operator serializers return their output as a sequence of string fragments and child nodes, child
+    nodes get expanded in place and all fragments are joined exactly once at the very end. List values
+    are written to the output as they are reached, however long the list
     """
-    if not node:
+    if node is None:
       return None
-    
-    if node.is_leaf():
-      return self.leaf_to_str_map[node.type](node)
-    
-    l_str = self.postorder_ast(node.left)
-    r_str = self.postorder_ast(node.right)
-    return self.node_to_str_map[node.type](node, l_str, r_str)
-  
-  def _get_template(self):
-    default = "SELECT * FROM data WHERE {where_str} {limit_str}"
-    return self.dialect_rules.get(self.dialect, {}).get('template', default)
 
-  def _get_limit_str(self, limit):
-    if limit is None:
-      return ""
-    tmp = self.dialect_rules.get(self.dialect, {}).get('limit_template', 'LIMIT {limit}')
-    return tmp.format(limit=limit)
+    out = []
+    shared = self.shared
+    stack = [node]
+    while stack:
+      item = stack.pop()
+      if item.__class__ is str:
+        out.append(item)
+      elif item.__class__ is _Values:
+        self._write_values(item, out)
+      elif shared and id(item) in shared:
+        out.append(shared[id(item)])
+      elif item.is_leaf():
+        out.append(self.leaf_to_str_map[item.type](self, item))
+      else:
+        stack.extend(reversed(self.node_to_str_map[item.type](self, item)))
+    return "".join(out)
+
+  def _dialect_free(self, node):
+    # Whether the fragments of the operator node `node` are the same whatever the dialect
+    if node.type != 'DSL_OP':
+      return node.type == 'DSL_LIST'
+    if node.value in self.DIALECT_FREE_OPERATORS:
+      return True
+    spec = getattr(self.operator_to_str_map.get(node.value), '__self__', None)
+    return isinstance(spec, OperatorSpec) and not spec.dialects
 
-  def serialize_ast(self, ast, limit = None):
+  def postorder_lanes(self, node, lanes):
+    """
+    `postorder_ast` for several bound serializers, one per dialect, in a single traversal
+
+    Every item on the stack carries the lanes (indices into `lanes`) it gets emitted in. Leaves that render
+    the same in every lane, e.g. inlined literals or the fields of dialects sharing a field delimiter, and
+    the fragments of `DIALECT_FREE_OPERATORS` are built once and shared. Other operators are called once per
+    lane: fragments that only differ in their text, e.g. the `neq` of :!=, are emitted per lane while the
+    children stay shared, lanes only part ways below an operator whose fragments differ in structure, e.g.
+    an IN list emitted through different strategies
+
+    :returns: A list of one SQL string per serializer
+    """
+    n = len(lanes)
+    every = tuple(range(n))
+    # Leaves render the same in lanes whose key for the leaf type is the same
+    keys = {
+      'DSL_FIELD': [s._dialect.field_delim for s in lanes],
+      'DSL_LITERAL': [s._dialect.escape if s.params is None else i for i, s in enumerate(lanes)],
+      'DSL_NIL': [None] * n,
+      'DSL_TRUE': [None] * n,
+      'DSL_FALSE': [None] * n,
+    }
+    # {leaf type: (lanes to render in, index of the text of every lane)} when rendered in every lane
+    plans = {}
+    for t, lane_keys in keys.items():
+      firsts = list(dict.fromkeys(lane_keys))
+      plans[t] = ([lane_keys.index(k) for k in firsts], tuple(firsts.index(k) for k in lane_keys))
+    leaf_to_str_map = self.leaf_to_str_map
+    node_to_str_map = self.node_to_str_map
+    # Text shared by every lane since the last per lane segment, and the (shared str | per lane tuple) segments
+    out = []
+    segments = []
+    # Items emitted in some of the lanes only are wrapped in an `_OnLanes`
+    stack = [node]
+    while stack:
+      item = stack.pop()
+      on = every
+      if item.__class__ is _OnLanes:
+        on = item.lanes
+        item = item.item
+      if item.__class__ is str:
+        if on is every:
+          out.append(item)
+          continue
+        item = tuple(item if i in on else "" for i in every)
+      if item.__class__ is tuple:
+        segments.append("".join(out))
+        segments.append(item)
+        out = []
+        continue
+
+      if item.__class__ is _Values:
+        inline = item.inline and lanes[on[0]].params is not None
+        types = {c.type for c in item.nodes}
+        groups = {}
+        for i in on:
+          key = tuple(lanes[i]._dialect.escape if inline and t == 'DSL_LITERAL' else keys.get(t, every)[i]
+                      for t in types)
+          groups.setdefault(key, []).append(i)
+        if len(groups) == 1 and on is every:
+          lanes[0]._write_values(item, out)
+          continue
+        texts = [""] * n
+        for group in groups.values():
+          buf = []
+          lanes[group[0]]._write_values(item, buf)
+          text = "".join(buf)
+          for i in group:
+            texts[i] = text
+        stack.append(tuple(texts))
+      elif item.is_leaf():
+        func = leaf_to_str_map[item.type]
+        if on is every and item.type in plans:
+          render, pick = plans[item.type]
+          if len(render) == 1:
+            out.append(func(lanes[0], item))
+          else:
+            texts = [func(lanes[i], item) for i in render]
+            stack.append(tuple(texts[j] for j in pick))
+          continue
+        lane_keys = keys.get(item.type, every)
+        texts = {}
+        for i in on:
+          if lane_keys[i] not in texts:
+            texts[lane_keys[i]] = func(lanes[i], item)
+        stack.append(tuple(texts[lane_keys[i]] if i in on else "" for i in every))
+      elif self._dialect_free(item):
+        frags = node_to_str_map[item.type](lanes[on[0]], item)
+        if on is every:
+          stack.extend(reversed(frags))
+        else:
+          stack.extend(_OnLanes(x, on) for x in reversed(frags))
+      else:
+        func = node_to_str_map[item.type]
+        per_lane = [func(lanes[i], item) for i in on]
+        merged = _merge_fragments(per_lane, on, every)
+        if merged is not None:
+          groups = [(on, merged)]
+        else:
+          # Different structures, every group of lanes with the same fragments goes its own way
+          groups = []
+          for i, frags in zip(on, per_lane):
+            for group in groups:
+              if len(group[1]) == len(frags) and all(map(_same_fragment, group[1], frags)):
+                group[0].append(i)
+                break
+            else:
+              groups.append(([i], frags))
+        for group, frags in groups:
+          if group is every:
+            stack.extend(reversed(frags))
+          else:
+            group = tuple(group)
+            stack.extend(_OnLanes(x, group) for x in reversed(frags))
+    segments.append("".join(out))
+    return ["".join(s if s.__class__ is str else s[i] for s in segments) for i in every]
+
+  def postorder_memo(self, node, memo):
+    """
+    `postorder_ast` that takes the SQL of operator subtrees found in the `cache.SubtreeMemo` `memo` as is
+    and records the SQL of every other one, so serializing an edited AST only walks the subtrees that
+    changed, i.e. the paths from the edits up to the root
+
+    The number of subtrees reused is left in `self.reused`
+    """
+    numbers = memo.number(node)
+    fragments = memo.fragments
+    leaf_to_str_map = self.leaf_to_str_map
+    out = []
+    pos = 0
+    open_nodes = []
+    spans = []
+    self.reused = 0
+    stack = [node]
+    while stack:
+      item = stack.pop()
+      if item.__class__ is str:
+        out.append(item)
+        pos += len(item)
+      elif item is _END:
+        n, start = open_nodes.pop()
+        spans.append((n, start, pos))
+      elif item.__class__ is _Values:
+        start = len(out)
+        self._write_values(item, out)
+        pos += sum(map(len, out[start:]))
+      elif item.is_leaf():
+        text = leaf_to_str_map[item.type](self, item)
+        out.append(text)
+        pos += len(text)
+      else:
+        n = numbers.get(id(item))
+        fragment = fragments.get(n) if n is not None else None
+        if n is None:
+          # Below a subtree carried over from the previous AST whose fragment is gone
+          stack.extend(reversed(self.node_to_str_map[item.type](self, item)))
+        elif fragment is not None:
+          sql, start, end = fragment
+          out.append(sql[start:end])
+          pos += end - start
+          self.reused += 1
+        else:
+          open_nodes.append((n, pos))
+          stack.append(_END)
+          stack.extend(reversed(self.node_to_str_map[item.type](self, item)))
+    res = "".join(out)
+    memo.record(res, spans, numbers)
+    return res
+
+  def shared_subtrees(self, ast):
+    """
+    Operator nodes that occur more than once in the fully expanded `ast`, e.g. the AST of a macro that
+    is referenced twice, in the order they have to be defined in (shared descendants first)
+
+    Occurrences are counted over the DAG, a subtree repeated only within another shared subtree counts
+    once as that one gets emitted once
+    """
+    if ast is None:
+      return []
+
+    # Post order over the DAG, reversed it lists every node before its children
+    order = []
+    seen = set()
+    stack = [(ast, False)]
+    while stack:
+      node, expanded = stack.pop()
+      if expanded:
+        order.append(node)
+        continue
+      if id(node) in seen:
+        continue
+      seen.add(id(node))
+      stack.append((node, True))
+      stack.extend((c, False) for c in node.children if id(c) not in seen)
+
+    counts = {id(ast): 1}
+    res = []
+    for node in reversed(order):
+      n = counts[id(node)]
+      if n > 1 and node.type == 'DSL_OP':
+        res.append(node)
+        n = 1
+      for c in node.children:
+        counts[id(c)] = counts.get(id(c), 0) + n
+    res.reverse()
+    return res
+
+  def _serialize_shared(self, ast):
+    # Emit every shared subtree once as a derived column, later uses refer to the column
+    join_template = self._dialect.shared_join
+    ref_template = self._dialect.shared_ref
+    self.shared = {}
+    joins = []
+    for index, node in enumerate(self.shared_subtrees(ast), 1):
+      joins.append(join_template.format(expr=self.postorder_ast(node), index=index))
+      self.shared[id(node)] = ref_template.format(index=index)
+    return " ".join(joins)
+
+  def serialize_ast(self, ast, limit = None, parameterize = False, shared = False, offset = None, order_by = None,
+                    columns = None, memo = None):
     """
     Take AST and return its SQL query string representation
+
+    :param parameterize: Replace literals by the dialect's `placeholder` and return a tuple of
+      (sql, params) where params holds the typed literal values in placeholder order
+    :param shared: Emit subtrees that occur more than once (see `shared_subtrees`) a single time, as
+      a derived column joined through the dialect's `shared_join` and referenced through `shared_ref`
+    :param order_by: A sequence of (DSL_FIELD node, `ASC` | `DESC`) pairs, see `Query`
+    :param columns: A sequence of DSL_FIELD nodes to select instead of every column
+    :param memo: A `cache.SubtreeMemo` to reuse the SQL of unchanged subtrees from, see `postorder_memo`
     """
-    template = self._get_template()
-    limit_str = self._get_limit_str(limit)
-    # @NOTE This final formatting of the result is.. let's say.. not ideal
-    where_str = "WHERE " + self.postorder_ast(ast) if ast is not None else ""
-    return template.format(where_str=where_str, limit_str=limit_str).replace('  ', ' ').strip() + ";"
+    if memo is not None and (parameterize or shared):
+      raise RuntimeError('Subtree memoization works on inlined, unshared SQL only')
+    if parameterize:
+      self.params = []
+    try:
+      join_str = self._serialize_shared(ast) if shared else ""
+      if ast is None:
+        where_str = ""
+      elif memo is not None:
+        where_str = "WHERE " + self.postorder_memo(ast, memo)
+      else:
+        where_str = "WHERE " + self.postorder_ast(ast)
+      sql = self._render_query(where_str, join_str, limit, offset, order_by, columns)
+      if parameterize:
+        return sql, tuple(self.params)
+      return sql
+    finally:
+      self.params = None
+      self.shared = None
+
+  def _render_query(self, where_str, join_str, limit, offset, order_by, columns):
+    # The statement around an already serialized where-clause
+    defaults = []
+    if columns:
+      columns_str = ", ".join(self.serialize_field(f) for f in columns)
+    else:
+      columns_str = "data.*" if join_str else "*"
+      defaults.append('columns')
+    if order_by:
+      order_str = "ORDER BY " + ", ".join(f"{self.serialize_field(f)} {d}" for f, d in order_by)
+    elif offset is not None:
+      order_str = self._dialect.default_order or ""
+    else:
+      order_str = ""
+    limit_str, offset_str = self._dialect.paging(limit, offset)
+    return self._dialect.render(
+      defaults,
+      columns=columns_str,
+      join_str=join_str,
+      where_str=where_str,
+      order_str=order_str,
+      limit_str=limit_str,
+      offset_str=offset_str,
+    )
+
+  def serialize_query(self, query, parameterize = False, shared = False, memo = None):
+    """
+    `serialize_ast` over every clause of a `Query`
+    """
+    return self.serialize_ast(query.where, limit=query.limit, parameterize=parameterize, shared=shared,
+                              offset=query.offset, order_by=query.order_by, columns=query.fields, memo=memo)
+
+  def serialize_multi(self, query, dialects, fields, parameterize = False):
+    """
+    `serialize_query` of the `Query` `query` in each of `dialects` at once, walking its where-clause a single
+    time, see `postorder_lanes`
+
+    :returns: A list of one result per dialect, as `serialize_query` returns them
+    """
+    lanes = [self.bind(d, fields) for d in dialects]
+    if parameterize:
+      for s in lanes:
+        s.params = []
+    if query.where is None:
+      wheres = [""] * len(lanes)
+    else:
+      wheres = ["WHERE " + w for w in self.postorder_lanes(query.where, lanes)]
+    res = []
+    for s, where_str in zip(lanes, wheres):
+      sql = s._render_query(where_str, "", query.limit, query.offset, query.order_by, query.fields)
+      res.append((sql, tuple(s.params)) if parameterize else sql)
+    return res
+
+
+class Span:
+  """
+  Lazy reference to a slice of the original query string
+
+  Used as the value of DSL_LITERAL nodes in streaming mode so that literal text is only copied out of
+  the query when it actually gets serialized
+  """
+  __slots__ = ('source', 'start', 'end')
+
+  def __init__(self, source, start, end):
+    self.source = source
+    self.start = start
+    self.end = end
+
+  def __str__(self):
+    return self.source[self.start:self.end]
+
+  def __repr__(self):
+    return f"Span({self.start},{self.end})"
 
 
 class Node:
   """
   Building block class for composing ASTs generated by DSLParser
+
+  Operator nodes hold any number of operands in `children`, e.g. every term of an :and or every value
+  of a DSL_LIST. `left` / `right` are shorthands for the first two children
+
+  Nodes may be shared between ASTs once hash-consed by DSLParser's AST cache, treat parsed trees as immutable
+
+  Nodes use `__slots__` since ASTs for e.g. pasted lists of IDs run into hundreds of thousands of them
   """
-  def __init__(self, type, value, left = None, right = None):
+  __slots__ = ('type', 'value', 'children')
+
+  def __init__(self, type, value, *children):
     self.type = type
     self.value = value
-    self.left = left
-    self.right = right
+    # None children are dropped so `Node(type, value, left, None)` keeps working for unary operators
+    self.children = tuple(c for c in children if c is not None)
 
-  def is_leaf(self):
-    return self.left is None and self.right is None
+  @property
+  def left(self):
+    return self.children[0] if self.children else None
 
-  def __str__(self):
-    return(f"Node({self.type},{self.value},{self.left},{self.right})")
+  @property
+  def right(self):
+    return self.children[1] if len(self.children) > 1 else None
+
+  def is_leaf(self):
+    return not self.children
 
   def __repr__(self):
-    return(f"Node({self.type},{self.value},{self.left},{self.right})")
+    # Iterative so that formatting very deep ASTs can't hit the recursion limit
+    out = []
+    stack = [self]
+    while stack:
+      item = stack.pop()
+      if item.__class__ is str:
+        out.append(item)
+        continue
+      out.append(f"Node({item.type},{item.value},[")
+      stack.append("])")
+      for i in range(len(item.children) - 1, -1, -1):
+        stack.append(item.children[i])
+        if i:
+          stack.append(", ")
+    return "".join(out)
 
+  __str__ = __repr__
 
-class DSLParser:
-  def __init__(self):
-    self.serializer = ASTSerializer()
-    self.added_operators = []
-    self.tokens = None
-    self.current = None
-    self.operators = {
-      ':and': self.parse_and,
-      ':or': self.parse_or,
-      ':not': self.parse_not,
-      ':=': self.parse_op_equals,
-      ':!=': self.parse_op_not_equals,
-      ':<': self.parse_op_lt,
-      ':>': self.parse_op_gt,
-      ':is-empty': self.parse_is_empty,
-      ':not-empty': self.parse_not_empty,
-    }
 
-  def set_tokens(self, tokens):
+def count_nodes(ast):
+  """
+  Number of nodes of `ast` as a tree, i.e. counting subtrees shared between several parents once per parent
+  """
+  if ast is None:
+    return 0
+  counts = {}
+  stack = [ast]
+  while stack:
+    node = stack[-1]
+    pending = [c for c in node.children if id(c) not in counts]
+    if pending:
+      stack.extend(pending)
+      continue
+    stack.pop()
+    counts[id(node)] = 1 + sum(counts[id(c)] for c in node.children)
+  return counts[id(ast)]
+
+
+class CompileListener:
+  """
+  Base class for instrumentation listeners attached through `DSLParser.add_listener`, override any of
+  the callbacks. They are called synchronously on the compiling thread so keep them cheap
+  """
+
+  def stage_start(self, event, stage):
+    pass
+
+  def stage_end(self, event, stage, elapsed):
+    pass
+
+  def compile_end(self, event):
+    pass
+
+
+class CompileEvent:
+  """
+  One instrumented `generate_sql` / `parse_query` call as seen by listeners
+
+  `stages` maps every stage that ran (tokenize, parse, macros, optimize, serialize, shape) to its
+  duration in seconds. `stats` collects what the call learned along the way: `tokens`, `nodes`, `macro_size` /
+  `macro_nodes` / `macro_depth`, the optimizer rewrites that `fired` ({rewrite: count}), `sql_length` and the
+  `cache` / `ast_cache` / `shape_cache` outcome ('hit' / 'miss').
+  `elapsed` and `error` get set once the call is done
+  """
+  __slots__ = ('kind', 'query', 'dialect', 'listeners', 'stages', 'stats', 'elapsed', 'error', '_start', '_stage_start')
+
+  def __init__(self, listeners, kind, query, dialect = None):
+    self.kind = kind
+    self.query = query
+    self.dialect = dialect
+    self.listeners = listeners
+    self.stages = {}
+    self.stats = {}
+    self.elapsed = None
+    self.error = None
+    self._stage_start = None
+    self._start = perf_counter()
+
+  def start(self, stage):
+    for listener in self.listeners:
+      listener.stage_start(self, stage)
+    self._stage_start = perf_counter()
+
+  def end(self, stage, **stats):
+    elapsed = perf_counter() - self._stage_start
+    self.stages[stage] = elapsed
+    self.stats.update(stats)
+    for listener in self.listeners:
+      listener.stage_end(self, stage, elapsed)
+
+  def finish(self, error = None):
+    self.elapsed = perf_counter() - self._start
+    self.error = error
+    for listener in self.listeners:
+      listener.compile_end(self)
+
+
+def _count_tokens(tokens, stats):
+  # Pass a token stream through, recording its length once the parser has drained it
+  n = 0
+  for t in tokens:
+    n += 1
+    yield t
+  stats['tokens'] = n
+
+
+def _macros_key(macros):
+  # A MacroLibrary keeps a fingerprint of its contents up to date, plain dicts are fingerprinted as is
+  return getattr(macros, 'fingerprint', macros)
+
+
+# A parsed query: its where-clause AST and the other top-level clauses, None when absent. `order_by` is a
+# tuple of (DSL_FIELD node, `ASC` | `DESC`) pairs and `fields` a tuple of DSL_FIELD nodes
+Query = namedtuple('Query', ['where', 'limit', 'offset', 'order_by', 'fields'], defaults=(None,) * 5)
+
+# Result of `DSLParser.compile`, `sql` as returned by `generate_sql` and the `cache.SubtreeMemo` to pass on
+# to the next compile of an edited version of the query. `reused` counts the subtrees taken from the memo
+Compilation = namedtuple('Compilation', ['sql', 'memo', 'reused'])
+
+# Outcome of one request of `DSLParser.generate_sql_many`, exactly one of `result` / `error` is None
+BatchResult = namedtuple('BatchResult', ['result', 'error'])
+
+
+# The tokens `query_shape` looks at: the same alternatives, in the same order, as `_TOKEN_RE` minus brackets and
+# whitespace, which are skipped over by the search and so stay part of the shape as they are
+_SHAPE_RE = re.compile(r'''
+    \[:field\s+\d+\]
+  | :field\s+\d+
+  | (?P<op>:[^\s,\[\]{}]+)
+  | (?P<literal>"(?:[^"\\]|\\.)*"|[^\s,\[\]{}]+)
+''', re.VERBOSE)
+
+# Ops whose literal argument is not a value but part of the shape, e.g. the id of a [:macro "<macro_id>"]
+_SHAPE_OPS = frozenset((':macro',))
+
+
+def query_shape(query):
+  """
+  Split a query into its shape, the query text with every literal value cut out, and those literals
+
+  Literals are replaced by a marker telling quoted strings from other literals apart, as they serialize
+  differently. `nil` and macro ids are kept, they change the structure rather than the values
+
+  :returns: A tuple of (shape str, list of literal texts in query order)
+  """
+  parts = []
+  literals = []
+  pos = 0
+  prev = None
+  for m in _SHAPE_RE.finditer(query):
+    kind = m.lastgroup
+    if kind == 'literal':
+      text = m.group(kind)
+      if text != 'nil' and prev not in _SHAPE_OPS:
+        start, end = m.span()
+        parts.append(query[pos:start])
+        parts.append('\x00"' if text[0] == '"' else '\x00')
+        literals.append(text)
+        pos = end
+      prev = None
+    else:
+      prev = m.group(kind) if kind == 'op' else None
+  parts.append(query[pos:])
+  return ''.join(parts), literals
+
+
+# Marks the slot of the literal <index> in the SQL of a shape, see `ShapeTemplate.compile`
+_SLOT_RE = re.compile(r"\x00(\d+)('*|#)\x00")
+
+# How a slot is filled in, by the suffix of its marker: as is, quotes stripped (`serialize_literal`),
+# quotes stripped and escaped (`_inline_literal`) or as a :limit / :offset count
+_SLOT_MODES = {'': 0, "'": 1, "''": 2, '#': 3}
+
+
+def _replace_values(root, values):
+  """
+  Copy of the AST `root` with the value of the nodes in `values` ({id(node): value}) replaced, subtrees
+  without any such node are shared rather than copied
+  """
+  done = {}
+  stack = [(root, False)]
+  while stack:
+    node, expanded = stack.pop()
+    if id(node) in done:
+      continue
+    if not expanded:
+      stack.append((node, True))
+      stack.extend((c, False) for c in node.children if id(c) not in done)
+      continue
+    children = [done[id(c)] for c in node.children]
+    value = values.get(id(node), node.value)
+    if value is node.value and all(a is b for a, b in zip(children, node.children)):
+      done[id(node)] = node
+    else:
+      done[id(node)] = Node(node.type, value, *children)
+  return done[id(root)]
+
+
+class ShapeTemplate:
+  """
+  The SQL a query shape (see `query_shape`) compiles to for one dialect and fields mapping, with a slot
+  wherever one of the query's literals ends up. Filling the slots with the literals of any query of that
+  shape gives the same result as compiling it from scratch, without tokenizing, parsing nor serializing
+  """
+  __slots__ = ('fields', 'pieces', 'slots', 'params', 'counts', 'macro_size', 'max_size', 'escape')
+
+  def __init__(self, fields, pieces, slots, params, counts, macro_size = None, max_size = None,
+               escape = escape_string):
+    """
+    :param fields: The fields mapping the template was compiled for
+    :param pieces: The SQL around the slots, one more than there are slots
+    :param slots: A (literal index, `_SLOT_MODES` mode) pair per slot
+    :param params: None if not parameterized, else how to build each param: (0, literal index),
+      (1, constant) or (2, tuple of the same for a list param)
+    :param counts: {literal index: clause} of the :limit / :offset values
+    :param macro_size: Size of the macro expansion of the where-clause minus the length of its literals
+    :param max_size: The `max_size` of the macros, checked against `macro_size` plus the where-clause literals
+    :param escape: How the dialect escapes inlined string literals (`Dialect.escape`)
+    """
+    self.fields = fields
+    self.pieces = pieces
+    self.slots = slots
+    self.params = params
+    self.counts = counts
+    self.macro_size = macro_size
+    self.max_size = max_size
+    self.escape = escape
+
+  @classmethod
+  def compile(cls, parser, dialect, fields, query, macros, parameterize):
+    """
+    Compile `query` once with its literals and once with markers in their place, the template is the SQL
+    of the latter cut at the markers
+
+    :returns: A tuple of (the `generate_sql` result for `query`, the template or None when `query` doesn't
+      make one, e.g. a custom operator turned a literal into something else than a literal node)
+    """
+    if isinstance(macros, dict):
+      from macros import MacroLibrary
+      macros = MacroLibrary(macros, validate=False) if macros else None
+    # An event nobody listens to still collects the size of the macro expansion
+    event = CompileEvent((), 'generate_sql', query)
+    parsed, field_ids = parser._parse_query_uncached(query, macros, True, event)
+    parser._check_fields(field_ids, fields)
+    serializer = parser.serializer.bind(dialect, fields)
+    res = serializer.serialize_query(parsed, parameterize=parameterize)
+    res = (f'"{res[0]}"', res[1]) if parameterize else f'"{res}"'
+
+    # Match literal nodes (their values are spans in streaming mode) and :limit / :offset values with the
+    # literals `query_shape` cut out
+    index = {}
+    counts = {}
+    prev = None
+    for m in _SHAPE_RE.finditer(query):
+      kind = m.lastgroup
+      if kind == 'literal':
+        text = m.group(kind)
+        if text != 'nil' and prev not in _SHAPE_OPS:
+          if prev in (':limit', ':offset'):
+            counts[len(index)] = prev[1:]
+          index[m.start()] = len(index)
+        prev = None
+      else:
+        prev = m.group(kind) if kind == 'op' else None
+    markers = {}
+    slotted = set()
+    literal_size = 0
+    stack = [parsed.where] if parsed.where is not None else []
+    seen = set()
+    while stack:
+      node = stack.pop()
+      if id(node) in seen:
+        continue
+      seen.add(id(node))
+      value = node.value
+      if node.type == 'DSL_LITERAL' and isinstance(value, Span) and value.source is query:
+        i = index.get(value.start)
+        if i is None or i in slotted:
+          return res, None
+        slotted.add(i)
+        literal_size += value.end - value.start
+        markers[id(node)] = f'"\x00{i}\'\x00"' if query[value.start] == '"' else f'\x00{i}\x00'
+      stack.extend(node.children)
+    if len(slotted) + len(counts) != len(index):
+      return res, None
+
+    marked = parsed._replace(**{
+      clause: f'\x00{i}#\x00' for i, clause in counts.items()
+    })
+    if marked.where is not None:
+      marked = marked._replace(where=_replace_values(marked.where, markers))
+    sql = serializer.serialize_query(marked, parameterize=parameterize)
+    params = None
+    if parameterize:
+      sql, marked_params = sql
+      params = tuple(cls._param_plan(p) for p in marked_params)
+    split = _SLOT_RE.split(sql)
+    pieces = tuple(split[::3])
+    try:
+      slots = tuple((int(i), _SLOT_MODES[mode]) for i, mode in zip(split[1::3], split[2::3]))
+    except KeyError:
+      return res, None
+
+    macro_size = max_size = None
+    if 'macro_size' in event.stats and macros.max_size is not None:
+      macro_size = event.stats['macro_size'] - literal_size
+      max_size = macros.max_size
+    template = cls(fields, pieces, slots, params, counts, macro_size, max_size, serializer._dialect.escape)
+    literals = query_shape(query)[1]
+    if template.fill(literals) != res:
+      return res, None
+    return res, template
+
+  @staticmethod
+  def _param_plan(p):
+    if isinstance(p, list):
+      return (2, tuple(ShapeTemplate._param_plan(x) for x in p))
+    m = _SLOT_RE.fullmatch(p) if isinstance(p, str) else None
+    if m is not None:
+      return (0, int(m.group(1)))
+    return (1, p)
+
+  def fill(self, literals):
+    """
+    The `generate_sql` result for the query of this shape whose literals are `literals`
+    """
+    for i, clause in self.counts.items():
+      if not literals[i].isdigit():
+        raise Exception(f'Expected unsigned int value for `{clause}`, got {literals[i]}')
+    if self.max_size is not None:
+      size = self.macro_size + sum(map(len, literals)) - sum(len(literals[i]) for i in self.counts)
+      if size > self.max_size:
+        raise RuntimeError(f'Macro expansion exceeds max_size ({size} > {self.max_size})')
+    pieces = self.pieces
+    out = [pieces[0]]
+    for n, (i, mode) in enumerate(self.slots, 1):
+      text = literals[i]
+      if mode == 1:
+        text = string_value(decode_string(text))
+      elif mode == 2:
+        text = self.escape(string_value(decode_string(text)))
+      elif mode == 3:
+        text = str(int(text))
+      out.append(text)
+      out.append(pieces[n])
+    sql = f'"{"".join(out)}"'
+    if self.params is None:
+      return sql
+    params = tuple(
+      literal_value(decode_string(literals[x])) if kind == 0 else x if kind == 1 else
+      [literal_value(decode_string(literals[y])) if k == 0 else y for k, y in x]
+      for kind, x in self.params
+    )
+    return sql, params
+
+
+def _compile_batch(parser, requests):
+  # Module level so that process pools can pickle it
+  return [parser._compile_one(r) for r in requests]
+
+
+class ParseContext:
+  """
+  Holds the state of a single parse (token stream, current token, source string) along with the
+  recursive descent functions that consume it
+
+  One is created per parse so a single DSLParser can be shared between threads. Built-in and custom
+  operator parse functions alike are called with the context, e.g. `parse_func(ctx)`
+  """
+
+  def __init__(self, parser, tokens, source = None, macros = None):
+    """
+    :param `parser`: The DSLParser whose operator registry is used
+    :param `tokens`: Any iterable of tokens, e.g. a list from `tokenize` or a generator from `iter_spans`
+    :param `source`: The query string when `tokens` are (TOKEN_TYPE, START, END) spans into it
+    :param `macros`: The `macros.MacroLibrary` that `[:macro "<macro_id>"]` clauses are resolved against
+    """
+    self.parser = parser
     self.tokens = iter(tokens)
+    self.source = source
+    self.macros = macros
+    # Ids (as str) of every field referenced, including by spliced macros
+    self.field_ids = set()
+    # Ids of the macros spliced in, once per [:macro "<macro_id>"] clause, and the characters those clauses
+    # take up. Together with `nodes` that's what `macros.MacroLibrary.expansion` builds on
+    self.macro_refs = []
+    self.macro_chars = 0
+    # Number of tokens read that make AST nodes, not counting [:macro "<macro_id>"] clauses
+    self.nodes = 0
+    # The (START, END) of the :where value and the `nodes` in it
+    self.where_span = None
+    self.where_nodes = 0
     self.current = next(self.tokens, None)
 
+  def token_text(self, token):
+    if self.source is None:
+      return token[1]
+    return self.source[token[1]:token[2]]
+
+  def literal_value(self, token):
+    # Strings with escapes get decoded right away, anything else is kept as is (or as a lazy Span)
+    if self.source is None:
+      text = token[1]
+      return decode_string(text) if text.startswith('"') else text
+    start, end = token[1], token[2]
+    if self.source.startswith('"', start) and self.source.find('\\', start, end) != -1:
+      return decode_string(self.source[start:end])
+    return Span(self.source, start, end)
+
   def advance(self):
+    c = self.current
+    if c is not None and c[0] in _NODE_TOKENS:
+      self.nodes += 1
     self.current = next(self.tokens, None)
 
   def accept(self, token):
-    if self.current[0] == token:
+    if self.current is not None and self.current[0] == token:
       self.advance()
       return True
     return False
   
   def expect(self, token):
-    if self.current[0] == token:
+    if self.current is not None and self.current[0] == token:
       self.advance()
       return True
     else:
       raise SyntaxError(f'Expected {token}')
 
+  def field_node(self, token):
+    field_id = self.token_text(token).lstrip('0') or '0'
+    self.field_ids.add(field_id)
+    return Node('DSL_FIELD', field_id)
+
   def parse_field(self):
     c = self.current
     if self.accept('DSL_FIELD'):
-      return Node('DSL_FIELD', c[1], None, None)
+      return self.field_node(c)
+    return None
+
+  def parse_scalar(self):
+    # SCALAR, a string or number literal
+    c = self.current
+    if self.accept('DSL_LITERAL'):
+      return Node('DSL_LITERAL', self.literal_value(c))
     return None
 
   def parse_literal(self):
@@ -287,11 +1871,11 @@ class DSLParser:
     c = self.current
     n = None
     if self.accept('DSL_LITERAL'):
-      n = Node('DSL_LITERAL', c[1], None, None)
+      n = Node('DSL_LITERAL', self.literal_value(c))
     elif self.accept('DSL_FIELD'):
-      n = Node('DSL_FIELD', c[1], None, None)
+      n = self.field_node(c)
     elif self.accept('DSL_NIL'):
-      n = Node('DSL_NIL', None, None, None)
+      n = Node('DSL_NIL', None)
     return n
 
   def parse_op_equals(self):
@@ -304,10 +1888,12 @@ class DSLParser:
       args.append(r)
       r = self.parse_literal()
     
+    if l is None or not args:
+      raise SyntaxError('Expected 2 or more literal args to ":="')
     res = None
     if len(args) > 1:
       # We have an "IN" operator
-      r = Node('DSL_LIST', [x.value for x in args], None, None)
+      r = Node('DSL_LIST', None, *args)
       res = Node('DSL_OP', ':in', l, r)
     else:
       # We have an "EQUALS" operator
@@ -324,10 +1910,12 @@ class DSLParser:
       args.append(r)
       r = self.parse_literal()
     
+    if l is None or not args:
+      raise SyntaxError('Expected 2 or more literal args to ":!="')
     res = None
     if len(args) > 1:
       # We have a "NOT IN" operator
-      r = Node('DSL_LIST', [x.value for x in args], None, None)
+      r = Node('DSL_LIST', None, *args)
       res = Node('DSL_OP', ':not-in', l, r)
     else:
       # We have an "NOT EQUALS" operator
@@ -352,13 +1940,31 @@ class DSLParser:
       raise SyntaxError('Expected 2 literal args to ":>"')
     return Node('DSL_OP', ':>', l, r)
 
+  def parse_op_lte(self):
+    # Parse less than or equal operator :<=
+    # Expects exactly two literals
+    l = self.parse_literal()
+    r = self.parse_literal()
+    if not l or not r:
+      raise SyntaxError('Expected 2 literal args to ":<="')
+    return Node('DSL_OP', ':<=', l, r)
+
+  def parse_op_gte(self):
+    # Parse greater than or equal operator :>=
+    # Expects exactly two literals
+    l = self.parse_literal()
+    r = self.parse_literal()
+    if not l or not r:
+      raise SyntaxError('Expected 2 literal args to ":>="')
+    return Node('DSL_OP', ':>=', l, r)
+
   def parse_is_empty(self):
     # Parse is empty operator :is-empty
     # Expects exactly one literal
     l = self.parse_literal()
     if not l:
       raise SyntaxError('Expected 1 literal arg to :is-empty')
-    return Node('DSL_OP', ':is-empty', l, None)
+    return Node('DSL_OP', ':is-empty', l)
 
   def parse_not_empty(self):
     # Parse not empty operator :not-empty
@@ -366,140 +1972,323 @@ class DSLParser:
     l = self.parse_literal()
     if not l:
       raise SyntaxError('Expected 1 literal arg to :not-empty')
-    return Node('DSL_OP', ':not-empty', l, None)
+    return Node('DSL_OP', ':not-empty', l)
+
+  def _build_logical(self, op, args):
+    lo, hi = LOGICAL_ARITY[op]
+    if len(args) < lo or (hi is not None and len(args) > hi):
+      expected = lo if lo == hi else f'{lo}+' if hi is None else f'{lo}-{hi}'
+      raise SyntaxError(f'Expected {expected} WHERE clause(s) following {op}, got {len(args)}')
+    return Node('DSL_OP', op, *args)
+
+  def _parse_logical(self, op):
+    args = []
+    n = self.parse_where()
+    while n is not None:
+      args.append(n)
+      n = self.parse_where()
+    return self._build_logical(op, args)
 
   def parse_and(self):
     # Parse AND operator :and
-    # EITHER:
-    # :and <where>
-    # :and <where> <where>
-    l = self.parse_where()
-    if not l:
-      raise SyntaxError('Expected 1-2 WHERE clauses following :and, got 0')
-    r = self.parse_where()
-    return Node('DSL_OP', ':and', l, r)
+    # :and <where>+
+    return self._parse_logical(':and')
 
   def parse_or(self):
     # Parse OR operator :or
-    # :or <where> <where>
-    l = self.parse_where()
-    r = self.parse_where()
-    if not l or not r:
-      raise SyntaxError('Expected 2 WHERE clauses following :or')
-    return Node('DSL_OP', ':or', l, r)
+    # :or <where>+
+    return self._parse_logical(':or')
 
   def parse_not(self):
     # Parse NOT operator :not
     # :not <where>
-    l = self.parse_where()
-    if not l:
-      raise SyntaxError('Expected 1 WHERE clause following :not')
-    return Node('DSL_OP', ':not', l, None)
+    return self._parse_logical(':not')
+
+  def parse_macro(self):
+    # Parse macro reference :macro
+    # Expects exactly one quoted macro id, the macro's pre-parsed AST is spliced in as is
+    c = self.current
+    if not self.accept('DSL_LITERAL'):
+      raise SyntaxError('Expected a macro id following :macro')
+    macro_id = literal_value(str(self.literal_value(c)))
+    if self.macros is None:
+      raise SyntaxError(f'Unknown macro "{macro_id}"')
+    ast = self.macros.resolve(macro_id, self.parser)
+    self.macro_refs.append(macro_id)
+    self.field_ids.update(self.macros.field_ids(macro_id))
+    return ast
 
   def parse_op(self):
     # Parse operator
     c = self.current
     self.expect('DSL_OP')
-    if c[1] in self.added_operators:
-      return self.operators[c[1]](self)
-    return self.operators[c[1]]()
+    op = self.token_text(c)
+    parse_func = self.parser.operators.get(op)
+    if parse_func is None:
+      raise SyntaxError(f'Unsupported operator "{op}"')
+    return parse_func(self)
 
   def parse_where(self):
-    n = None
-    if self.accept('DSL_OPEN_BRACKET'):
-      n = self.parse_op()
+    """
+    WHERE := [OP ARG+]
+
+    :and / :or / :not nest arbitrarily deep so they are handled here with an explicit stack of open
+    (op, args) frames instead of recursing through their parse functions. Every other operator only
+    takes scalars and is dispatched through `parse_op`
+    """
+    if not self.accept('DSL_OPEN_BRACKET'):
+      return None
+
+    stack = []
+    while True:
+      c = self.current
+      op = self.token_text(c) if c is not None and c[0] == 'DSL_OP' else None
+      if op in LOGICAL_ARITY:
+        self.advance()
+        if self.accept('DSL_OPEN_BRACKET'):
+          # Descend into the first nested where-clause
+          stack.append((op, []))
+          continue
+        n = self._build_logical(op, [])
+      elif op == ':macro':
+        self.advance()
+        n = self.parse_macro()
+        # The clause stands for the macro's expansion, which the library accounts for, so its :macro and
+        # id tokens don't count. Positions only come with span tokens, `[` right before `:macro` included
+        self.nodes -= 2
+        if len(c) > 2 and self.current is not None:
+          self.macro_chars += self.current[-1] - c[-2] + 1
+      else:
+        n = self.parse_op()
       self.expect('DSL_CLOSE_BRACKET')
+
+      # Hand the finished clause to its parent, closing every parent that has no further args
+      while stack:
+        stack[-1][1].append(n)
+        if self.accept('DSL_OPEN_BRACKET'):
+          break
+        n = self._build_logical(*stack.pop())
+        self.expect('DSL_CLOSE_BRACKET')
+      else:
+        return n
+
+
+  def parse_clauses(self):
+    """
+    QUERY := { (KEY VALUE)* }
+
+    The top-level map, parsed off the same token stream as its where-clause so the query is read in a
+    single pass. Every key appears at most once, see `QUERY_CLAUSES` for the supported ones
+
+    :returns: A `Query`
+    """
+    if not self.accept('DSL_OPEN_BRACE'):
+      raise SyntaxError('Did not find opening and/or closing bracket "{" | "}"')
+    res = {}
+    while not self.accept('DSL_CLOSE_BRACE'):
+      c = self.current
+      if c is None:
+        raise SyntaxError('Did not find opening and/or closing bracket "{" | "}"')
+      key = self.token_text(c)
+      if c[0] != 'DSL_OP' or key not in QUERY_CLAUSES:
+        raise SyntaxError(f'Unsupported clause "{key}"')
+      name, parse_func = QUERY_CLAUSES[key]
+      if name in res:
+        raise Exception(f'Expected at most 1 `{key[1:]}` clause')
+      self.advance()
+      res[name] = parse_func(self)
+    if self.current is not None:
+      raise SyntaxError('Unexpected input following closing bracket "}"')
+    return Query(**res)
+
+  def parse_where_clause(self):
+    # :where WHERE
+    c = self.current
+    nodes = self.nodes
+    ast = self.parse_where()
+    if ast is None:
+      raise SyntaxError('Expected a where-clause following :where')
+    self.where_nodes = self.nodes - nodes
+    # Span tokens end in (START, END), the clause runs up to whatever follows it minus separators
+    if c is not None and len(c) > 2 and self.current is not None:
+      self.where_span = (c[-2], self.current[-2])
+    return ast
+
+  def _parse_count(self, clause):
+    c = self.current
+    text = self.token_text(c) if c is not None else None
+    if c is None or c[0] != 'DSL_LITERAL' or not text.isdigit():
+      raise Exception(f'Expected unsigned int value for `{clause}`, got {text}')
+    self.advance()
+    return int(text)
+
+  def parse_limit(self):
+    # :limit UNSIGNED-INT
+    return self._parse_count('limit')
+
+  def parse_offset(self):
+    # :offset UNSIGNED-INT
+    return self._parse_count('offset')
+
+  def _expect_field(self, clause):
+    n = self.parse_field()
+    if n is None:
+      raise SyntaxError(f'Expected a field in {clause}')
     return n
-  
-  def tokenize(self, raw):
+
+  def parse_order_by(self):
+    # :order-by [[:asc FIELD] [:desc FIELD] ...]
+    self.expect('DSL_OPEN_BRACKET')
+    res = []
+    while self.accept('DSL_OPEN_BRACKET'):
+      c = self.current
+      direction = ORDER_DIRECTIONS.get(self.token_text(c)) if c is not None and c[0] == 'DSL_OP' else None
+      if direction is None:
+        raise SyntaxError('Expected :asc or :desc in :order-by')
+      self.advance()
+      res.append((self._expect_field(':order-by'), direction))
+      self.expect('DSL_CLOSE_BRACKET')
+    self.expect('DSL_CLOSE_BRACKET')
+    if not res:
+      raise SyntaxError('Expected at least 1 field in :order-by')
+    return tuple(res)
+
+  def parse_fields(self):
+    # :fields [FIELD+]
+    self.expect('DSL_OPEN_BRACKET')
+    res = [self._expect_field(':fields')]
+    n = self.parse_field()
+    while n is not None:
+      res.append(n)
+      n = self.parse_field()
+    self.expect('DSL_CLOSE_BRACKET')
+    return tuple(res)
+
+
+# Top-level query keys, {key: (`Query` attribute, ParseContext function parsing the value)}
+QUERY_CLAUSES = {
+  ':where': ('where', ParseContext.parse_where_clause),
+  ':limit': ('limit', ParseContext.parse_limit),
+  ':offset': ('offset', ParseContext.parse_offset),
+  ':order-by': ('order_by', ParseContext.parse_order_by),
+  ':fields': ('fields', ParseContext.parse_fields),
+}
+
+
+class DSLParser:
+  def __init__(self, cache_size = None, cache_bytes = None, ast_cache_size = None, registry = None,
+               shape_cache_size = None):
+    """
+    :param cache_size: Opt in to caching compiled queries in `generate_sql`, max number of entries
+    :param cache_bytes: Opt in to caching compiled queries in `generate_sql`, max total length of cached SQL
+    :param ast_cache_size: Opt in to caching dialect independent, hash-consed ASTs in `parse_query`
+    :param shape_cache_size: Opt in to compiling queries in `generate_sql` through a `ShapeTemplate` per
+      query shape, max number of shapes
+    :param registry: The `Registry` of operators and dialects to compile with, the built-in one by default.
+      It is shared, not copied, `add_operator` / `add_dialect` switch this parser to an extended copy
+    """
+    self.serializer = ASTSerializer(registry=registry)
+    self.cache = None
+    if cache_size is not None or cache_bytes is not None:
+      self.cache = LRUCache(max_entries=cache_size, max_bytes=cache_bytes)
+    self.ast_cache = None
+    self.interner = None
+    if ast_cache_size is not None:
+      self.ast_cache = LRUCache(max_entries=ast_cache_size)
+      self.interner = NodeInterner(live=self._cached_asts)
+    self.shape_cache = None
+    if shape_cache_size is not None:
+      self.shape_cache = LRUCache(max_entries=shape_cache_size)
+    # Instrumentation, see `add_listener`. Replaced rather than mutated so compiling threads can iterate it
+    self.listeners = []
+    # Shared with the serializer's registry, see `registry`
+    self.operators = self.serializer.registry.parse_operators
+
+  @property
+  def registry(self):
     """
-    This is our tokenizer / lexer for the input where-clause query that returns a list of tokens to
-    be consumed by our DSLParser in the construction of an AST
+    The `Registry` of operators and dialects this parser compiles with
+    """
+    return self.serializer.registry
+
+  def _cached_asts(self):
+    # Roots the interner keeps canonical nodes for, see `NodeInterner.live`
+    return [parsed.where for parsed, _ in self.ast_cache.values()]
+
+  def __getstate__(self):
+    # Caches hold locks, a copy of the parser sent to another process starts without them
+    state = self.__dict__.copy()
+    state['cache'] = None
+    state['ast_cache'] = None
+    state['interner'] = None
+    state['shape_cache'] = None
+    state['listeners'] = []
+    del state['operators']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.operators = self.registry.parse_operators
+
+  def parse_where(self, tokens, source = None, macros = None):
+    """
+    Build the AST for a where-clause from its tokens, see `ParseContext`
+    """
+    return ParseContext(self, tokens, source, macros).parse_where()
 
-    :param `raw`: A where-clause string
-    :returns: A list of tuples of the form (Str(TOKEN_TYPE), TOKEN_VALUE))
+  def scan(self, raw):
     """
-    tokens = []
-
-    def has_flattenable_field(tokens):
-      """
-      @NOTE:
-      By default FIELD tokens end up in the token stream sandwiched between open & close BRACKET tokens
-      This helper removes the book end bracket tokens to make the parser's life easier
-      The existence of this helper is probably indicating that the overall grammer / tokenizer is suboptimal
-      """
-      return len(tokens) >= 3 and all([
-        tokens[-3][0] == 'DSL_OPEN_BRACKET',
-        tokens[-2][0] == 'DSL_FIELD',
-        tokens[-1][0] == 'DSL_CLOSE_BRACKET'
-      ])
-
-    i = 0
-    while i < len(raw):
-      if raw[i] == "[":
-        tokens.append(('DSL_OPEN_BRACKET', '['))
-        i += 1
-        continue
-      elif raw[i] == "]":
-        tokens.append(('DSL_CLOSE_BRACKET', ']'))
-        if has_flattenable_field(tokens):
-          # Flatten DSL_FIELDs that are wrapped by open/close brackets
-          field_token = tokens[-2]
-          tokens = tokens[:-3] + [field_token]
-        i += 1
+    Single pass scanner over a query or where-clause string, driven by the compiled `_TOKEN_RE` master regex
+
+    Bracketed field references e.g. `[:field 3]` are matched as one unit so they come out of the scanner
+    already folded into a single DSL_FIELD token
+
+    :param `raw`: A query or where-clause string
+    :returns: A generator of tuples of the form (Str(TOKEN_TYPE), TOKEN_VALUE, START, END)
+    """
+    for m in _TOKEN_RE.finditer(raw):
+      kind = m.lastgroup
+      if kind == 'ws':
         continue
-      elif raw[i] == ":":
-        idx = raw[i:].find(' ')
-        tmp = raw[i:][:idx]
-        if tmp == ":field":
-          # process field
-          k = idx + 1 # first digit of field identifier
-          while k < len(raw) and raw[i:][k].isdigit():
-            k += 1
-          tokens.append(('DSL_FIELD', raw[i:][idx+1:k]))
-          i += k
-          continue
-        else:
-          # @TODO: Check if supported operator, else error
-          tokens.append(('DSL_OP', tmp))
-          i += idx + 1
-      elif raw[i] == " ":
-        i += 1
+      if kind == 'mismatch':
+        raise SyntaxError(f'Unexpected character {m.group()!r} at position {m.start()}')
+      value = m.group(kind)
+      if kind == 'literal' and value == 'nil':
+        yield ('DSL_NIL', value, m.start(), m.end())
+      else:
+        yield (_TOKEN_TYPES[kind], value, m.start(), m.end())
+
+  def iter_spans(self, raw):
+    """
+    Streaming flavour of `scan` that yields compact (Str(TOKEN_TYPE), START, END) spans into `raw`
+    instead of copying each token value out. For DSL_FIELD tokens the span covers just the field id
+
+    Consumed lazily by the parser through `parse_where(..., source=raw)`
+    """
+    for m in _TOKEN_RE.finditer(raw):
+      kind = m.lastgroup
+      if kind == 'ws':
         continue
+      if kind == 'mismatch':
+        raise SyntaxError(f'Unexpected character {m.group()!r} at position {m.start()}')
+      start, end = m.span(kind)
+      if kind == 'literal' and end - start == 3 and raw.startswith('nil', start):
+        yield ('DSL_NIL', start, end)
       else:
-        # Consuming a literal
-        k = i + 1
-        while k < len(raw) and raw[k] not in [x for x in " []{}"]:
-          k += 1
-        tmp = raw[i:k]
-        if tmp == "nil":
-          tokens.append(('DSL_NIL', tmp))
-        else:
-          tokens.append(('DSL_LITERAL', raw[i:k]))
-        i = k
-    return tokens
+        yield (_TOKEN_TYPES[kind], start, end)
 
-  def _parse_clauses(self, raw_query):
-    res = {'where': None, 'limit': None}
-    if not (raw_query.startswith('{') and raw_query.endswith('}')):
-      raise SyntaxError('Did not find opening and/or closing bracket "{" | "}"')
-    
-    def split_clause(raw):
-      # @TODO: Handle if raw has no space (malformed input)
-      idx = raw.find(' ')
-      return (raw[:idx], raw[idx + 1:])
-    for key, val in [split_clause(x.strip()) for x in raw_query.strip('{}').split(',')]:
-      if key == ":where":
-        if res['where'] is not None:
-          raise Exception('Expected at most 1 `where` clause')
-        res['where'] = val
-      elif key == ':limit':
-        if res['limit'] is not None:
-          raise Exception('Expected at most 1 `limit` clause')
-        if not val.isdigit():
-          raise Exception(f'Expected unsigned int value for `limit`, got {val}')
-        res['limit'] = int(val)
-    return((res['where'], res['limit']))
+  def tokenize(self, raw, positions = False):
+    """
+    This is our tokenizer / lexer for the input query that returns a list of tokens to be consumed by
+    our DSLParser in the construction of an AST
+
+    :param `raw`: A query or where-clause string
+    :param `positions`: If set, tokens also carry their (START, END) offsets into `raw`
+    :returns: A list of tuples of the form (Str(TOKEN_TYPE), TOKEN_VALUE))
+    """
+    if positions:
+      return list(self.scan(raw))
+    return [(t[0], t[1]) for t in self.scan(raw)]
 
   def add_operator(self, op_id, parse_func, serialize_func):
     """
@@ -508,48 +2297,384 @@ class DSLParser:
     :param parse_func: A function to extend the DSLParser for creating new DSL_OP nodes in the AST
     :param serialize_func: A function to extend the ASTSerializer for string formatting the new DSL_OP AST nodes
     """
-    if op_id in self.operators:
-      raise Exception(f'DSLOperator operator exists with id: "{op_id}"')
-    self.operators[op_id] = parse_func
-    self.added_operators.append(op_id)
-    self.serializer.add_operator(op_id, serialize_func)
+    self.serializer.set_registry(self.registry.with_operator(op_id, parse_func, serialize_func))
+    self.operators = self.registry.parse_operators
+    self.invalidate_cache()
+
+  def add_operators(self, *specs):
+    """
+    Extend DSLParser with the where-clause operators declared by the `OperatorSpec`s `specs`
+    """
+    self.serializer.set_registry(self.registry.with_operators(*specs))
+    self.operators = self.registry.parse_operators
+    self.invalidate_cache()
 
   def add_dialect(self, name, params):
     self.serializer.add_dialect(name, params)
+    # Parsing doesn't depend on the dialect, cached ASTs stay valid
+    self.invalidate_cache(asts=False)
+
+  def add_listener(self, listener):
+    """
+    Attach an instrumentation listener, a `CompileListener` e.g. `metrics.MetricsAggregator`, that gets
+    called around every stage of every `generate_sql` / `parse_query` call from now on
+
+    Nothing gets timed or counted while no listener is attached
+    """
+    self.listeners = self.listeners + [listener]
+
+  def remove_listener(self, listener):
+    self.listeners = [x for x in self.listeners if x is not listener]
+
+  def _traced(self, kind, query, dialect, func, *args):
+    event = CompileEvent(self.listeners, kind, query, dialect)
+    try:
+      res = func(*args, event)
+    except Exception as e:
+      event.finish(e)
+      raise
+    event.finish()
+    return res
+
+  def invalidate_cache(self, asts = True):
+    """
+    Drop all cached compilation results, called whenever the operator / dialect registry changes
+    """
+    if self.cache is not None:
+      self.cache.clear()
+    if asts and self.ast_cache is not None:
+      self.ast_cache.clear()
+    if self.shape_cache is not None:
+      self.shape_cache.clear()
+
+  def _cache_key(self, dialect, fields, query, macros, parameterize, optimize, shared):
+    d = self.serializer.dialects.get(dialect)
+    rules_fp = d.fingerprint if d is not None else None
+    return fingerprint(dialect, rules_fp, fields, query, _macros_key(macros), parameterize, optimize, shared)
 
   def resolve_macros(self, raw_where, macros):
     """
     Takes a raw <where-clause> string and iteratively flattens the macro references
+
+    Textual fallback, `parse_query` splices pre-parsed macro ASTs from a `macros.MacroLibrary` instead
     """
     if has_cycle(macros):
       raise RuntimeError("Cycle detected in macros.")
     return reduce_macros(raw_where, macros)
 
-  def generate_sql(self, dialect, fields, query, macros={}):
+  def parse(self, query, macros={}, stream=False, fields=None):
+    """
+    Parse a raw query into a `Query` of its where-clause AST and other top-level clauses, none of which
+    depend on the dialect or fields
+
+    When `fields` is given, references to field ids missing from it are rejected with a SyntaxError
+
+    `macros` is either a `macros.MacroLibrary` or a plain dict of {macro_id: where-clause}, which is
+    compiled into a throwaway library for this one call. Keep a library around to parse each macro once
+
+    If the parser was constructed with `ast_cache_size` the result is cached keyed on a fingerprint of
+    the query and macros, and its nodes are hash-consed with every other cached AST
+    """
+    if self.listeners:
+      return self._traced('parse_query', query, None, self._parse_query, query, macros, stream, fields)
+    return self._parse_query(query, macros, stream, fields, None)
+
+  def parse_query(self, query, macros={}, stream=False, fields=None):
+    """
+    Parse a raw query into its (AST, limit) parts, see `parse` for the other clauses
+    """
+    res = self.parse(query, macros, stream, fields)
+    return res.where, res.limit
+
+  def _parse_query(self, query, macros, stream, fields, event, shared = False):
+    key = None
+    res = None
+    if self.ast_cache is not None:
+      # Macro expansions are checked differently for shared output, see `_parse_query_uncached`
+      key = fingerprint(query, _macros_key(macros), 'shared') if shared else fingerprint(query, _macros_key(macros))
+      res = self.ast_cache.get(key)
+      if event is not None:
+        event.stats['ast_cache'] = 'miss' if res is None else 'hit'
+    if res is None:
+      res = self._parse_query_uncached(query, macros, stream, event, shared)
+      if key is not None:
+        parsed, field_ids = res
+        if parsed.where is not None:
+          parsed = parsed._replace(where=self.interner.intern(parsed.where))
+        res = (parsed, field_ids)
+        self.ast_cache.put(key, res, size=len(query))
+
+    parsed, field_ids = res
+    self._check_fields(field_ids, fields)
+    return parsed
+
+  @staticmethod
+  def _check_fields(field_ids, fields):
+    if fields is not None:
+      unknown = sorted(f for f in field_ids if int(f) not in fields)
+      if unknown:
+        raise SyntaxError(f'Unknown field id(s) {", ".join(unknown)}')
+
+  def _parse_query_uncached(self, query, macros, stream, event, shared = False):
+    if isinstance(macros, dict):
+      from macros import MacroLibrary
+      macros = MacroLibrary(macros, validate=False) if macros else None
+
+    if stream:
+      # Tokens are scanned lazily while parsing, so the parse stage includes tokenizing
+      tokens = self.iter_spans(query)
+      if event is not None:
+        tokens = _count_tokens(tokens, event.stats)
+        event.start('parse')
+      ctx = ParseContext(self, tokens, query, macros)
+    else:
+      if event is not None:
+        event.start('tokenize')
+      tokens = list(self.scan(query))
+      if event is not None:
+        event.end('tokenize', tokens=len(tokens))
+        event.start('parse')
+      ctx = ParseContext(self, tokens, None, macros)
+    parsed = ctx.parse_clauses()
+    if event is not None:
+      event.end('parse', nodes=count_nodes(parsed.where))
+
+    if ctx.macro_refs:
+      # Spliced macro ASTs are shared, not copied, so nothing got expanded yet. Reject where-clauses that
+      # would blow up once serialized, which for `shared` output is once per distinct macro. The figures of
+      # the where-clause itself were collected while parsing it
+      start, end = ctx.where_span
+      if event is not None:
+        event.start('macros')
+      own = len(query[start:end].rstrip(', \t\r\n')) - ctx.macro_chars
+      size, nodes, depth = macros.check_expansion(own, ctx.where_nodes, ctx.macro_refs, shared)
+      if event is not None:
+        event.end('macros', macro_size=size, macro_nodes=nodes, macro_depth=depth)
+    # A tuple rather than a frozenset, it is kept per AST cache entry
+    return parsed, tuple(ctx.field_ids)
+
+  def optimize(self, ast, **rewrites):
+    """
+    Run the predicate optimizer over an AST, e.g. one returned by `parse_query`
+
+    :param rewrites: Switch individual rewrites on / off, see `optimizer.Optimizer`
+    :returns: An `optimizer.OptimizeResult` with the rewritten `ast`, the rewrites that `fired` and
+      whether the where-clause is `always_false` (no need to hit the database at all)
+    """
+    from optimizer import Optimizer
+    return Optimizer(**rewrites).optimize(ast)
+
+  def predicate(self, fields, query, macros={}, stream=False):
+    """
+    Compile the where-clause of a query into an in process `evaluator.Predicate`, e.g. to narrow down a
+    result set already in memory rather than querying the database again
+
+    p.predicate(fields, '{:where [:> [:field 4] 30]}')({'age': ages, ...})  # -> mask of the matching rows
+    """
+    from evaluator import Evaluator
+    return Evaluator(fields).compile(self.parse(query, macros, stream, fields).where)
+
+  def generate_sql(self, dialect, fields, query, macros={}, stream=False, parameterize=False, optimize=False,
+                   shared=False):
     """
     The primary solution method
     
     Steps roughly follow:
-    ---> Preprocess the raw <where-clause> <limit> inputs
-    ---> If <where-clause> is present
-    ------> Resolve macros
-    ------> Convert <where-clause> to tokenized list
-    ------> Convert tokenized list to abstract syntax tree
-    ------> Serialize AST to SQL query string representation using post order tree traversal
-    ---> Combine the str representations of <where-clause> and <limit> appropriately (or try to)
-
-    """
-    raw_where, raw_limit = self._parse_clauses(query)
-
-    ast = None
-    if raw_where:
-      if macros:
-        raw_where = self.resolve_macros(raw_where, macros)
-      self.set_tokens(self.tokenize(raw_where))
-      ast = self.parse_where()
-      # @TODO: Clean up instance variables after parsing?
-    
-    self.serializer.set_dialect(dialect)
-    self.serializer.set_fields(fields)
-    return(f'"{self.serializer.serialize_ast(ast, limit=raw_limit)}"')
+    ---> Convert the raw query to tokenized list (or a lazy stream of token spans if `stream`)
+    ---> Convert tokenized list to its top-level clauses and the abstract syntax tree of its <where-clause>,
+         splicing in macros
+    ---> If macros were referenced, check the size of their expansion
+    ---> Serialize AST to SQL query string representation using post order tree traversal
+    ---> Combine the str representations of <where-clause>, <order-by>, <limit>, ... appropriately
+
+    If the parser was constructed with `cache_size` / `cache_bytes` the result is cached keyed on a
+    fingerprint of the dialect rules, fields, query and macros
+
+    If the parser was constructed with `shape_cache_size` queries that only differ in their literals share
+    a `ShapeTemplate` (per dialect, fields mapping and macros): the first one of a shape gets compiled as
+    usual, the others only get scanned for their literals. Not used with `optimize` nor `shared`, whose
+    output depends on the literal values. Custom operators whose parse / serialize functions look at the
+    values of their literals (rather than just passing them on) must not be used with it
+
+    With `parameterize` literals are emitted as dialect placeholders and a tuple of (sql, params) is returned
+
+    With `optimize` the AST goes through the predicate optimizer first, pass a dict to switch individual
+    rewrites on / off e.g. `optimize={'merge_in': False}`
+
+    With `shared` subtrees the where-clause repeats, typically macros referenced more than once, are
+    emitted once as a joined derived column instead of once per use, see `ASTSerializer.serialize_ast`
+
+    Listeners attached through `add_listener` get called around each of these stages
+    """
+    args = (dialect, fields, query, macros, stream, parameterize, optimize, shared)
+    if self.listeners:
+      return self._traced('generate_sql', query, dialect, self._generate_sql, *args)
+    return self._generate_sql(*args, None)
+
+  def _generate_sql(self, dialect, fields, query, macros, stream, parameterize, optimize, shared, event):
+    key = None
+    if self.cache is not None:
+      key = self._cache_key(dialect, fields, query, macros, parameterize, optimize, shared)
+      res = self.cache.get(key)
+      if event is not None:
+        event.stats['cache'] = 'miss' if res is None else 'hit'
+      if res is not None:
+        return res
+
+    if self.shape_cache is not None and not optimize and not shared and '\x00' not in query:
+      res = self._generate_shaped(dialect, fields, query, macros, parameterize, event)
+      if res is not None:
+        if key is not None:
+          self.cache.put(key, res, size=len(res[0]) if parameterize else len(res))
+        return res
+
+    parsed = self._parse_query(query, macros, stream, fields, event, shared)
+    if optimize:
+      parsed = self._optimize_query(parsed, optimize, event)
+
+    if event is not None:
+      event.start('serialize')
+    serializer = self.serializer.bind(dialect, fields)
+    if parameterize:
+      sql, params = serializer.serialize_query(parsed, parameterize=True, shared=shared)
+      res = (f'"{sql}"', params)
+      size = len(res[0])
+    else:
+      res = f'"{serializer.serialize_query(parsed, shared=shared)}"'
+      size = len(res)
+    if event is not None:
+      event.end('serialize', sql_length=size)
+    if key is not None:
+      self.cache.put(key, res, size=size)
+    return(res)
+
+  def generate_sql_multi(self, dialects, fields, query, macros={}, stream=False, parameterize=False,
+                         optimize=False):
+    """
+    `generate_sql` of one query in each of `dialects`, e.g. to pre-render a saved query for every database
+    it may run against
+
+    The query is parsed (and optimized) once and its where-clause serialized for all dialects in a single
+    traversal, fragments that are the same in every dialect are built once, see `ASTSerializer.postorder_lanes`
 
+    :returns: A dict of {dialect: `generate_sql` result}
+    """
+    dialects = list(dict.fromkeys(dialects))
+    args = (dialects, fields, query, macros, stream, parameterize, optimize)
+    if self.listeners:
+      return self._traced('generate_sql_multi', query, ','.join(dialects), self._generate_sql_multi, *args)
+    return self._generate_sql_multi(*args, None)
+
+  def _optimize_query(self, parsed, optimize, event):
+    # The rewrites that fired go into the event's stats, e.g. to tell how often optimizing pays off
+    if event is not None:
+      event.start('optimize')
+    res = self.optimize(parsed.where, **(optimize if isinstance(optimize, dict) else {}))
+    if event is not None:
+      event.end('optimize', fired=res.fired)
+    return parsed._replace(where=res.ast)
+
+  def _generate_sql_multi(self, dialects, fields, query, macros, stream, parameterize, optimize, event):
+    parsed = self._parse_query(query, macros, stream, fields, event)
+    if optimize:
+      parsed = self._optimize_query(parsed, optimize, event)
+
+    if event is not None:
+      event.start('serialize')
+    res = {}
+    for dialect, sql in zip(dialects, self.serializer.serialize_multi(parsed, dialects, fields, parameterize)):
+      res[dialect] = (f'"{sql[0]}"', sql[1]) if parameterize else f'"{sql}"'
+    if event is not None:
+      event.end('serialize', sql_length=sum(len(r[0]) if parameterize else len(r) for r in res.values()))
+    return res
+
+  def _generate_shaped(self, dialect, fields, query, macros, parameterize, event):
+    # None when queries of this shape don't make a template and have to be compiled as usual
+    if event is not None:
+      event.start('shape')
+    shape, literals = query_shape(query)
+    macros_key = macros.fingerprint if hasattr(macros, 'fingerprint') else fingerprint(macros) if macros else None
+    key = (dialect, _fields_key(fields), parameterize, macros_key, shape)
+    template = self.shape_cache.get(key)
+    if template is None:
+      outcome = 'miss'
+      res, template = ShapeTemplate.compile(self, dialect, fields, query, macros, parameterize)
+      # Shapes that don't make a template are remembered too, so they get compiled the usual way from then on
+      self.shape_cache.put(key, template or False)
+    else:
+      outcome = 'hit'
+      res = template.fill(literals) if template is not False else None
+    if event is not None:
+      event.stats['shape_cache'] = outcome
+      if res is None:
+        event.end('shape')
+      else:
+        event.end('shape', sql_length=len(res[0]) if parameterize else len(res))
+    return res
+
+  def compile(self, dialect, fields, query, macros={}, previous=None, stream=False, optimize=False):
+    """
+    Incremental flavour of `generate_sql` for queries edited a bit at a time, e.g. from a query builder
+
+    Pass the `Compilation` of the previous version of the query as `previous`: the SQL of every subtree
+    the two versions have in common, matched on structure, is reused as is. Only the subtrees containing
+    edits get serialized again, so the serialize stage grows with the depth of the edits rather than the
+    size of the query. Tokenizing, parsing and matching stay linear
+
+    :returns: A `Compilation(sql, memo, reused)`, results are never parameterized nor shared
+    """
+    args = (dialect, fields, query, macros, previous, stream, optimize)
+    if self.listeners:
+      return self._traced('compile', query, dialect, self._compile, *args)
+    return self._compile(*args, None)
+
+  def _compile(self, dialect, fields, query, macros, previous, stream, optimize, event):
+    parsed = self._parse_query(query, macros, stream, fields, event)
+    if optimize:
+      parsed = self._optimize_query(parsed, optimize, event)
+
+    if event is not None:
+      event.start('serialize')
+    serializer = self.serializer.bind(dialect, fields)
+    context = (serializer._dialect.fingerprint, serializer._quoted)
+    memo = previous.memo if previous is not None else None
+    if memo is None or not memo.matches(context):
+      memo = SubtreeMemo(context)
+    with memo.lock:
+      sql = f'"{serializer.serialize_query(parsed, memo=memo)}"'
+    if event is not None:
+      event.end('serialize', sql_length=len(sql), reused=serializer.reused)
+    return Compilation(sql, memo, serializer.reused)
+
+  def _compile_one(self, request):
+    try:
+      return BatchResult(self.generate_sql(**request), None)
+    except Exception as e:
+      return BatchResult(None, e)
+
+  def generate_sql_many(self, requests, executor=None, chunksize=None):
+    """
+    Compile many queries, optionally concurrently on a `concurrent.futures` executor
+
+    :param requests: An iterable of dicts of `generate_sql` keyword arguments, i.e. dialect, fields, query, macros, ...
+    :param executor: None to compile in the calling thread, a ThreadPoolExecutor which shares this parser as
+      is, or a ProcessPoolExecutor which gets this parser (and with it the operator / dialect registry)
+      pickled once per chunk of requests rather than once per request
+    :param chunksize: Number of requests per task, by default requests are spread over ~4 chunks per worker
+    :returns: A list of BatchResult(result, error) in the same order as `requests`
+    """
+    requests = list(requests)
+    if executor is None:
+      return [self._compile_one(r) for r in requests]
+
+    if chunksize is None:
+      workers = getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+      chunksize = max(1, -(-len(requests) // (workers * 4)))
+    futures = [
+      executor.submit(_compile_batch, self, requests[i:i + chunksize])
+      for i in range(0, len(requests), chunksize)
+    ]
+    res = []
+    for f in futures:
+      res.extend(f.result())
+    return res
@@ -0,0 +1,487 @@
+import operator
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from dsl_parser import DEFAULT_FIELDS, literal_value
+
+
+# SQL comparison of each comparison operator, and the one it turns into seen from its right hand side
+COMPARISONS = {
+  ':=': (operator.eq, ':='),
+  ':!=': (operator.ne, ':!='),
+  ':<': (operator.lt, ':>'),
+  ':>': (operator.gt, ':<'),
+  ':<=': (operator.le, ':>='),
+  ':>=': (operator.ge, ':<='),
+}
+
+# Operand kinds, see `Evaluator.compile`
+FIELD = 'field'
+LITERAL = 'literal'
+NIL = 'nil'
+
+
+class _Lists:
+  """
+  Kernels over plain sequences, truth values are lists of True / False / None (SQL's UNKNOWN)
+  """
+
+  def column(self, values):
+    return values if isinstance(values, list) else list(values)
+
+  def const(self, value, n):
+    return [value] * n
+
+  def compare(self, func, left, right, n):
+    (lk, lv), (rk, rv) = left, right
+    if lk == NIL or rk == NIL:
+      return [None] * n
+    if lk == FIELD and rk == FIELD:
+      return [None if a is None or b is None else func(a, b) for a, b in zip(lv, rv)]
+    if lk == FIELD:
+      return [None if a is None else func(a, rv) for a in lv]
+    if rk == FIELD:
+      return [None if b is None else func(lv, b) for b in rv]
+    return [func(lv, rv)] * n
+
+  def is_null(self, arg, negate, n):
+    kind, value = arg
+    if kind == FIELD:
+      if negate:
+        return [v is not None for v in value]
+      return [v is None for v in value]
+    return [(kind == NIL) != negate] * n
+
+  def in_values(self, column, values, has_null, negate):
+    # `column` [NOT] IN `values` (a set of literals), NULL when either the value or any list value is NULL
+    missing = None if has_null else negate
+    found = not negate
+    return [None if v is None else found if v in values else missing for v in column]
+
+  def and_(self, parts):
+    res = parts[0]
+    for p in parts[1:]:
+      res = [False if a is False or b is False else None if a is None or b is None else True for a, b in zip(res, p)]
+    return res
+
+  def or_(self, parts):
+    res = parts[0]
+    for p in parts[1:]:
+      res = [True if a is True or b is True else None if a is None or b is None else False for a, b in zip(res, p)]
+    return res
+
+  def not_(self, part):
+    return [None if a is None else not a for a in part]
+
+  def mask(self, part):
+    return [a is True for a in part]
+
+  def truth(self, part):
+    return part
+
+
+class _Arrays:
+  """
+  Kernels over NumPy arrays. Columns are (values, null mask | None) pairs, nulls being NaNs, NaTs, the masked
+  entries of masked arrays or Nones in object arrays. Truth values are (true, unknown) pairs of boolean arrays
+  """
+
+  def column(self, values):
+    if np.ma.isMaskedArray(values):
+      return np.ma.getdata(values), np.ma.getmaskarray(values)
+    values = np.asarray(values)
+    kind = values.dtype.kind
+    if kind == 'f':
+      return values, np.isnan(values)
+    if kind in 'mM':
+      return values, np.isnat(values)
+    if kind == 'O':
+      return values, np.equal(values, None)
+    return values, None
+
+  def const(self, value, n):
+    return np.full(n, value is True), np.full(n, value is None)
+
+  @staticmethod
+  def _apply(func, column, value):
+    # Skip the nulls, Python objects don't compare with None
+    values, nulls = column
+    if nulls is None or values.dtype.kind != 'O':
+      return np.asarray(func(values, value), dtype=bool)
+    res = np.zeros(len(values), dtype=bool)
+    keep = ~nulls
+    res[keep] = func(values[keep], value)
+    return res
+
+  def compare(self, func, left, right, n):
+    (lk, lv), (rk, rv) = left, right
+    if lk == NIL or rk == NIL:
+      return self.const(None, n)
+    if lk == FIELD and rk == FIELD:
+      (a, an), (b, bn) = lv, rv
+      nulls = an if bn is None else bn if an is None else an | bn
+      if nulls is not None and (a.dtype.kind == 'O' or b.dtype.kind == 'O'):
+        res = np.zeros(n, dtype=bool)
+        keep = ~nulls
+        res[keep] = func(a[keep], b[keep])
+      else:
+        res = np.asarray(func(a, b), dtype=bool)
+    elif lk == FIELD:
+      nulls = lv[1]
+      res = self._apply(func, lv, rv)
+    elif rk == FIELD:
+      nulls = rv[1]
+      res = self._apply(lambda b, a: func(a, b), rv, lv)
+    else:
+      return self.const(func(lv, rv), n)
+    if nulls is None:
+      return res, np.zeros(n, dtype=bool)
+    return res & ~nulls, nulls
+
+  def is_null(self, arg, negate, n):
+    kind, value = arg
+    if kind != FIELD:
+      return self.const((kind == NIL) != negate, n)
+    nulls = value[1]
+    if nulls is None:
+      nulls = np.zeros(n, dtype=bool)
+    return (~nulls if negate else nulls.copy()), np.zeros(n, dtype=bool)
+
+  @staticmethod
+  def _isin(data, values):
+    options = np.array(list(values))
+    if data.dtype.kind == 'O':
+      return np.fromiter((v in values for v in data), dtype=bool, count=len(data))
+    if (data.dtype.kind in 'US') != (options.dtype.kind in 'US'):
+      # Strings never equal numbers
+      return np.zeros(len(data), dtype=bool)
+    return np.isin(data, options)
+
+  def in_values(self, column, values, has_null, negate):
+    data, nulls = column
+    if nulls is None:
+      found = self._isin(data, values)
+      valid = np.ones(len(data), dtype=bool)
+    else:
+      valid = ~nulls
+      found = np.zeros(len(data), dtype=bool)
+      found[valid] = self._isin(data[valid], values)
+    missing = valid & ~found
+    if has_null:
+      true = valid & found if not negate else np.zeros(len(data), dtype=bool)
+      unknown = ~valid | missing
+    else:
+      true = (valid & found) if not negate else missing
+      unknown = ~valid
+    return true, unknown
+
+  def and_(self, parts):
+    true, unknown = parts[0]
+    false = ~(true | unknown)
+    for t, u in parts[1:]:
+      true = true & t
+      false = false | ~(t | u)
+    return true, ~(true | false)
+
+  def or_(self, parts):
+    true, unknown = parts[0]
+    false = ~(true | unknown)
+    for t, u in parts[1:]:
+      true = true | t
+      false = false & ~(t | u)
+    return true, ~(true | false)
+
+  def not_(self, part):
+    true, unknown = part
+    return ~(true | unknown), unknown
+
+  def mask(self, part):
+    return part[0]
+
+  def truth(self, part):
+    true, unknown = part
+    res = np.full(len(true), False, dtype=object)
+    res[true] = True
+    res[unknown] = None
+    return res
+
+
+_LISTS = _Lists()
+_ARRAYS = _Arrays() if np is not None else None
+
+
+class Predicate:
+  """
+  A where-clause compiled by `Evaluator.compile`, call it with columnar data to get the mask of the rows it
+  matches, e.g. `pred({'id': [1, 2, None], 'age': [30, None, 5]})`
+  """
+
+  def __init__(self, program, columns):
+    """
+    :param program: The (kernel name, args) instructions of every predicate node in post order, args refer to
+      the results of earlier instructions by index
+    :param columns: Names of the columns the where-clause reads
+    """
+    self.program = program
+    self.columns = columns
+
+  def _run(self, columns, rows):
+    arrays = np is not None and any(isinstance(c, np.ndarray) for c in columns.values())
+    kernels = _ARRAYS if arrays else _LISTS
+    loaded = {}
+    for name in self.columns:
+      if name not in columns:
+        raise RuntimeError(f'Missing column "{name}"')
+      loaded[name] = kernels.column(columns[name])
+    if rows is None:
+      rows = len(next(iter(columns.values()))) if columns else 0
+    for name in self.columns:
+      if len(columns[name]) != rows:
+        raise RuntimeError(f'Column "{name}" has {len(columns[name])} rows, expected {rows}')
+
+    def operand(arg):
+      kind, value = arg
+      return (kind, loaded[value]) if kind == FIELD else arg
+
+    results = []
+    for name, args in self.program:
+      if name == 'compare':
+        func, left, right = args
+        res = kernels.compare(func, operand(left), operand(right), rows)
+      elif name == 'is_null':
+        arg, negate = args
+        res = kernels.is_null(operand(arg), negate, rows)
+      elif name == 'in_values':
+        field, values, has_null, negate = args
+        res = kernels.in_values(loaded[field], values, has_null, negate)
+      elif name == 'in_fold':
+        left, values, negate = args
+        func = operator.ne if negate else operator.eq
+        parts = [kernels.compare(func, operand(left), operand(v), rows) for v in values]
+        res = kernels.and_(parts) if negate else kernels.or_(parts)
+      elif name == 'const':
+        res = kernels.const(args, rows)
+      elif name == 'not_':
+        res = kernels.not_(results[args])
+      else:
+        res = getattr(kernels, name)([results[i] for i in args])
+      results.append(res)
+    if not results:
+      return kernels, kernels.const(True, rows)
+    return kernels, results[-1]
+
+  def __call__(self, columns, rows = None):
+    """
+    :param columns: {column name: NumPy array or sequence}, NumPy kernels are used as soon as one of the
+      columns is an array
+    :param rows: Number of rows, only needed when the where-clause doesn't read any column
+    :returns: A boolean NumPy array or a list of bools, True for the rows the where-clause is TRUE for
+    """
+    kernels, res = self._run(columns, rows)
+    return kernels.mask(res)
+
+  def truth(self, columns, rows = None):
+    """
+    The SQL truth value of the where-clause for every row, True / False / None (UNKNOWN)
+    """
+    kernels, res = self._run(columns, rows)
+    return kernels.truth(res)
+
+
+class Evaluator:
+  """
+  Backend next to `ASTSerializer` that compiles where-clause ASTs into predicates evaluated in process,
+  a column at a time, over columnar data: a dict of NumPy arrays or of lists keyed by column name, as given
+  by the `fields` mapping
+
+  NULLs (None, NaN, ...) follow SQL three valued logic: comparisons with NULL are UNKNOWN, so is NOT of
+  UNKNOWN, :and / :or only are when no operand decides the outcome, and a row matches when the where-clause
+  is TRUE. `nil`, :is-empty and :not-empty mean IS NULL / IS NOT NULL, as in the SQL the serializer emits
+  """
+
+  # {op_id: name of the method compiling a node of that operator}
+  OPERATORS = {
+    ':and': '_compile_logical',
+    ':or': '_compile_logical',
+    ':not': '_compile_logical',
+    ':=': '_compile_comparison',
+    ':!=': '_compile_comparison',
+    ':<': '_compile_comparison',
+    ':>': '_compile_comparison',
+    ':<=': '_compile_comparison',
+    ':>=': '_compile_comparison',
+    ':in': '_compile_in',
+    ':not-in': '_compile_in',
+    ':is-empty': '_compile_is_null',
+    ':not-empty': '_compile_is_null',
+  }
+
+  def __init__(self, fields = DEFAULT_FIELDS):
+    """
+    :param fields: {field id: column name} mapping, as for `generate_sql`
+    """
+    self.fields = fields
+
+  def _operand(self, node, columns):
+    if node.type == 'DSL_FIELD':
+      name = self.fields.get(int(node.value))
+      if name is None:
+        raise SyntaxError(f'Unknown field id {node.value}')
+      columns[name] = None
+      return (FIELD, name)
+    if node.type == 'DSL_LITERAL':
+      return (LITERAL, literal_value(str(node.value)))
+    if node.type == 'DSL_NIL':
+      return (NIL, None)
+    raise SyntaxError(f'Expected a field, literal or nil, got {node.type}')
+
+  def compile(self, ast):
+    """
+    Compile a where-clause AST, e.g. from `DSLParser.parse`, into a `Predicate`
+
+    Nodes are compiled in post order on an explicit stack, into a flat program that runs without recursing
+    however deep the where-clause. Subtrees shared between macro references are evaluated once
+    """
+    program = []
+    columns = {}
+    if ast is None:
+      return Predicate(program, ())
+    done = {}
+    stack = [(ast, False)]
+    while stack:
+      node, expanded = stack.pop()
+      if id(node) in done:
+        continue
+      logical = node.type == 'DSL_OP' and node.value in (':and', ':or', ':not')
+      if logical and not expanded:
+        stack.append((node, True))
+        stack.extend((c, False) for c in reversed(node.children) if id(c) not in done)
+        continue
+      if node.type in ('DSL_TRUE', 'DSL_FALSE'):
+        instr = ('const', node.type == 'DSL_TRUE')
+      elif node.type != 'DSL_OP':
+        raise SyntaxError(f'Expected a where-clause, got {node.type}')
+      elif node.value not in self.OPERATORS:
+        raise RuntimeError(f'Operator "{node.value}" can\'t be evaluated')
+      elif logical:
+        instr = self._compile_logical(node, done)
+      else:
+        instr = getattr(self, self.OPERATORS[node.value])(node, columns)
+      done[id(node)] = len(program)
+      program.append(instr)
+    return Predicate(program, tuple(columns))
+
+  def _compile_logical(self, node, done):
+    args = [done[id(c)] for c in node.children]
+    if node.value == ':not':
+      return ('not_', args[0])
+    return ('and_' if node.value == ':and' else 'or_', args)
+
+  def _compile_comparison(self, node, columns):
+    left = self._operand(node.left, columns)
+    right = self._operand(node.right, columns)
+    if node.value in (':=', ':!=') and (left[0] == NIL) != (right[0] == NIL):
+      # x = nil is x IS NULL, see `ASTSerializer.serialize_eq`
+      return ('is_null', (right if left[0] == NIL else left, node.value == ':!='))
+    op = node.value
+    if left[0] != FIELD and right[0] == FIELD:
+      # Keep the column on the left
+      op = COMPARISONS[op][1]
+      left, right = right, left
+    return ('compare', (COMPARISONS[op][0], left, right))
+
+  def _compile_in(self, node, columns):
+    left = self._operand(node.left, columns)
+    values = [self._operand(c, columns) for c in node.right.children]
+    negate = node.value == ':not-in'
+    literals = [v for kind, v in values if kind == LITERAL]
+    if left[0] == FIELD and all(kind != FIELD for kind, _ in values) and len({type(v) for v in literals}) <= 1:
+      return ('in_values', (left[1], frozenset(literals), len(literals) < len(values), negate))
+    # x IN (a, b) is x = a OR x = b, x NOT IN (a, b) is x <> a AND x <> b
+    return ('in_fold', (left, values, negate))
+
+  def _compile_is_null(self, node, columns):
+    return ('is_null', (self._operand(node.left, columns), node.value == ':not-empty'))
+
+  def evaluate(self, ast, columns, rows = None):
+    """
+    `compile` and run a where-clause over `columns` at once, see `Predicate.__call__`
+    """
+    return self.compile(ast)(columns, rows)
+
+  def evaluate_rows(self, ast, rows):
+    """
+    Reference, row at a time evaluation of a where-clause over {column name: value} dicts
+
+    :returns: A generator of the SQL truth value of every row, True / False / None (UNKNOWN)
+    """
+    # Post order list of (node, resolved operands), so rows only get walked, not the AST resolved again
+    order = []
+    seen = set()
+    stack = [(ast, False)]
+    while stack:
+      node, expanded = stack.pop()
+      if id(node) in seen:
+        continue
+      if node.type == 'DSL_OP' and node.value in (':and', ':or', ':not') and not expanded:
+        stack.append((node, True))
+        stack.extend((c, False) for c in node.children)
+        continue
+      seen.add(id(node))
+      if node.type == 'DSL_OP' and node.value not in (':and', ':or', ':not'):
+        if node.value not in self.OPERATORS:
+          raise RuntimeError(f'Operator "{node.value}" can\'t be evaluated')
+        operands = [self._operand(c, {}) for c in node.children if c.type != 'DSL_LIST']
+        if node.value in (':in', ':not-in'):
+          operands.extend(self._operand(c, {}) for c in node.right.children)
+      else:
+        operands = [id(c) for c in node.children]
+      order.append((id(node), node.type, node.value, operands))
+    for row in rows:
+      values = {}
+      for key, type, op, operands in order:
+        values[key] = self._row_value(type, op, operands, row, values)
+      yield values[id(ast)]
+
+  def evaluate_row(self, ast, row):
+    """
+    Reference, row at a time evaluation of a where-clause over a {column name: value} dict, see `evaluate_rows`
+    """
+    return next(self.evaluate_rows(ast, [row]))
+
+  @staticmethod
+  def _row_value(type, op, operands, row, values):
+    if type in ('DSL_TRUE', 'DSL_FALSE'):
+      return type == 'DSL_TRUE'
+    if op in (':and', ':or'):
+      args = [values[c] for c in operands]
+      decisive = op == ':or'
+      if decisive in args:
+        return decisive
+      return None if None in args else not decisive
+    if op == ':not':
+      v = values[operands[0]]
+      return None if v is None else not v
+
+    kinds = [kind for kind, _ in operands]
+    args = [row[value] if kind == FIELD else value for kind, value in operands]
+    if op in (':is-empty', ':not-empty'):
+      return (args[0] is None) == (op == ':is-empty')
+    if op in (':in', ':not-in'):
+      v, options = args[0], args[1:]
+      if v is None:
+        return None
+      if v in options:
+        return op == ':in'
+      return None if None in options else op == ':not-in'
+    if op in (':=', ':!=') and (kinds[0] == NIL) != (kinds[1] == NIL):
+      # x = nil is x IS NULL
+      other = args[1] if kinds[0] == NIL else args[0]
+      return (other is None) == (op == ':=')
+    a, b = args
+    if a is None or b is None:
+      return None
+    return COMPARISONS[op][0](a, b)
@@ -0,0 +1,290 @@
+import threading
+
+from cache import fingerprint
+from dsl_parser import DSLParser, ParseContext
+from utils import build_neighbors_map, has_cycle, macro_refs, reaches
+
+
+# Default limits on the where-clause a query expands to, see `MacroLibrary.check_expansion`
+MAX_EXPANDED_SIZE = 1000000
+MAX_EXPANDED_NODES = 100000
+MAX_EXPANDED_DEPTH = None
+
+
+class MacroLibrary:
+  """
+  A precompiled set of where-clause macros, referenced from queries as `[:macro "<macro_id>"]`
+
+  Instead of textually substituting macro bodies into the query, every macro body is parsed (lazily, on
+  first use) into an AST once, and the parser splices that AST in wherever the macro is referenced.
+  Macro ASTs are shared between every query and every other macro referencing them, treat them as
+  immutable
+
+  The dependency graph is checked for cycles once on construction. `set` / `remove` update single
+  macros, re-validating only the cycles that could run through the changed macro and dropping the
+  parsed ASTs of the macro and of the macros depending on it
+
+  Macros referencing each other more than once (e.g. a chain of diamonds) expand exponentially, the size
+  of the expansion is calculated bottom up over the dependency graph and queries exceeding the limits
+  are rejected before anything gets expanded
+  """
+
+  def __init__(self, macros = None, parser = None, validate = True, max_size = MAX_EXPANDED_SIZE,
+               max_nodes = MAX_EXPANDED_NODES, max_depth = MAX_EXPANDED_DEPTH):
+    """
+    :param macros: A dict of {macro_id: where-clause str}
+    :param parser: The DSLParser whose operators macro bodies are parsed with, by default the parser
+      of the query referencing the macro
+    :param validate: Check the whole dependency graph up front. Otherwise only the macros actually
+      referenced get scanned (and checked for cycles) as they are resolved, which is cheaper for a
+      library that is thrown away after a single query
+    :param max_size: Max length in characters of a where-clause with all its macros expanded, None for no limit
+    :param max_nodes: Max number of AST nodes of a where-clause with all its macros expanded, None for no limit
+    :param max_depth: Max nesting depth of macros referencing macros, None for no limit
+    """
+    self.parser = parser
+    self.max_size = max_size
+    self.max_nodes = max_nodes
+    self.max_depth = max_depth
+    self._bodies = dict(macros or {})
+    self._deps = {}
+    self._dependents = None
+    if validate:
+      self._validate()
+    self._asts = {}
+    self._field_ids = {}
+    self._expansions = {}
+    self._own = {}
+    # Computed on first use, then kept up to date by `set` / `remove`
+    self._fp = None
+    self._lock = threading.RLock()
+
+  def _validate(self):
+    if self._dependents is not None:
+      return
+    self._deps = build_neighbors_map(self._bodies)
+    if has_cycle(self._bodies, self._deps):
+      raise RuntimeError("Cycle detected in macros.")
+    self._dependents = {}
+    for macro_id, deps in self._deps.items():
+      for dep in deps:
+        self._dependents.setdefault(dep, set()).add(macro_id)
+
+  def _refs(self, macro_id):
+    deps = self._deps.get(macro_id)
+    if deps is None:
+      deps = self._deps[macro_id] = macro_refs(self._bodies[macro_id])
+    return deps
+
+  @staticmethod
+  def _entry_fp(macro_id, body):
+    return int(fingerprint(macro_id, body), 16)
+
+  @property
+  def fingerprint(self):
+    """
+    Stable digest of the library contents, independent of the order macros were added in
+    """
+    if self._fp is None:
+      fp = 0
+      for macro_id, body in self._bodies.items():
+        fp ^= self._entry_fp(macro_id, body)
+      self._fp = fp
+    return f'{self._fp:032x}'
+
+  def __len__(self):
+    return len(self._bodies)
+
+  def __contains__(self, macro_id):
+    return macro_id in self._bodies
+
+  def __getitem__(self, macro_id):
+    return self._bodies[macro_id]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.RLock()
+
+  def dependents(self, macro_id):
+    """
+    Ids of every macro that references `macro_id`, directly or through other macros
+    """
+    self._validate()
+    res = set()
+    stack = [macro_id]
+    while stack:
+      for n in self._dependents.get(stack.pop(), ()):
+        if n not in res:
+          res.add(n)
+          stack.append(n)
+    return res
+
+  def set(self, macro_id, body):
+    """
+    Add or replace a single macro
+
+    Any new cycle has to run through `macro_id` since the rest of the graph was acyclic, so only the
+    macros reachable from the new body are walked
+    """
+    with self._lock:
+      self._validate()
+      deps = macro_refs(body)
+      if macro_id in deps or reaches(self._deps, deps, macro_id):
+        raise RuntimeError("Cycle detected in macros.")
+      self._unlink(macro_id)
+      self._bodies[macro_id] = body
+      self._deps[macro_id] = deps
+      for dep in deps:
+        self._dependents.setdefault(dep, set()).add(macro_id)
+      if self._fp is not None:
+        self._fp ^= self._entry_fp(macro_id, body)
+
+  def remove(self, macro_id):
+    """
+    Remove a single macro, queries and macros still referencing it fail to parse from then on
+    """
+    with self._lock:
+      if macro_id not in self._bodies:
+        raise KeyError(macro_id)
+      self._validate()
+      self._unlink(macro_id)
+      del self._bodies[macro_id]
+      del self._deps[macro_id]
+
+  def _unlink(self, macro_id):
+    # Drop the parsed ASTs that (transitively) contain `macro_id` and its outgoing edges
+    for n in self.dependents(macro_id) | {macro_id}:
+      self._asts.pop(n, None)
+      self._field_ids.pop(n, None)
+      self._expansions.pop(n, None)
+      self._own.pop(n, None)
+    if macro_id in self._bodies:
+      if self._fp is not None:
+        self._fp ^= self._entry_fp(macro_id, self._bodies[macro_id])
+      for dep in self._deps[macro_id]:
+        self._dependents[dep].discard(macro_id)
+
+  def resolve(self, macro_id, parser = None):
+    """
+    The AST of the macro `macro_id`, parsing it and the macros it references on first use
+
+    :param parser: The DSLParser to parse with when the library was not constructed with one
+    """
+    ast = self._asts.get(macro_id)
+    if ast is not None:
+      return ast
+    if macro_id not in self._bodies:
+      raise SyntaxError(f'Unknown macro "{macro_id}"')
+
+    parser = self.parser or parser or DSLParser()
+    with self._lock:
+      # Parse dependencies first (post order, explicit stack) so that parsing a body never recurses
+      # into another macro body. Cycles are caught here too when the library was not validated upfront
+      in_process = set()
+      stack = [(macro_id, False)]
+      while stack:
+        n, expanded = stack.pop()
+        if n in self._asts:
+          continue
+        if n not in self._bodies:
+          raise SyntaxError(f'Unknown macro "{n}"')
+        if not expanded:
+          if n in in_process:
+            raise RuntimeError("Cycle detected in macros.")
+          in_process.add(n)
+          stack.append((n, True))
+          stack.extend((d, False) for d in self._refs(n) if d not in self._asts)
+          continue
+        in_process.discard(n)
+        self._asts[n], self._field_ids[n] = self._parse_body(n, parser)
+      return self._asts[macro_id]
+
+  def _parse_body(self, macro_id, parser):
+    body = self._bodies[macro_id]
+    ctx = ParseContext(parser, parser.scan(body), macros=self)
+    ast = ctx.parse_where()
+    if ast is None or ctx.current is not None:
+      raise SyntaxError(f'Expected macro "{macro_id}" to be a single where-clause')
+    # Size and node count of the body itself, the macros it references are accounted for separately
+    self._own[macro_id] = (len(body) - ctx.macro_chars, ctx.nodes, ctx.macro_refs)
+    return ast, frozenset(ctx.field_ids)
+
+  def field_ids(self, macro_id):
+    """
+    Ids (as str) of the fields the macro `macro_id` references, including through other macros
+    """
+    self.resolve(macro_id)
+    return self._field_ids[macro_id]
+
+  def expansion(self, size, nodes, refs, shared = False):
+    """
+    Calculate the (size, nodes, depth) of a where-clause with all its macros expanded, without expanding
+    them, i.e. its length in characters, its number of AST nodes and how deep macros nest
+
+    Computed bottom up over the dependency graph from the figures `ParseContext` collects while parsing,
+    for the where-clause as for every macro body, the figures of each macro are memoized
+
+    :param size: Length of the where-clause, not counting its [:macro "<macro_id>"] clauses
+    :param nodes: Number of AST nodes of the where-clause, not counting its macro clauses either
+    :param refs: The ids of the macros referenced, once per clause (`ParseContext.macro_refs`)
+    :param shared: Count every distinct macro once, however often it is referenced, i.e. measure the
+      dependency DAG `generate_sql(..., shared=True)` emits rather than the fully inlined tree
+    """
+    for r in refs:
+      if r not in self._own:
+        self.resolve(r)
+    stack = [(r, False) for r in dict.fromkeys(refs) if r not in self._expansions]
+    while stack:
+      macro_id, expanded = stack.pop()
+      if macro_id in self._expansions:
+        continue
+      m_size, m_nodes, m_refs = self._own[macro_id]
+      if not expanded:
+        # Resolving parsed the macros referenced too, and their cycles were caught doing so
+        stack.append((macro_id, True))
+        stack.extend((d, False) for d in m_refs if d not in self._expansions)
+        continue
+      depth = 0
+      for r in m_refs:
+        r_size, r_nodes, r_depth = self._expansions[r]
+        m_size += r_size
+        m_nodes += r_nodes
+        depth = max(depth, r_depth)
+      self._expansions[macro_id] = (m_size, m_nodes, depth + 1)
+
+    depth = max((self._expansions[r][2] for r in refs), default=0)
+    if shared:
+      seen = set()
+      stack = list(refs)
+      while stack:
+        macro_id = stack.pop()
+        if macro_id in seen:
+          continue
+        seen.add(macro_id)
+        m_size, m_nodes, m_refs = self._own[macro_id]
+        size += m_size
+        nodes += m_nodes
+        stack.extend(m_refs)
+      return size, nodes, depth
+    for r in refs:
+      r_size, r_nodes, _ = self._expansions[r]
+      size += r_size
+      nodes += r_nodes
+    return size, nodes, depth
+
+  def check_expansion(self, size, nodes, refs, shared = False):
+    """
+    Raise a RuntimeError if a where-clause would expand beyond the limits of this library
+
+    :returns: The (size, nodes, depth) of the expansion, see `expansion` for the arguments
+    """
+    size, nodes, depth = self.expansion(size, nodes, refs, shared)
+    for name, value, limit in (('size', size, self.max_size), ('nodes', nodes, self.max_nodes), ('depth', depth, self.max_depth)):
+      if limit is not None and value > limit:
+        raise RuntimeError(f'Macro expansion exceeds max_{name} ({value} > {limit})')
+    return size, nodes, depth
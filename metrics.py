@@ -0,0 +1,149 @@
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from dsl_parser import CompileListener
+
+
+# Upper bounds of the latency buckets in seconds, 1 / 2 / 5 steps from 1us to 10s
+LATENCY_BUCKETS = tuple(float(f'{m}e{e}') for e in range(-6, 1) for m in (1, 2, 5)) + (10.0,)
+# Upper bounds of the size buckets (tokens, nodes, characters), powers of 4 up to ~16M
+SIZE_BUCKETS = tuple(4 ** e for e in range(13))
+
+
+class Histogram:
+  """
+  Fixed bucket histogram, observations above the last bound land in an overflow bucket
+  """
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def percentile(self, q):
+    """
+    Upper bound of the bucket holding the `q` (0..1) quantile, None when empty or in the overflow bucket
+    """
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for bound, n in zip(self.bounds, self.counts):
+      seen += n
+      if seen >= rank:
+        return bound
+    return None
+
+  def to_dict(self):
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'buckets': dict(zip([*self.bounds, 'inf'], self.counts)),
+    }
+
+
+class MetricsAggregator(CompileListener):
+  """
+  In-process `CompileListener` keeping counters and histograms over every instrumented call
+
+  Counters: `compiles.<kind>`, `errors.<kind>`, `cache.<hit|miss>`, `ast_cache.<hit|miss>`,
+  `shape_cache.<hit|miss>` and `rewrites.<rewrite>`, how often each optimizer rewrite fired
+  Histograms: `latency.total` and `latency.<stage>` in seconds, plus `tokens`, `nodes`, `macro_size` and
+  `sql_length`
+
+  p = DSLParser()
+  metrics = MetricsAggregator()
+  p.add_listener(metrics)
+  ...
+  metrics.snapshot()
+  """
+
+  SIZE_STATS = ('tokens', 'nodes', 'macro_size', 'sql_length')
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.counters = Counter()
+      self.histograms = {}
+
+  def _observe(self, name, bounds, value):
+    h = self.histograms.get(name)
+    if h is None:
+      h = self.histograms[name] = Histogram(bounds)
+    h.observe(value)
+
+  def compile_end(self, event):
+    with self._lock:
+      self.counters[f'compiles.{event.kind}'] += 1
+      if event.error is not None:
+        self.counters[f'errors.{event.kind}'] += 1
+      for cache in ('cache', 'ast_cache', 'shape_cache'):
+        if cache in event.stats:
+          self.counters[f'{cache}.{event.stats[cache]}'] += 1
+      for rewrite, n in event.stats.get('fired', {}).items():
+        self.counters[f'rewrites.{rewrite}'] += n
+      self._observe('latency.total', LATENCY_BUCKETS, event.elapsed)
+      for stage, elapsed in event.stages.items():
+        self._observe(f'latency.{stage}', LATENCY_BUCKETS, elapsed)
+      for name in self.SIZE_STATS:
+        if name in event.stats:
+          self._observe(name, SIZE_BUCKETS, event.stats[name])
+
+  def percentile(self, name, q):
+    """
+    e.g. `percentile('latency.parse', 0.99)`, see `Histogram.percentile`
+    """
+    with self._lock:
+      h = self.histograms.get(name)
+      return h.percentile(q) if h is not None else None
+
+  def snapshot(self):
+    """
+    Plain dict copy of all counters and histograms, e.g. to dump as JSON
+    """
+    with self._lock:
+      return {
+        'counters': dict(self.counters),
+        'histograms': {name: h.to_dict() for name, h in self.histograms.items()},
+      }
+
+  def render_prometheus(self, prefix = 'dsl_parser'):
+    """
+    All metrics in the Prometheus text exposition format
+    """
+    snap = self.snapshot()
+    lines = []
+    family = None
+    for name, value in sorted(snap['counters'].items()):
+      metric, label = name.split('.', 1)
+      metric = f'{prefix}_{metric}_total'
+      if metric != family:
+        family = metric
+        lines.append(f'# TYPE {metric} counter')
+      label_name = 'outcome' if metric.endswith('cache_total') else 'kind'
+      lines.append(f'{metric}{{{label_name}="{label}"}} {value}')
+    for name, h in sorted(snap['histograms'].items()):
+      metric, _, stage = name.partition('.')
+      metric = f'{prefix}_{metric}_seconds' if metric == 'latency' else f'{prefix}_{metric}'
+      labels = f'stage="{stage}",' if stage else ''
+      if metric != family:
+        family = metric
+        lines.append(f'# TYPE {metric} histogram')
+      cumulative = 0
+      for bound, n in h['buckets'].items():
+        cumulative += n
+        le = '+Inf' if bound == 'inf' else repr(bound)
+        lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {cumulative}')
+      lines.append(f'{metric}_sum{{{labels.rstrip(",")}}} {h["sum"]}')
+      lines.append(f'{metric}_count{{{labels.rstrip(",")}}} {h["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,428 @@
+from cache import value_key
+from dsl_parser import Node, literal_value
+
+
+REWRITES = ('flatten', 'dedupe', 'merge_in', 'fold_not', 'contradictions')
+
+# [:not [op a b]] is equivalent to [negated-op a b], also under SQL three valued logic
+NEGATED_OPS = {
+  ':=': ':!=',
+  ':!=': ':=',
+  ':<': ':>=',
+  ':>=': ':<',
+  ':>': ':<=',
+  ':<=': ':>',
+  ':in': ':not-in',
+  ':not-in': ':in',
+  ':is-empty': ':not-empty',
+  ':not-empty': ':is-empty',
+}
+
+# Comparisons seen from their right hand side, [:< 5 [:field 1]] is [:> [:field 1] 5]
+FLIPPED_OPS = {
+  ':=': ':=',
+  ':!=': ':!=',
+  ':<': ':>',
+  ':>': ':<',
+  ':<=': ':>=',
+  ':>=': ':<=',
+}
+
+# Absorbing / neutral constants of the logical chains
+CONSTANTS = {
+  ':and': ('DSL_FALSE', 'DSL_TRUE'),
+  ':or': ('DSL_TRUE', 'DSL_FALSE'),
+}
+
+NIL = object()
+
+
+class OptimizeResult:
+  """
+  Outcome of `Optimizer.optimize`
+
+  :attr ast: The rewritten AST
+  :attr fired: Dict of rewrite name to the number of times it fired
+  """
+
+  def __init__(self, ast, fired):
+    self.ast = ast
+    self.fired = fired
+
+  @property
+  def always_false(self):
+    """
+    The where-clause can never match, the database round trip can be skipped entirely
+    """
+    return self.ast is not None and self.ast.type == 'DSL_FALSE'
+
+  def __repr__(self):
+    return f"OptimizeResult({self.ast},{self.fired})"
+
+
+class _FieldFacts:
+  """
+  Everything an :and chain states about a single field, used to detect contradictions
+
+  Ranges and sets of allowed values are only reasoned about for numbers, how strings compare is up to the
+  collation of the database
+  """
+
+  def __init__(self):
+    self.null = None
+    self.lo = None
+    self.hi = None
+    self.allowed = None
+    self.excluded = set()
+    self.kind = None
+    self.unsafe = False
+
+  def _check_kind(self, values):
+    # Mixing numbers and strings leaves the outcome up to the database's implicit casts, so give up
+    for v in values:
+      kind = 'num' if isinstance(v, (int, float)) else 'str'
+      if self.kind is None:
+        self.kind = kind
+      elif self.kind != kind:
+        self.unsafe = True
+
+  def _set_null(self, null):
+    if self.null is not None and self.null != null:
+      return True
+    self.null = null
+    return False
+
+  def add(self, op, value):
+    """
+    Record `[op <field> value]` and return whether the facts about the field became contradictory
+    """
+    if op == ':is-empty' or (op == ':=' and value is NIL):
+      return self._set_null(True)
+    if op == ':not-empty' or (op == ':!=' and value is NIL):
+      return self._set_null(False)
+    if value is NIL:
+      return False
+    # Any other comparison can only hold for non null values
+    if self._set_null(False):
+      return True
+
+    values = value if op in (':in', ':not-in') else (value,)
+    self._check_kind(values)
+    if self.unsafe:
+      return False
+
+    if op in (':=', ':in'):
+      if self.allowed is None:
+        self.allowed = set(values)
+      elif self.kind == 'num':
+        self.allowed &= set(values)
+      # Distinct strings may still be equal under the database's collation ('a' = 'A' in MySQL by default,
+      # trailing spaces are often ignored), so the allowed strings are never narrowed down. Identical
+      # literals are equal under any collation, so an allowed string that is also excluded still can't match
+    elif op in (':!=', ':not-in'):
+      self.excluded.update(values)
+    elif self.kind != 'num':
+      self.unsafe = True
+      return False
+    elif op in (':<', ':<='):
+      bound = (value, op == ':<=')
+      if self.hi is None or bound[0] < self.hi[0] or (bound[0] == self.hi[0] and not bound[1]):
+        self.hi = bound
+    elif op in (':>', ':>='):
+      bound = (value, op == ':>=')
+      if self.lo is None or bound[0] > self.lo[0] or (bound[0] == self.lo[0] and not bound[1]):
+        self.lo = bound
+    return self._is_empty()
+
+  def _in_bounds(self, v):
+    if self.kind != 'num':
+      return True
+    if self.lo is not None and (v < self.lo[0] or (v == self.lo[0] and not self.lo[1])):
+      return False
+    if self.hi is not None and (v > self.hi[0] or (v == self.hi[0] and not self.hi[1])):
+      return False
+    return True
+
+  def _is_empty(self):
+    if self.lo is not None and self.hi is not None:
+      if self.lo[0] > self.hi[0] or (self.lo[0] == self.hi[0] and not (self.lo[1] and self.hi[1])):
+        return True
+    if self.allowed is not None:
+      return not any(v not in self.excluded and self._in_bounds(v) for v in self.allowed)
+    return False
+
+
+def _constraint(node):
+  """
+  Normalize a comparison against a single field into (field id, op, value), None for anything else
+  """
+  if node.type != 'DSL_OP':
+    return None
+  op, l, r = node.value, node.left, node.right
+  if op in (':is-empty', ':not-empty'):
+    return (str(l.value), op, None) if l.type == 'DSL_FIELD' else None
+  if op in (':in', ':not-in'):
+    # Lists holding fields or nil constrain nothing we can reason about
+    if l.type == 'DSL_FIELD' and r.type == 'DSL_LIST' and all(v.type == 'DSL_LITERAL' for v in r.children):
+      return (str(l.value), op, tuple(literal_value(str(v.value)) for v in r.children))
+    return None
+  if op not in FLIPPED_OPS:
+    return None
+  if r.type == 'DSL_FIELD' and l.type != 'DSL_FIELD':
+    l, r, op = r, l, FLIPPED_OPS[op]
+  if l.type != 'DSL_FIELD':
+    return None
+  if r.type == 'DSL_NIL':
+    return (str(l.value), op, NIL)
+  if r.type == 'DSL_LITERAL':
+    return (str(l.value), op, literal_value(str(r.value)))
+  return None
+
+
+def _eq_values(node):
+  """
+  (field id, field node, literal nodes) of a `[:= <field> <literal>]` or `[:in <field> <list>]`, else None
+  """
+  if node.type != 'DSL_OP':
+    return None
+  if node.value == ':in' and node.left.type == 'DSL_FIELD':
+    return (str(node.left.value), node.left, list(node.right.children))
+  if node.value == ':=':
+    l, r = node.left, node.right
+    if r.type == 'DSL_FIELD':
+      l, r = r, l
+    if l.type == 'DSL_FIELD' and r.type == 'DSL_LITERAL':
+      return (str(l.value), l, [r])
+  return None
+
+
+class _Pass:
+  """
+  Per `optimize` call state: fired rewrite counters and the structural key memo
+  """
+
+  def __init__(self):
+    self.fired = {}
+    self.keys = {}
+    self.key_table = {}
+
+  def fire(self, name, n = 1):
+    self.fired[name] = self.fired.get(name, 0) + n
+
+  def key(self, node):
+    """
+    Small int identifying the structure of `node`, equal for structurally identical subtrees
+    """
+    stack = [node]
+    while stack:
+      n = stack[-1]
+      if id(n) in self.keys:
+        stack.pop()
+        continue
+      pending = [c for c in n.children if id(c) not in self.keys]
+      if pending:
+        stack.extend(pending)
+        continue
+      stack.pop()
+      k = (n.type, value_key(n.value), tuple(self.keys[id(c)] for c in n.children))
+      self.keys[id(n)] = self.key_table.setdefault(k, len(self.key_table))
+    return self.keys[id(node)]
+
+
+class Optimizer:
+  """
+  Predicate optimizer run on where-clause ASTs in between DSLParser.parse_where and ASTSerializer.serialize_ast
+
+  Every rewrite is on by default and can be switched off individually, e.g. `Optimizer(merge_in=False)`
+  - flatten: collapse nested :and / :or of the same operator into a single n-ary node
+  - dedupe: drop structurally identical operands of :and / :or
+  - merge_in: merge several := / :in on the same field under :or into a single :in
+  - fold_not: fold :not into the comparison below it, e.g. [:not [:< a b]] -> [:>= a b]
+  - contradictions: replace :and chains that can never match e.g. [:< [:field 4] 5] and [:> [:field 4] 10]
+    by a constant false, and simplify chains around constants. Only done where the chain filters rows
+    directly (not e.g. under a :not), since it may be UNKNOWN rather than FALSE
+
+  Input ASTs are never mutated (they may be hash-consed and shared), rewritten parts are built from new nodes
+  """
+
+  def __init__(self, **rewrites):
+    unknown = set(rewrites) - set(REWRITES)
+    if unknown:
+      raise ValueError(f'Unknown optimizer rewrite(s): {", ".join(sorted(unknown))}')
+    self.enabled = {name: bool(rewrites.get(name, True)) for name in REWRITES}
+
+  def optimize(self, ast):
+    """
+    :returns: An `OptimizeResult` holding the rewritten AST and which rewrites fired
+    """
+    run = _Pass()
+    if ast is None:
+      return OptimizeResult(None, run.fired)
+
+    # Iterative post order over the AST, where the children of an :and / :or chain are its flattened operands.
+    # Nodes are visited along with whether they are filtering, i.e. only reached through :and / :or from the
+    # top of the where-clause. There a NULL comparison (UNKNOWN) filters a row out just like FALSE does, so a
+    # chain that can never be true may be folded to FALSE. Anywhere else, e.g. under a :not, it can't: NOT
+    # UNKNOWN is still UNKNOWN. A subtree shared between both gets rewritten once for each
+    done = {}
+    operands = {}
+    stack = [(ast, True)]
+    while stack:
+      node, filtering = stack[-1]
+      key = (id(node), filtering)
+      if key in done:
+        stack.pop()
+        continue
+      if key not in operands:
+        kids = self._operands(node, run)
+        below = filtering and node.type == 'DSL_OP' and node.value in CONSTANTS
+        operands[key] = kids = [(k, below) for k in kids]
+        pending = [k for k in kids if (id(k[0]), k[1]) not in done]
+        if pending:
+          stack.extend(reversed(pending))
+          continue
+      stack.pop()
+      kids = [done[(id(k), below)] for k, below in operands[key]]
+      done[key] = self._rewrite(node, kids, run, filtering)
+    return OptimizeResult(done[(id(ast), True)], run.fired)
+
+  def _operands(self, node, run):
+    if node.type != 'DSL_OP':
+      return ()
+    if node.value not in CONSTANTS or not self.enabled['flatten']:
+      return node.children
+    return self._flatten(node.value, node.children, run)
+
+  def _flatten(self, op, kids, run):
+    flat = []
+    nested = 0
+    stack = list(kids[::-1])
+    while stack:
+      n = stack.pop()
+      if n.type == 'DSL_OP' and n.value == op:
+        nested += 1
+        stack.extend(n.children[::-1])
+      else:
+        flat.append(n)
+    if nested:
+      run.fire('flatten', nested)
+    return flat
+
+  def _rewrite(self, node, kids, run, filtering):
+    if node.type != 'DSL_OP':
+      return node
+    if node.value in CONSTANTS:
+      return self._rewrite_chain(node, kids, run, filtering)
+    if any(a is not b for a, b in zip(kids, node.children)):
+      node = Node(node.type, node.value, *kids)
+    if node.value == ':not' and self.enabled['fold_not']:
+      return self._fold_not(node, run)
+    return node
+
+  def _fold_not(self, node, run):
+    child = node.left
+    if child.type in ('DSL_TRUE', 'DSL_FALSE'):
+      run.fire('fold_not')
+      return Node('DSL_FALSE' if child.type == 'DSL_TRUE' else 'DSL_TRUE', None)
+    if child.type != 'DSL_OP':
+      return node
+    if child.value == ':not':
+      run.fire('fold_not')
+      return child.left
+    negated = NEGATED_OPS.get(child.value)
+    if negated is None:
+      return node
+    run.fire('fold_not')
+    return Node('DSL_OP', negated, *child.children)
+
+  def _rewrite_chain(self, node, kids, run, filtering):
+    op = node.value
+    operands = kids
+    if self.enabled['flatten'] and any(k.type == 'DSL_OP' and k.value == op for k in kids):
+      # An operand only turned into the same chain while being rewritten, e.g. [:not [:not [:and ..]]]
+      operands = self._flatten(op, kids, run)
+
+    if self.enabled['dedupe']:
+      seen = set()
+      unique = []
+      for n in operands:
+        k = run.key(n)
+        if k in seen:
+          run.fire('dedupe')
+          continue
+        seen.add(k)
+        unique.append(n)
+      operands = unique
+
+    if self.enabled['contradictions']:
+      absorbing, neutral = CONSTANTS[op]
+      for n in operands:
+        if n.type == absorbing:
+          run.fire('contradictions')
+          return n
+      kept = [n for n in operands if n.type != neutral]
+      if not kept:
+        return operands[0]
+      operands = kept
+
+    if op == ':or' and self.enabled['merge_in']:
+      operands = self._merge_in(operands, run)
+
+    # A contradiction only rules out TRUE, the chain may still be UNKNOWN rather than FALSE
+    if op == ':and' and filtering and self.enabled['contradictions'] and self._contradicts(operands):
+      run.fire('contradictions')
+      return Node('DSL_FALSE', None)
+
+    if len(operands) == 1:
+      return operands[0]
+    if len(operands) == len(node.children) and all(a is b for a, b in zip(operands, node.children)):
+      return node
+    return Node('DSL_OP', op, *operands)
+
+  def _merge_in(self, operands, run):
+    out = []
+    groups = {}
+    for n in operands:
+      m = _eq_values(n)
+      if m is None:
+        out.append(n)
+        continue
+      field_id, field, values = m
+      if field_id not in groups:
+        groups[field_id] = len(out)
+        out.append([n, field, values, False])
+        continue
+      entry = out[groups[field_id]]
+      entry[2] = entry[2] + values
+      entry[3] = True
+      run.fire('merge_in')
+
+    res = []
+    for entry in out:
+      if not isinstance(entry, list):
+        res.append(entry)
+      elif not entry[3]:
+        res.append(entry[0])
+      else:
+        _, field, values, _ = entry
+        # Keyed on the node type too, or [:field 2] and the literal 2 would collapse into one
+        unique = list({(v.type, value_key(v.value)): v for v in values}.values())
+        if len(unique) == 1:
+          res.append(Node('DSL_OP', ':=', field, unique[0]))
+        else:
+          res.append(Node('DSL_OP', ':in', field, Node('DSL_LIST', None, *unique)))
+    return res
+
+  def _contradicts(self, operands):
+    facts = {}
+    for n in operands:
+      c = _constraint(n)
+      if c is None:
+        continue
+      field_id, op, value = c
+      f = facts.get(field_id)
+      if f is None:
+        f = facts[field_id] = _FieldFacts()
+      if f.add(op, value):
+        return True
+    return False
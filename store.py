@@ -0,0 +1,417 @@
+"""
+Compact binary store of precompiled queries, readable through mmap
+
+A store file holds many parsed `Query`s keyed by id, so a cold process can serialize SQL straight from the
+mapped file without tokenizing, parsing or resolving macros
+
+Layout (little endian, version 1), every section starts 8 byte aligned:
+
+  header   magic b'DSLQ', u16 version, u16 flags, u32 string count, u32 query count, u64 offset of the
+           string blob, u64 offset of the records, u64 file size
+  strings  (count + 1) u32 offsets into the UTF-8 string blob. Every node type, node value, key and order
+           direction of the whole store is stored once and referenced by index
+  keys     u32 key string per query, sorted by the UTF-8 bytes of the key
+  records  (query count + 1) u64 offsets of the records, in the order of the keys, the last one is the end
+  blob     the UTF-8 strings, back to back
+  data     one record per query, see below
+
+A record is a run of unsigned LEB128 varints: limit + 1 and offset + 1 (0 for None), the number of :order-by
+entries + 1 followed by (field id, direction) string pairs, the number of :fields + 1 followed by field id
+strings, then 1 and the where-clause in pre-order (or 0 without one). Every node is a tag, its value
+string + 1 (0 for None) and its number of children. The tag is 0 for a back reference to an earlier node,
+followed by its slot number, or else (type string + 1) << 1 with the low bit set when the node is
+referenced again later on (it then takes the next slot). Subtrees shared within a query, e.g. macros
+referenced more than once, are so stored once
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from dsl_parser import DSLParser, Node, Query
+
+
+MAGIC = b'DSLQ'
+VERSION = 1
+
+_ITEMSIZE = {'I': 4, 'Q': 8}
+
+_HEADER = struct.Struct('<4sHHIIQQQ')
+
+
+def _pad(n):
+  return -n % 8
+
+
+def _array(typecode, values):
+  a = array(typecode, values)
+  if sys.byteorder != 'little':
+    a.byteswap()
+  return a.tobytes()
+
+
+def _view(buf, offset, typecode, n):
+  # Zero copy on little endian hosts
+  a = memoryview(buf)[offset:offset + n * _ITEMSIZE[typecode]]
+  if sys.byteorder == 'little':
+    return a.cast(typecode)
+  a = array(typecode, a)
+  a.byteswap()
+  return a
+
+
+def _write_varint(out, n):
+  while n > 0x7f:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+
+
+def _read_varints(buf):
+  # Records are mostly made of varints below 128, one byte each
+  if max(buf, default=0) < 0x80:
+    return list(buf)
+  res = []
+  n = shift = 0
+  for b in buf:
+    n |= (b & 0x7f) << shift
+    if b < 0x80:
+      res.append(n)
+      n = shift = 0
+    else:
+      shift += 7
+  return res
+
+
+def _ref_counts(root):
+  # Number of parents of every node reachable from `root`, by id
+  counts = {id(root): 1}
+  stack = [root]
+  while stack:
+    for c in stack.pop().children:
+      n = counts.get(id(c), 0)
+      counts[id(c)] = n + 1
+      if not n:
+        stack.append(c)
+  return counts
+
+
+class StoreWriter:
+  """
+  Collects queries in memory, then writes them out as a store file
+
+  w = StoreWriter()
+  w.add('q1', parser.parse(raw_query, macros))
+  w.write('queries.dslq')
+  """
+
+  def __init__(self):
+    self._strings = {}
+    self._records = {}
+
+  def __len__(self):
+    return len(self._records)
+
+  def _string(self, s):
+    i = self._strings.get(s)
+    if i is None:
+      i = self._strings[s] = len(self._strings)
+    return i
+
+  def _opt_string(self, value):
+    return 0 if value is None else self._string(str(value)) + 1
+
+  def add(self, key, query):
+    """
+    :param key: Id of the query, stored as str
+    :param query: A `Query` as returned by `DSLParser.parse`
+    """
+    self._records[str(key)] = self._encode(query)
+
+  def _encode(self, query):
+    out = bytearray()
+    for n in (query.limit, query.offset):
+      _write_varint(out, 0 if n is None else n + 1)
+    _write_varint(out, 0 if query.order_by is None else len(query.order_by) + 1)
+    for field, direction in query.order_by or ():
+      _write_varint(out, self._string(field.value))
+      _write_varint(out, self._string(direction))
+    _write_varint(out, 0 if query.fields is None else len(query.fields) + 1)
+    for field in query.fields or ():
+      _write_varint(out, self._string(field.value))
+    _write_varint(out, query.where is not None)
+    if query.where is None:
+      return bytes(out)
+
+    counts = _ref_counts(query.where)
+    slots = {}
+    stack = [query.where]
+    while stack:
+      node = stack.pop()
+      slot = slots.get(id(node))
+      if slot is not None:
+        _write_varint(out, 0)
+        _write_varint(out, slot)
+        continue
+      shared = counts[id(node)] > 1
+      if shared:
+        slots[id(node)] = len(slots)
+      _write_varint(out, (self._string(node.type) + 1) << 1 | shared)
+      _write_varint(out, self._opt_string(node.value))
+      _write_varint(out, len(node.children))
+      stack.extend(reversed(node.children))
+    return bytes(out)
+
+  def write(self, path):
+    if array('I').itemsize != 4 or array('Q').itemsize != 8:
+      raise RuntimeError('Unsupported platform, expected 4 byte unsigned ints')
+    keys = sorted(self._records, key=lambda k: k.encode())
+    key_ids = [self._string(k) for k in keys]
+    blobs = [s.encode() for s in sorted(self._strings, key=self._strings.get)]
+
+    string_offsets = [0]
+    for b in blobs:
+      string_offsets.append(string_offsets[-1] + len(b))
+    if string_offsets[-1] > 0xffffffff:
+      raise RuntimeError('String table exceeds 4 GiB')
+    record_offsets = [0]
+    for k in keys:
+      record_offsets.append(record_offsets[-1] + len(self._records[k]))
+
+    n_strings, n_keys = len(blobs), len(keys)
+    pos = _HEADER.size + (n_strings + 1 + n_keys) * 4
+    pos += _pad(pos)
+    blob_offset = pos + (n_keys + 1) * 8
+    records_offset = blob_offset + string_offsets[-1]
+    records_offset += _pad(records_offset)
+    size = records_offset + record_offsets[-1]
+
+    with open(path, 'wb') as f:
+      f.write(_HEADER.pack(MAGIC, VERSION, 0, n_strings, n_keys, blob_offset, records_offset, size))
+      f.write(_array('I', string_offsets))
+      f.write(_array('I', key_ids))
+      f.write(bytes(_pad(f.tell())))
+      f.write(_array('Q', record_offsets))
+      for b in blobs:
+        f.write(b)
+      f.write(bytes(_pad(f.tell())))
+      for k in keys:
+        f.write(self._records[k])
+
+
+def compile_store(path, queries, macros = {}, parser = None):
+  """
+  Parse every raw query of `queries`, a dict of {key: query str}, and write them out as a store file
+
+  :returns: The number of queries written
+  """
+  parser = parser or DSLParser()
+  w = StoreWriter()
+  for key, raw in queries.items():
+    w.add(key, parser.parse(raw, macros))
+  w.write(path)
+  return len(w)
+
+
+class Store:
+  """
+  Read only, memory mapped view of a store file written by `StoreWriter`
+
+  Opening only reads the header, queries are looked up by binary search over the index and decoded on
+  demand, strings are decoded once on first use. Decoded ASTs are plain `Node` trees (shared subtrees stay
+  shared), treat them as immutable
+
+  with Store('queries.dslq') as store:
+    print(store.generate_sql('postgres', fields, 'q1'))
+  """
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if size < _HEADER.size:
+        raise RuntimeError(f'Not a query store "{path}"')
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      magic, version, _, n_strings, n_keys, self._blob_offset, self._records_offset, expected = \
+        _HEADER.unpack_from(self._mm, 0)
+      if magic != MAGIC:
+        raise RuntimeError(f'Not a query store "{path}"')
+      if version != VERSION:
+        raise RuntimeError(f'Unsupported query store version {version}, expected {VERSION}')
+      if size != expected:
+        raise RuntimeError(f'Truncated query store "{path}", expected {expected} bytes, got {size}')
+      pos = _HEADER.size
+      self._string_offsets = _view(self._mm, pos, 'I', n_strings + 1)
+      pos += (n_strings + 1) * 4
+      self._key_ids = _view(self._mm, pos, 'I', n_keys)
+      pos += n_keys * 4
+      self._record_offsets = _view(self._mm, pos + _pad(pos), 'Q', n_keys + 1)
+    except Exception:
+      self._release()
+      raise
+    self._n_keys = n_keys
+    self._strings = [None] * n_strings
+
+  def _release(self):
+    # Views into the map have to go before the map itself can be closed
+    for name in ('_string_offsets', '_key_ids', '_record_offsets'):
+      view = self.__dict__.pop(name, None)
+      if isinstance(view, memoryview):
+        view.release()
+    self._mm.close()
+
+  def close(self):
+    self._release()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __len__(self):
+    return self._n_keys
+
+  def _string_bytes(self, i):
+    offsets = self._string_offsets
+    return self._mm[self._blob_offset + offsets[i]:self._blob_offset + offsets[i + 1]]
+
+  def _string(self, i):
+    s = self._strings[i]
+    if s is None:
+      s = self._strings[i] = self._string_bytes(i).decode()
+    return s
+
+  def keys(self):
+    """
+    Every key of the store, in the order of their UTF-8 bytes
+    """
+    return [self._string(i) for i in self._key_ids]
+
+  def _find(self, key):
+    # Binary search over the sorted keys, comparing raw bytes so no other key gets decoded
+    target = str(key).encode()
+    key_ids = self._key_ids
+    lo, hi = 0, self._n_keys
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._string_bytes(key_ids[mid]) < target:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self._n_keys and self._string_bytes(key_ids[lo]) == target:
+      return lo
+    return None
+
+  def __contains__(self, key):
+    return self._find(key) is not None
+
+  def __getitem__(self, key):
+    i = self._find(key)
+    if i is None:
+      raise KeyError(key)
+    return self._decode(self._record(i))
+
+  def _record(self, i):
+    start = self._records_offset
+    return self._mm[start + self._record_offsets[i]:start + self._record_offsets[i + 1]]
+
+  def items(self):
+    """
+    Iterate over every (key, `Query`) of the store in key order, without looking keys up
+    """
+    for i, key_id in enumerate(self._key_ids):
+      yield self._string(key_id), self._decode(self._record(i))
+
+  def get(self, key, default = None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def _decode(self, buf):
+    vals = _read_varints(buf)
+    string = self._string
+    limit, offset, n = vals[0] - 1, vals[1] - 1, vals[2]
+    pos = 3
+    order_by = None
+    if n:
+      order_by = tuple((Node('DSL_FIELD', string(vals[i])), string(vals[i + 1])) for i in range(pos, pos + 2 * (n - 1), 2))
+      pos += 2 * (n - 1)
+    fields = None
+    n = vals[pos]
+    pos += 1
+    if n:
+      fields = tuple(Node('DSL_FIELD', string(i)) for i in vals[pos:pos + n - 1])
+      pos += n - 1
+    where = self._decode_where(vals, pos + 1) if vals[pos] else None
+    return Query(where, None if limit < 0 else limit, None if offset < 0 else offset, order_by, fields)
+
+  def _decode_where(self, vals, pos):
+    # Pre-order, on an explicit stack of the (type, value, slot, pending child count, children) of every
+    # node whose children are still being decoded. `kids` / `left` are those of the innermost one
+    string = self._string
+    slots = []
+    stack = []
+    kids = []
+    left = 1
+    while True:
+      tag = vals[pos]
+      if tag:
+        value, count = vals[pos + 1], vals[pos + 2]
+        pos += 3
+        slot = None
+        if tag & 1:
+          slot = len(slots)
+          slots.append(None)
+        node_type = string((tag >> 1) - 1)
+        value = string(value - 1) if value else None
+        if count:
+          stack.append((node_type, value, slot, left, kids))
+          kids = []
+          left = count
+          continue
+        node = Node(node_type, value)
+        if slot is not None:
+          slots[slot] = node
+      else:
+        node = slots[vals[pos + 1]]
+        pos += 2
+      kids.append(node)
+      left -= 1
+      # Complete every node this one was the last pending child of
+      while not left:
+        if not stack:
+          return kids[0]
+        node_type, value, slot, left, parent_kids = stack.pop()
+        node = Node(node_type, value, *kids)
+        if slot is not None:
+          slots[slot] = node
+        kids = parent_kids
+        kids.append(node)
+        left -= 1
+
+  def generate_sql(self, dialect, fields, key, parser = None, parameterize = False):
+    """
+    `DSLParser.generate_sql` for the stored query `key`, serialized straight from its decoded AST
+
+    :param parser: The DSLParser whose dialects and operators to serialize with, a fresh one by default
+    """
+    parser = parser or _default_parser()
+    query = self[key]
+    serializer = parser.serializer.bind(dialect, fields)
+    if parameterize:
+      sql, params = serializer.serialize_query(query, parameterize=True)
+      return (f'"{sql}"', params)
+    return f'"{serializer.serialize_query(query)}"'
+
+
+_parser = None
+
+
+def _default_parser():
+  global _parser
+  if _parser is None:
+    _parser = DSLParser()
+  return _parser
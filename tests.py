@@ -1,5 +1,21 @@
+import contextlib
+import io
+import json
+import os
+import pickle
+import random
+import re
+import sqlite3
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dsl_parser import *
+from cache import NodeInterner, SubtreeMemo
+from evaluator import Evaluator, np
+from macros import MacroLibrary
+from optimizer import Optimizer
+from utils import reduce_macros
 
 FIELDS = {
   1: "id",
@@ -70,6 +86,1556 @@ class TestParser(unittest.TestCase):
         expected = '"SELECT TOP 20 * FROM data;"'
         self.assertEqual(res, expected)
 
+    def test_quotes_in_strings_are_escaped(self):
+        query = '{:where [:or [:= [:field 2] "x\' OR 1=1 --"] [:= [:field 2] "o\'brien" "a"]]}'
+        expected = '"SELECT * FROM data WHERE "name" = \'x\'\' OR 1=1 --\' OR "name" IN (\'o\'\'brien\', \'a\');"'
+        p = DSLParser(shape_cache_size=4)
+        for _ in range(2):
+            self.assertEqual(p.generate_sql('postgres', FIELDS, query), expected)
+        self.assertEqual(p.generate_sql(dialect='postgres', fields=FIELDS, query=query, stream=True), expected)
+        self.assertEqual(p.generate_sql_multi(['postgres'], FIELDS, query)['postgres'], expected)
+
+    def test_backslashes_are_escaped_for_mysql(self):
+        # MySQL reads \' as a quote, so the backslash has to be doubled for the literal to end where it should
+        query = r'{:where [:or [:= [:field 2] "x\\\' OR 1=1 -- "] [:= [:field 2] "a\\" "b"]]}'
+        expected = {
+            'postgres': '"SELECT * FROM data WHERE "name" = \'x\\\'\' OR 1=1 -- \' OR "name" IN (\'a\\\', \'b\');"',
+            'mysql': '"SELECT * FROM data WHERE `name` = \'x\\\\\'\' OR 1=1 -- \' OR `name` IN (\'a\\\\\', \'b\');"',
+        }
+        p = DSLParser(shape_cache_size=4)
+        for dialect, sql in expected.items():
+            for _ in range(2):
+                self.assertEqual(p.generate_sql(dialect, FIELDS, query), sql)
+            self.assertEqual(p.generate_sql(dialect=dialect, fields=FIELDS, query=query, stream=True), sql)
+        self.assertEqual(p.generate_sql_multi(list(expected), FIELDS, query), expected)
+        self.assertEqual(p.generate_sql('mysql', FIELDS, query, parameterize=True)[1], ("x\\\' OR 1=1 -- ", 'a\\', 'b'))
+
+    def test_string_escapes_are_decoded(self):
+        query = r'{:where [:= [:field 2] "a\"b\\c\u00e9"]}'
+        p = DSLParser(shape_cache_size=4)
+        for stream in (False, True, False):
+            self.assertEqual(p.generate_sql('postgres', FIELDS, query, stream=stream),
+                             '"SELECT * FROM data WHERE "name" = \'a"b\\cé\';"')
+            self.assertEqual(p.generate_sql('postgres', FIELDS, query, stream=stream, parameterize=True)[1], ('a"b\\cé',))
+        self.assertEqual(p.predicate(FIELDS, query)({'name': ['a"b\\cé', 'a\\"b\\\\c']}), [True, False])
+
+
+class TestTokenizer(unittest.TestCase):
+
+    def test_tokenize_folds_fields(self):
+        p = DSLParser()
+        res = p.tokenize('[:and [:< [:field 1] 5] [:= [:field 2] nil]]')
+        expected = [
+            ('DSL_OPEN_BRACKET', '['), ('DSL_OP', ':and'),
+            ('DSL_OPEN_BRACKET', '['), ('DSL_OP', ':<'), ('DSL_FIELD', '1'), ('DSL_LITERAL', '5'), ('DSL_CLOSE_BRACKET', ']'),
+            ('DSL_OPEN_BRACKET', '['), ('DSL_OP', ':='), ('DSL_FIELD', '2'), ('DSL_NIL', 'nil'), ('DSL_CLOSE_BRACKET', ']'),
+            ('DSL_CLOSE_BRACKET', ']'),
+        ]
+        self.assertEqual(res, expected)
+
+    def test_tokenize_positions(self):
+        p = DSLParser()
+        res = p.tokenize('[:> [:field 4] 35]', positions=True)
+        expected = [
+            ('DSL_OPEN_BRACKET', '[', 0, 1),
+            ('DSL_OP', ':>', 1, 3),
+            ('DSL_FIELD', '4', 4, 14),
+            ('DSL_LITERAL', '35', 15, 17),
+            ('DSL_CLOSE_BRACKET', ']', 17, 18),
+        ]
+        self.assertEqual(res, expected)
+
+    def test_tokenize_string_with_spaces(self):
+        p = DSLParser()
+        res = p.tokenize('[:= [:field 2] "joe smith"]')
+        self.assertEqual(res[3], ('DSL_LITERAL', '"joe smith"'))
+
+    def test_tokenize_braces_and_commas(self):
+        p = DSLParser()
+        res = p.tokenize('{:where [:= [:field 2] "a, b" c], :limit 5}')
+        self.assertEqual(res, [
+            ('DSL_OPEN_BRACE', '{'),
+            ('DSL_OP', ':where'),
+            ('DSL_OPEN_BRACKET', '['),
+            ('DSL_OP', ':='),
+            ('DSL_FIELD', '2'),
+            ('DSL_LITERAL', '"a, b"'),
+            ('DSL_LITERAL', 'c'),
+            ('DSL_CLOSE_BRACKET', ']'),
+            ('DSL_OP', ':limit'),
+            ('DSL_LITERAL', '5'),
+            ('DSL_CLOSE_BRACE', '}'),
+        ])
+        with self.assertRaises(SyntaxError):
+            p.parse_where(p.tokenize('[:= [:field 2] {]'))
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_iter_spans(self):
+        p = DSLParser()
+        raw = '[:= [:field 2] "cam"]'
+        res = [(t, raw[s:e]) for t, s, e in p.iter_spans(raw)]
+        self.assertEqual(res, p.tokenize(raw))
+
+    def test_stream_matches_list(self):
+        p = DSLParser()
+        queries = [
+            '{:where [:= [:field 3] nil]}',
+            '{:where [:and [:!= [:field 3] nil] [:or [:> [:field 4] 25] [:= [:field 2] "Jerry"]]]}',
+            '{:where [:= [:field 4] 25 26 27], :limit 3}',
+        ]
+        for q in queries:
+            self.assertEqual(p.generate_sql('postgres', FIELDS, q, stream=True), p.generate_sql('postgres', FIELDS, q))
+
+    def test_stream_literals_are_lazy(self):
+        p = DSLParser()
+        raw = '[:= [:field 2] "cam"]'
+        ast = p.parse_where(p.iter_spans(raw), source=raw)
+        self.assertIsInstance(ast.right.value, Span)
+        self.assertEqual(str(ast.right.value), '"cam"')
+
+
+class TestDeepNesting(unittest.TestCase):
+
+    def _chain(self, op, depth):
+        where = '[:= [:field 1] 0]'
+        for i in range(1, depth):
+            where = f'[{op} [:= [:field 1] {i}] {where}]'
+        return '{:where ' + where + '}'
+
+    def test_deep_and_chain(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query=self._chain(':and', 5000))
+        self.assertTrue(res.startswith('"SELECT * FROM data WHERE "id" = 4999 AND ("id" = 4998 AND ('))
+        self.assertEqual(res.count('"id" = '), 5000)
+
+    def test_deep_not_chain(self):
+        p = DSLParser()
+        query = '{:where ' + '[:not ' * 3000 + '[:= [:field 1] 0]' + ']' * 3000 + '}'
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query=query)
+        self.assertEqual(res.count('NOT'), 3000)
+
+    def test_single_arg_and(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:and [:> [:field 4] 35]]}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE "age" > 35;"')
+
+    def test_logical_arity(self):
+        p = DSLParser()
+        with self.assertRaises(SyntaxError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:or]}')
+        with self.assertRaises(SyntaxError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:not [:> [:field 4] 35] [:> [:field 4] 35]]}')
+        with self.assertRaises(SyntaxError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:not]}')
+
+
+class TestQueryCache(unittest.TestCase):
+
+    QUERY = '{:where [:= [:field 2] "cam"]}'
+
+    def test_cache_is_opt_in(self):
+        p = DSLParser()
+        self.assertIsNone(p.cache)
+
+    def test_cache_hit_miss(self):
+        p = DSLParser(cache_size=10)
+        first = p.generate_sql(dialect='postgres', fields=FIELDS, query=self.QUERY)
+        second = p.generate_sql(dialect='postgres', fields=FIELDS, query=self.QUERY)
+        self.assertEqual(first, second)
+        p.generate_sql(dialect='mysql', fields=FIELDS, query=self.QUERY)
+        p.generate_sql(dialect='postgres', fields={**FIELDS, 2: 'full_name'}, query=self.QUERY)
+        stats = p.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 3, 3))
+
+    def test_cache_lru_eviction(self):
+        p = DSLParser(cache_size=2)
+        for i in range(3):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query=f'{{:where [:= [:field 1] {i}]}}')
+        self.assertEqual(p.cache.stats()['evictions'], 1)
+        self.assertEqual(len(p.cache), 2)
+
+    def test_cache_bytes_bound(self):
+        p = DSLParser(cache_bytes=60)
+        p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:= [:field 1] 1]}')
+        p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:= [:field 1] 2]}')
+        self.assertEqual(len(p.cache), 1)
+        self.assertLessEqual(p.cache.stats()['bytes'], 60)
+
+    def test_cache_invalidated_by_registry_changes(self):
+        p = DSLParser(cache_size=10)
+        p.generate_sql(dialect='postgres', fields=FIELDS, query=self.QUERY)
+        p.add_dialect('test', {'field-delim': '_'})
+        self.assertEqual(len(p.cache), 0)
+        self.assertEqual(p.cache.stats()['invalidations'], 1)
+
+
+class TestASTCache(unittest.TestCase):
+
+    def test_dialect_switch_reuses_parse(self):
+        p = DSLParser(ast_cache_size=10)
+        query = '{:where [:= [:field 2] "cam"], :limit 10}'
+        pg = p.generate_sql(dialect='postgres', fields=FIELDS, query=query)
+        my = p.generate_sql(dialect='mysql', fields=FIELDS, query=query)
+        self.assertEqual(pg, '"SELECT * FROM data WHERE "name" = \'cam\' LIMIT 10;"')
+        self.assertEqual(my, '"SELECT * FROM data WHERE `name` = \'cam\' LIMIT 10;"')
+        stats = p.ast_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_subtrees_are_shared(self):
+        p = DSLParser(ast_cache_size=10)
+        a, _ = p.parse_query('{:where [:and [:= [:field 2] "joe"] [:> [:field 4] 3]]}')
+        b, _ = p.parse_query('{:where [:or [:< [:field 1] 5] [:= [:field 2] "joe"]]}', stream=True)
+        self.assertIs(a.left, b.right)
+        self.assertEqual(b.right.right.value, '"joe"')
+
+    def test_interner_drops_evicted_asts(self):
+        p = DSLParser()
+        live = []
+        interner = NodeInterner(live=lambda: live, min_prune=8)
+        for i in range(50):
+            live[:] = [interner.intern(p.parse_query('{:where [:> [:field 4] %d]}' % i)[0])]
+        self.assertLess(len(interner), 16)
+        self.assertIs(interner.intern(p.parse_query('{:where [:> [:field 4] 49]}')[0]), live[0])
+        self.assertIs(interner.intern(p.parse_query('{:where [:> [:field 1] 49]}')[0]).right, live[0].right)
+
+    def test_add_dialect_keeps_asts(self):
+        p = DSLParser(ast_cache_size=10)
+        p.parse_query('{:where [:= [:field 2] "joe"]}')
+        p.add_dialect('test', {'field-delim': '_'})
+        self.assertEqual(len(p.ast_cache), 1)
+
+
+class TestParameterized(unittest.TestCase):
+
+    QUERY = '{:where [:and [:= [:field 2] "joe"] [:or [:> [:field 4] 25] [:= [:field 1] 1 2.5 3]]]}'
+
+    def test_postgres_placeholders(self):
+        p = DSLParser()
+        sql, params = p.generate_sql(dialect='postgres', fields=FIELDS, query=self.QUERY, parameterize=True)
+        self.assertEqual(sql, '"SELECT * FROM data WHERE "name" = $1 AND ("age" > $2 OR "id" IN ($3, $4, $5));"')
+        self.assertEqual(params, ('joe', 25, 1, 2.5, 3))
+
+    def test_mysql_sqlserver_placeholders(self):
+        p = DSLParser()
+        sql, _ = p.generate_sql(dialect='mysql', fields=FIELDS, query='{:where [:= [:field 2] "joe"]}', parameterize=True)
+        self.assertEqual(sql, '"SELECT * FROM data WHERE `name` = %s;"')
+        sql, _ = p.generate_sql(dialect='sqlserver', fields=FIELDS, query='{:where [:< [:field 4] 3], :limit 5}', parameterize=True)
+        self.assertEqual(sql, '"SELECT TOP 5 * FROM data WHERE "age" < @p1;"')
+
+    def test_nil_is_not_a_param(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:!= [:field 3] nil]}', parameterize=True)
+        self.assertEqual(res, ('"SELECT * FROM data WHERE "date_joined" IS NOT NULL;"', ()))
+
+    def test_custom_dialect_placeholder(self):
+        p = DSLParser(cache_size=10)
+        p.add_dialect('test', {'placeholder': ':v{index}'})
+        sql, params = p.generate_sql(dialect='test', fields=FIELDS, query='{:where [:= [:field 2] "joe"]}', parameterize=True)
+        self.assertEqual((sql, params), ('"SELECT * FROM data WHERE "name" = :v1;"', ('joe',)))
+        self.assertEqual(p.generate_sql(dialect='test', fields=FIELDS, query='{:where [:= [:field 2] "joe"]}'), '"SELECT * FROM data WHERE "name" = \'joe\';"')
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def _optimize(self, where, **rewrites):
+        p = DSLParser()
+        ast, _ = p.parse_query('{:where ' + where + '}')
+        res = p.optimize(ast, **rewrites)
+        p.serializer.set_fields(FIELDS)
+        return p.serializer.postorder_ast(res.ast), res
+
+    def test_contradiction(self):
+        sql, res = self._optimize('[:and [:< [:field 4] 5] [:> [:field 4] 10]]')
+        self.assertTrue(res.always_false)
+        self.assertEqual(res.fired, {'contradictions': 1})
+        self.assertEqual(sql, '1 = 0')
+
+    def test_contradiction_flipped_and_eq(self):
+        _, res = self._optimize('[:and [:> 5 [:field 4]] [:= [:field 4] 7 8]]')
+        self.assertTrue(res.always_false)
+        _, res = self._optimize('[:and [:= [:field 2] "a"] [:is-empty [:field 2]]]')
+        self.assertTrue(res.always_false)
+        _, res = self._optimize('[:and [:>= [:field 4] 5] [:<= [:field 4] 5]]')
+        self.assertFalse(res.always_false)
+
+    def test_strings_follow_the_collation(self):
+        # Equal under case insensitive collations, e.g. MySQL's default
+        _, res = self._optimize('[:and [:= [:field 2] "a"] [:= [:field 2] "A"]]')
+        self.assertFalse(res.always_false)
+        _, res = self._optimize('[:and [:= [:field 2] "a" "b"] [:!= [:field 2] "a"] [:!= [:field 2] "b"]]')
+        self.assertTrue(res.always_false)
+
+    def test_mixed_types_are_not_contradictions(self):
+        _, res = self._optimize('[:and [:= [:field 4] "5"] [:= [:field 4] 5]]')
+        self.assertFalse(res.always_false)
+
+    def test_in_lists_with_fields_are_not_contradictions(self):
+        sql, res = self._optimize('[:and [:= [:field 1] 5 [:field 4]] [:= [:field 1] 7]]')
+        self.assertFalse(res.always_false)
+        self.assertEqual(sql, '"id" IN (5, "age") AND "id" = 7')
+        _, res = self._optimize('[:and [:!= [:field 1] 5 nil] [:= [:field 1] 5]]')
+        self.assertFalse(res.always_false)
+
+    def test_flatten_dedupe(self):
+        sql, res = self._optimize('[:and [:= [:field 1] 1] [:and [:= [:field 1] 1] [:> [:field 4] 3]]]')
+        self.assertEqual(sql, '"id" = 1 AND "age" > 3')
+        self.assertEqual(res.fired, {'flatten': 1, 'dedupe': 1})
+
+    def test_merge_in(self):
+        sql, res = self._optimize('[:or [:= [:field 1] 1] [:or [:= [:field 2] "x"] [:= [:field 1] 2 3]]]')
+        self.assertEqual(sql, '"id" IN (1, 2, 3) OR "name" = \'x\'')
+        self.assertEqual(res.fired['merge_in'], 1)
+
+    def test_merge_in_keeps_fields_and_literals_apart(self):
+        sql, _ = self._optimize('[:or [:= [:field 1] 2 3] [:= [:field 1] [:field 2] 4]]')
+        self.assertEqual(sql, '"id" IN (2, 3, "name", 4)')
+
+    def test_fold_not(self):
+        sql, res = self._optimize('[:not [:< [:field 4] 5]]')
+        self.assertEqual(sql, '"age" >= 5')
+        _, res = self._optimize('[:not [:not [:is-empty [:field 4]]]]')
+        self.assertEqual(res.ast.value, ':is-empty')
+
+    def test_contradictions_under_not_keep_nulls_out(self):
+        # [:and [:is-empty x] [:> x 5]] is never true but UNKNOWN rather than FALSE when x is NULL, so its
+        # negation must not become true
+        db = sqlite3.connect(':memory:')
+        db.execute('CREATE TABLE data (id, name, date_joined, age)')
+        db.executemany('INSERT INTO data VALUES (?, ?, ?, ?)', [(1, 'a', None, None), (2, 'b', None, 3), (3, 'c', None, 7)])
+        contradiction = '[:and [:is-empty [:field 4]] [:> [:field 4] 5]]'
+        p = DSLParser()
+        for where in ('[:not ' + contradiction + ']',
+                      '[:not [:or ' + contradiction + ' [:= [:field 1] 2]]]',
+                      '[:or ' + contradiction + ' [:not ' + contradiction + ']]'):
+            query = '{:where ' + where + ', :order-by [[:asc [:field 1]]]}'
+            rows = [db.execute(p.generate_sql('postgres', FIELDS, query, optimize=optimize)[1:-1]).fetchall()
+                    for optimize in (False, True)]
+            self.assertEqual(rows[1], rows[0], where)
+        # Still folded where the chain filters rows directly
+        sql, res = self._optimize('[:or ' + contradiction + ' [:= [:field 1] 2]]')
+        self.assertEqual(sql, '"id" = 2')
+        self.assertEqual(res.fired, {'contradictions': 1})
+
+    def test_rewrites_are_switchable(self):
+        sql, res = self._optimize('[:or [:= [:field 1] 1] [:= [:field 1] 2]]', merge_in=False)
+        self.assertEqual(sql, '"id" = 1 OR "id" = 2')
+        self.assertEqual(res.fired, {})
+        with self.assertRaises(ValueError):
+            Optimizer(unknown=True)
+
+    def test_does_not_mutate_input(self):
+        p = DSLParser()
+        ast, _ = p.parse_query('{:where [:or [:= [:field 1] 1] [:= [:field 1] 2]]}')
+        before = repr(ast)
+        p.optimize(ast)
+        self.assertEqual(repr(ast), before)
+
+    def test_generate_sql_optimize(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:and [:< [:field 4] 5] [:> [:field 4] 10]]}', optimize=True)
+        self.assertEqual(res, '"SELECT * FROM data WHERE 1 = 0;"')
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:and [:< [:field 4] 5] [:> [:field 4] 10]]}', optimize={'contradictions': False})
+        self.assertEqual(res, '"SELECT * FROM data WHERE "age" < 5 AND "age" > 10;"')
+
+
+class TestNaryNodes(unittest.TestCase):
+
+    def test_variadic_and_or(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:and [:= [:field 1] 1] [:= [:field 2] "a"] [:or [:< [:field 4] 3] [:> [:field 4] 9] [:= [:field 4] nil]]]}')
+        expected = '"SELECT * FROM data WHERE "id" = 1 AND "name" = \'a\' AND ("age" < 3 OR "age" > 9 OR "age" IS NULL);"'
+        self.assertEqual(res, expected)
+        ast, _ = p.parse_query('{:where [:and [:= [:field 1] 1] [:= [:field 1] 2] [:= [:field 1] 3]]}')
+        self.assertEqual(len(ast.children), 3)
+
+    def test_in_list_holds_literal_nodes(self):
+        p = DSLParser()
+        ast, _ = p.parse_query('{:where [:= [:field 2] "a" "b"]}')
+        self.assertEqual([c.type for c in ast.right.children], ['DSL_LITERAL', 'DSL_LITERAL'])
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:!= [:field 2] "a" "b"]}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE "name" NOT IN (\'a\', \'b\');"')
+
+    def test_is_empty(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:or [:is-empty [:field 2]] [:not-empty [:field 3]]]}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE "name" IS NULL OR "date_joined" IS NOT NULL;"')
+
+    def test_compact_nodes(self):
+        n = Node('DSL_LITERAL', '1')
+        self.assertFalse(hasattr(n, '__dict__'))
+        self.assertEqual(n.children, ())
+
+    def test_repr_deep_tree(self):
+        p = DSLParser()
+        ast, _ = p.parse_query('{:where ' + '[:not ' * 3000 + '[:= [:field 1] 0]' + ']' * 3000 + '}')
+        self.assertTrue(repr(ast).startswith('Node(DSL_OP,:not,[Node(DSL_OP,:not,['))
+        self.assertEqual(str(ast.children[0].children[0]), repr(ast.children[0].children[0]))
+
+    def test_variadic_custom_operator(self):
+        def parse_coalesce(dsl_parser):
+            args = []
+            arg = dsl_parser.parse_literal()
+            while arg is not None:
+                args.append(arg)
+                arg = dsl_parser.parse_literal()
+            return Node('DSL_OP', ':coalesce-eq', *args)
+
+        def serialize_coalesce(ast_serializer, node, *strs):
+            return f"COALESCE({', '.join(strs[:-1])}) = {strs[-1]}"
+
+        p = DSLParser()
+        p.add_operator(':coalesce-eq', parse_func=parse_coalesce, serialize_func=serialize_coalesce)
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:coalesce-eq [:field 1] [:field 4] 3]}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE COALESCE("id", "age") = 3;"')
+
+
+class TestBatch(unittest.TestCase):
+    def requests(self):
+        reqs = []
+        for i in range(40):
+            reqs.append(dict(dialect=['postgres', 'mysql', 'sqlserver'][i % 3], fields=FIELDS,
+                             query=f'{{:where [:= [:field 1] {i}], :limit {i + 1}}}'))
+        reqs.append(dict(dialect='oracle', fields=FIELDS, query='{:where [:= [:field 1] 1]}'))
+        return reqs
+
+    def check(self, p, results, reqs):
+        self.assertEqual(len(results), len(reqs))
+        for res, req in zip(results[:-1], reqs[:-1]):
+            self.assertIsNone(res.error)
+            self.assertEqual(res.result, DSLParser().generate_sql(**req))
+        self.assertIsNone(results[-1].result)
+        self.assertIsInstance(results[-1].error, Exception)
+
+    def test_sequential(self):
+        p = DSLParser()
+        reqs = self.requests()
+        self.check(p, p.generate_sql_many(reqs), reqs)
+
+    def test_thread_pool(self):
+        p = DSLParser(cache_size=16, ast_cache_size=16)
+        reqs = self.requests()
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            self.check(p, p.generate_sql_many(reqs, executor=ex, chunksize=1), reqs)
+
+    def test_process_pool(self):
+        p = DSLParser(cache_size=16)
+        reqs = self.requests()
+        with ProcessPoolExecutor(max_workers=2) as ex:
+            self.check(p, p.generate_sql_many(reqs, executor=ex), reqs)
+
+    def test_shared_parser_across_threads(self):
+        p = DSLParser(ast_cache_size=64)
+        barrier = threading.Barrier(4)
+
+        def work(dialect):
+            barrier.wait()
+            return [p.generate_sql(dialect=dialect, fields=FIELDS, query=f'{{:where [:!= [:field 2] {i}]}}')
+                    for i in range(200)]
+
+        dialects = ['postgres', 'mysql', 'sqlserver', 'postgres']
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            outs = list(ex.map(work, dialects))
+        for dialect, out in zip(dialects, outs):
+            expected = [DSLParser().generate_sql(dialect=dialect, fields=FIELDS, query=f'{{:where [:!= [:field 2] {i}]}}')
+                        for i in range(200)]
+            self.assertEqual(out, expected)
+
+
+class TestCLI(unittest.TestCase):
+    def records(self):
+        lines = []
+        for i in range(30):
+            lines.append(json.dumps({'id': i, 'dialect': ['postgres', 'mysql', 'sqlserver'][i % 3],
+                                     'fields': {'1': 'id', '4': 'age'},
+                                     'query': f'{{:where [:macro "m"], :limit {i + 1}}}',
+                                     'macros': {'m': f'[:> [:field 4] {i}]'}}))
+        lines.insert(5, '')
+        lines.insert(10, 'not json')
+        lines.append(json.dumps({'dialect': 'oracle', 'fields': {'1': 'id'}, 'query': '{:where [:= [:field 1] 1]}'}))
+        lines.append(json.dumps({'dialect': 'postgres', 'fields': {'1': 'id'}}))
+        return '\n'.join(lines) + '\n'
+
+    def check(self, out, summary):
+        rows = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(summary['records'], 33)
+        self.assertEqual(summary['errors'], 3)
+        self.assertEqual(len(rows), 33)
+        self.assertEqual([r['line'] for r in rows], sorted(r['line'] for r in rows))
+        self.assertNotIn(6, [r['line'] for r in rows])
+        self.assertEqual(rows[9]['error_type'], 'JSONDecodeError')
+        self.assertEqual(rows[-2]['error'], 'Unsupported dialect "oracle"')
+        self.assertEqual(rows[-1]['error'], 'Missing query')
+        ok = [r for r in rows if 'id' in r and 'sql' in r]
+        self.assertEqual([r['id'] for r in ok], list(range(30)))
+        for r in ok:
+            i = r['id']
+            expected = DSLParser().generate_sql(dialect=['postgres', 'mysql', 'sqlserver'][i % 3], fields={1: 'id', 4: 'age'},
+                                                query=f'{{:where [:> [:field 4] {i}], :limit {i + 1}}}')
+            self.assertEqual(f'"{r["sql"]}"', expected)
+
+    def test_in_process(self):
+        import cli
+        out = io.StringIO()
+        summary = cli.run(io.StringIO(self.records()), out, chunksize=4)
+        self.check(out.getvalue(), summary)
+
+    def test_process_pool_keeps_order(self):
+        import cli
+        out = io.StringIO()
+        summary = cli.run(io.StringIO(self.records()), out, jobs=2, chunksize=3)
+        self.check(out.getvalue(), summary)
+
+    def test_main(self):
+        import cli
+        with tempfile.TemporaryDirectory() as d:
+            src, dst, dialects = (os.path.join(d, n) for n in ('in.jsonl', 'out.jsonl', 'dialects.json'))
+            with open(src, 'w') as f:
+                f.write(json.dumps({'dialect': 'postgres', 'fields': {'2': 'name'}, 'query': '{:where [:= [:field 2] "x"]}',
+                                    'parameterize': True}) + '\n')
+            with open(dialects, 'w') as f:
+                json.dump({'brackets': {'field-delim': '|', 'placeholder': ':{index}'}}, f)
+            self.assertEqual(cli.main([src, '-o', dst, '--dialect', 'brackets', '--dialects', dialects, '-q']), 0)
+            with open(dst) as f:
+                self.assertEqual(json.loads(f.read()), {'line': 1, 'params': ['x'], 'sql': 'SELECT * FROM data WHERE |name| = :1;'})
+
+
+class TestMacros(unittest.TestCase):
+    MACROS = {
+        'outer_and': '[:and [:macro "inner_lt"] [:macro "inner_eq"]]',
+        'inner_lt': '[:< [:field 1] 5]',
+        'inner_eq': '[:= [:field 2] "joe"]',
+    }
+
+    def test_dict_macros(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:macro "outer_and"]}', macros=self.MACROS)
+        self.assertEqual(res, '"SELECT * FROM data WHERE "id" < 5 AND "name" = \'joe\';"')
+
+    def test_splices_shared_subtrees(self):
+        lib = MacroLibrary(self.MACROS)
+        p = DSLParser()
+        ast, _ = p.parse_query('{:where [:or [:macro "outer_and"] [:not [:macro "outer_and"]]]}', macros=lib)
+        self.assertIs(ast.children[0], lib.resolve('outer_and'))
+        self.assertIs(ast.children[1].children[0], ast.children[0])
+        self.assertIs(ast.children[0].children[0], lib.resolve('inner_lt'))
+        res = p.generate_sql(dialect='mysql', fields=FIELDS, query='{:where [:not [:macro "outer_and"]]}', macros=lib)
+        self.assertEqual(res, '"SELECT * FROM data WHERE NOT (`id` < 5 AND `name` = \'joe\');"')
+
+    def test_cycle(self):
+        with self.assertRaises(RuntimeError):
+            MacroLibrary({'a': '[:macro "b"]', 'b': '[:and [:macro "c"] [:macro "a"]]', 'c': '[:= [:field 1] 1]'})
+        lib = MacroLibrary(self.MACROS)
+        with self.assertRaises(RuntimeError):
+            lib.set('inner_eq', '[:not [:macro "outer_and"]]')
+        with self.assertRaises(RuntimeError):
+            lib.set('inner_eq', '[:not [:macro "inner_eq"]]')
+        self.assertEqual(lib['inner_eq'], self.MACROS['inner_eq'])
+        p = DSLParser()
+        with self.assertRaises(RuntimeError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:macro "a"]}',
+                           macros={'a': '[:not [:macro "b"]]', 'b': '[:or [:macro "a"] [:= [:field 1] 1]]'})
+
+    def test_unknown_macro(self):
+        p = DSLParser()
+        with self.assertRaises(SyntaxError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:macro "nope"]}', macros=self.MACROS)
+        with self.assertRaises(SyntaxError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:macro "nope"]}')
+
+    def test_incremental_update(self):
+        lib = MacroLibrary(self.MACROS)
+        p = DSLParser(cache_size=16, ast_cache_size=16)
+        query = '{:where [:macro "outer_and"]}'
+        before = p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=lib)
+        eq = lib.resolve('inner_eq')
+        fp = lib.fingerprint
+
+        lib.set('inner_lt', '[:> [:field 1] 9]')
+        self.assertNotEqual(lib.fingerprint, fp)
+        self.assertIs(lib.resolve('inner_eq'), eq)
+        after = p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=lib)
+        self.assertEqual(after, '"SELECT * FROM data WHERE "id" > 9 AND "name" = \'joe\';"')
+
+        lib.set('inner_lt', self.MACROS['inner_lt'])
+        self.assertEqual(lib.fingerprint, fp)
+        self.assertEqual(p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=lib), before)
+
+        lib.remove('inner_lt')
+        with self.assertRaises(SyntaxError):
+            lib.resolve('outer_and')
+
+    def test_fingerprint_is_order_independent(self):
+        reordered = dict(reversed(list(self.MACROS.items())))
+        self.assertEqual(MacroLibrary(self.MACROS).fingerprint, MacroLibrary(reordered).fingerprint)
+
+    def test_deep_macro_chain(self):
+        chain = {f'm{i}': f'[:and [:= [:field 1] {i}] [:macro "m{i + 1}"]]' for i in range(3000)}
+        chain['m3000'] = '[:= [:field 4] 0]'
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:macro "m0"]}', macros=MacroLibrary(chain))
+        self.assertEqual(res.count('"id" = '), 3000)
+        self.assertTrue(res.endswith('"id" = 2999 AND "age" = 0' + ')' * 2999 + ';"'))
+
+
+class TestMacroExpansion(unittest.TestCase):
+    MACROS = {
+        'a': '[:or [:= [:field 1] 1] [:> [:field 4] 3]]',
+        'b': '[:and [:macro "a"] [:not [:macro "a"]] [:= [:field 2] "x"]]',
+    }
+
+    @staticmethod
+    def diamonds(n):
+        chain = {f'd{i}': f'[:or [:= [:field 1] {i}] [:and [:macro "d{i + 1}"] [:not [:macro "d{i + 1}"]]]]' for i in range(n)}
+        chain[f'd{n}'] = '[:= [:field 4] 0]'
+        return chain
+
+    @staticmethod
+    def expansion(lib, where, shared=False):
+        # The figures of the where-clause itself come from parsing it, as in `parse_query`
+        p = DSLParser()
+        ctx = ParseContext(p, p.scan(where), macros=lib)
+        ctx.parse_where()
+        return lib.expansion(len(where) - ctx.macro_chars, ctx.nodes, ctx.macro_refs, shared)
+
+    def test_expansion_matches_text_substitution(self):
+        lib = MacroLibrary(self.MACROS)
+        where = '[:or [:macro "b"] [:macro "b"] [:macro "a"]]'
+        expanded = reduce_macros(where, self.MACROS)
+        size, nodes, depth = self.expansion(lib, where)
+        self.assertEqual(size, len(expanded))
+        self.assertEqual(depth, 2)
+        ast, _ = DSLParser().parse_query('{:where ' + expanded + '}')
+        self.assertEqual(nodes, len(re.findall(r'Node\(', repr(ast))))
+
+    def test_parsing_collects_the_figures(self):
+        # No rescan of the where-clause, the figures come from the same pass that parses it, in both modes
+        where = '[:or [:macro "b"] [:= [:field 2] "x" "y"] [:macro "a"]]'
+        expanded = reduce_macros(where, self.MACROS)
+        for stream in (False, True):
+            p = DSLParser()
+            listener = RecordingListener()
+            p.add_listener(listener)
+            p.parse_query('{:where ' + where + ', :limit 5}', self.MACROS, stream=stream)
+            stats = listener.events[0].stats
+            self.assertEqual((stats['macro_size'], stats['macro_depth']), (len(expanded), 2))
+            brackets = ('DSL_OPEN_BRACKET', 'DSL_CLOSE_BRACKET')
+            self.assertEqual(stats['macro_nodes'], sum(t[0] not in brackets for t in p.scan(expanded)))
+
+    def test_limits(self):
+        p = DSLParser()
+        query = '{:where [:macro "d0"]}'
+        with self.assertRaises(RuntimeError) as cm:
+            p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=self.diamonds(60))
+        self.assertIn('max_size', str(cm.exception))
+        with self.assertRaises(RuntimeError):
+            p.parse_query(query, MacroLibrary(self.diamonds(10), max_size=None, max_nodes=100))
+        with self.assertRaises(RuntimeError):
+            p.parse_query(query, MacroLibrary(self.diamonds(10), max_depth=5))
+        p.parse_query(query, MacroLibrary(self.diamonds(10), max_depth=11))
+
+    def test_limits_follow_updates(self):
+        lib = MacroLibrary(self.diamonds(10), max_nodes=10000)
+        p = DSLParser()
+        p.parse_query('{:where [:macro "d0"]}', lib)
+        lib.set('d10', '[:and ' + '[:= [:field 4] 0] ' * 20 + ']')
+        with self.assertRaises(RuntimeError):
+            p.parse_query('{:where [:macro "d0"]}', lib)
+
+    def test_shared_subexpressions(self):
+        p = DSLParser()
+        query = '{:where [:or [:macro "b"] [:macro "b"] [:macro "a"]], :limit 3}'
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=self.MACROS, shared=True)
+        self.assertEqual(res, '"SELECT data.* FROM data '
+                              'CROSS JOIN LATERAL (SELECT ("id" = 1 OR "age" > 3) AS p) AS _s1 '
+                              'CROSS JOIN LATERAL (SELECT ((_s1.p) AND NOT (_s1.p) AND "name" = \'x\') AS p) AS _s2 '
+                              'WHERE (_s2.p) OR (_s2.p) OR (_s1.p) LIMIT 3;"')
+        res = p.generate_sql(dialect='sqlserver', fields=FIELDS, query='{:where [:and [:macro "a"] [:not [:macro "a"]]]}',
+                             macros=self.MACROS, shared=True, parameterize=True)
+        self.assertEqual(res, ('"SELECT data.* FROM data CROSS APPLY (SELECT CASE WHEN "id" = @p1 OR "age" > @p2 THEN 1 '
+                               'WHEN NOT ("id" = @p1 OR "age" > @p2) THEN 0 END AS p) AS _s1 '
+                               'WHERE (_s1.p = 1) AND NOT (_s1.p = 1);"', (1, 3)))
+
+    def test_shared_is_linear(self):
+        p = DSLParser()
+        lib = MacroLibrary(self.diamonds(200), max_size=None, max_nodes=None)
+        res = p.generate_sql(dialect='mysql', fields=FIELDS, query='{:where [:macro "d0"]}', macros=lib, shared=True)
+        self.assertEqual(res.count('CROSS JOIN LATERAL'), 200)
+        self.assertLess(len(res), 200 * 120)
+
+    def test_shared_limits_count_each_macro_once(self):
+        p = DSLParser(ast_cache_size=8)
+        lib = MacroLibrary(self.diamonds(60))
+        query = '{:where [:macro "d0"]}'
+        self.assertEqual(self.expansion(lib, '[:macro "d0"]', shared=True)[2], 61)
+        self.assertLess(self.expansion(lib, '[:macro "d0"]', shared=True)[0], 61 * 80)
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=lib, shared=True)
+        self.assertEqual(res.count('CROSS JOIN LATERAL'), 60)
+        # A query parsed for shared output isn't let through uninlined later on
+        with self.assertRaisesRegex(RuntimeError, 'max_size'):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=lib)
+        with self.assertRaisesRegex(RuntimeError, 'max_depth'):
+            DSLParser().generate_sql(dialect='postgres', fields=FIELDS, query=query, macros=MacroLibrary(self.diamonds(60), max_depth=10),
+                                     shared=True)
+
+    def test_nothing_shared(self):
+        p = DSLParser()
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:macro "a"]}', macros=self.MACROS, shared=True)
+        self.assertEqual(res, '"SELECT * FROM data WHERE "id" = 1 OR "age" > 3;"')
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_workloads_compile(self):
+        import benchmarks
+        p = DSLParser()
+        for name, (where, macros) in benchmarks.stage_workloads().items():
+            stages = benchmarks.stage_funcs(p, where, macros)
+            self.assertEqual(list(stages), ['tokenize', 'parse', 'macros', 'serialize'] if macros
+                             else ['tokenize', 'parse', 'serialize'], name)
+            self.assertTrue(p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where ' + where + '}', macros=macros or {}))
+
+    def test_compare_flags_regressions(self):
+        import benchmarks
+        m = lambda p50, kb: {'p50_us': p50, 'peak_kb': kb}
+        base = {'results': {'w': {'parse': m(100.0, 10.0), 'tokenize': m(1.0, 10.0)}}}
+        run = {'results': {'w': {'parse': m(200.0, 10.0), 'tokenize': m(1.9, 10.0)}, 'new': {'parse': m(1.0, 1.0)}}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            regressions = benchmarks.compare_runs(base, run, threshold=1.25)
+        self.assertEqual([r[:3] for r in regressions], [('w', 'parse', 'p50_us')])
+
+
+class RecordingListener(CompileListener):
+    def __init__(self):
+        self.calls = []
+        self.events = []
+
+    def stage_start(self, event, stage):
+        self.calls.append(('start', stage))
+
+    def stage_end(self, event, stage, elapsed):
+        self.calls.append(('end', stage))
+
+    def compile_end(self, event):
+        self.events.append(event)
+
+
+class TestInstrumentation(unittest.TestCase):
+    QUERY = '{:where [:and [:macro "a"] [:= [:field 2] "x" "y"]], :limit 5}'
+    MACROS = {'a': '[:< [:field 4] 3]'}
+
+    def test_stages_and_stats(self):
+        p = DSLParser(cache_size=8)
+        listener = RecordingListener()
+        p.add_listener(listener)
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query=self.QUERY, macros=self.MACROS, optimize=True)
+        stages = ['tokenize', 'parse', 'macros', 'optimize', 'serialize']
+        self.assertEqual(listener.calls, [(x, s) for s in stages for x in ('start', 'end')])
+        event = listener.events[0]
+        self.assertEqual((event.kind, event.dialect, event.error), ('generate_sql', 'postgres', None))
+        self.assertEqual(list(event.stages), stages)
+        self.assertGreaterEqual(event.elapsed, sum(event.stages.values()))
+        self.assertEqual(event.stats['tokens'], 18)
+        self.assertEqual(event.stats['nodes'], 9)
+        self.assertEqual(event.stats['macro_size'], len(self.QUERY) - len('{:where , :limit 5}') + len(self.MACROS['a']) - len('[:macro "a"]'))
+        self.assertEqual(event.stats['sql_length'], len(res))
+        self.assertEqual(event.stats['cache'], 'miss')
+        self.assertEqual(event.stats['fired'], {})
+
+        p.generate_sql(dialect='postgres', fields=FIELDS, query=self.QUERY, macros=self.MACROS, optimize=True)
+        self.assertEqual(listener.events[1].stages, {})
+        self.assertEqual(listener.events[1].stats, {'cache': 'hit'})
+
+    def test_stream_counts_tokens(self):
+        p = DSLParser()
+        listener = RecordingListener()
+        p.add_listener(listener)
+        p.parse_query('{:where [:= [:field 2] "x" "y"]}', stream=True)
+        event = listener.events[0]
+        self.assertEqual(event.kind, 'parse_query')
+        self.assertEqual(list(event.stages), ['parse'])
+        self.assertEqual(event.stats['tokens'], 9)
+
+    def test_errors_and_removal(self):
+        p = DSLParser()
+        listener = RecordingListener()
+        p.add_listener(listener)
+        with self.assertRaises(SyntaxError):
+            p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:foo [:field 2] 1]}')
+        self.assertIsInstance(listener.events[0].error, SyntaxError)
+        self.assertNotIn('parse', listener.events[0].stages)
+        p.remove_listener(listener)
+        p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:= [:field 2] 1]}')
+        self.assertEqual(len(listener.events), 1)
+
+    def test_aggregator(self):
+        from metrics import MetricsAggregator
+        p = DSLParser(ast_cache_size=8)
+        metrics = MetricsAggregator()
+        p.add_listener(metrics)
+        for _ in range(3):
+            p.generate_sql(dialect='mysql', fields=FIELDS, query=self.QUERY, macros=self.MACROS)
+        with self.assertRaises(RuntimeError):
+            p.generate_sql(dialect='nope', fields=FIELDS, query=self.QUERY, macros=self.MACROS)
+        snap = metrics.snapshot()
+        self.assertEqual(snap['counters'], {'compiles.generate_sql': 4, 'errors.generate_sql': 1,
+                                            'ast_cache.miss': 1, 'ast_cache.hit': 3})
+        self.assertEqual(snap['histograms']['latency.total']['count'], 4)
+        self.assertEqual(snap['histograms']['latency.parse']['count'], 1)
+        self.assertEqual(snap['histograms']['sql_length']['count'], 3)
+        self.assertIsNotNone(metrics.percentile('latency.serialize', 0.99))
+        text = metrics.render_prometheus()
+        self.assertIn('dsl_parser_compiles_total{kind="generate_sql"} 4', text)
+        self.assertIn('dsl_parser_latency_seconds_count{stage="serialize"} 3', text)
+        self.assertEqual(text.count('# TYPE dsl_parser_latency_seconds histogram'), 1)
+
+
+    def test_fired_rewrites(self):
+        from metrics import MetricsAggregator
+        p = DSLParser()
+        listener = RecordingListener()
+        metrics = MetricsAggregator()
+        p.add_listener(listener)
+        p.add_listener(metrics)
+        query = '{:where [:or [:= [:field 1] 1] [:= [:field 1] 2] [:not [:< [:field 4] 5]]]}'
+        p.generate_sql(dialect='postgres', fields=FIELDS, query=query, optimize=True)
+        p.generate_sql_multi(['postgres', 'mysql'], FIELDS, query, optimize={'merge_in': False})
+        self.assertEqual([e.stats['fired'] for e in listener.events], [{'merge_in': 1, 'fold_not': 1}, {'fold_not': 1}])
+        counters = metrics.snapshot()['counters']
+        self.assertEqual((counters['rewrites.merge_in'], counters['rewrites.fold_not']), (1, 2))
+
+
+class TestDialect(unittest.TestCase):
+    def test_immutable(self):
+        d = DSLParser().serializer.dialects['postgres']
+        with self.assertRaises(AttributeError):
+            d.neq = '!='
+        with self.assertRaises(TypeError):
+            d.rules['neq'] = '!='
+        self.assertEqual(d.neq, ' <> ')
+
+    def test_custom_dialect_defaults(self):
+        p = DSLParser()
+        p.add_dialect('test', {'neq': '%', 'field-delim': '_'})
+        d = p.serializer.dialects['test']
+        self.assertEqual(d.rules['placeholder'], '?')
+        self.assertEqual(p.serializer.dialect_rules['test']['neq'], '%')
+        res = p.generate_sql(dialect='test', fields=FIELDS, query='{:where [:or [:!= [:field 3] "2015-11-01"] [:= [:field 1] 456]]}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE _date_joined_ % \'2015-11-01\' OR _id_ = 456;"')
+
+    def test_template_drops_empty_parts(self):
+        p = DSLParser()
+        p.add_dialect('padded', {'template': 'SELECT  {columns}  FROM data {join_str}   {where_str} {limit_str}'})
+        self.assertEqual(p.generate_sql(dialect='padded', fields=FIELDS, query='{:limit 2}'), '"SELECT * FROM data LIMIT 2;"')
+        res = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:not [:= [:field 2] "a  b"]]}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE NOT "name" = \'a  b\';"')
+
+    def test_identifier_table_is_reused(self):
+        s = DSLParser().serializer
+        fields = {1: 'id', 2: 'we"ird'}
+        a = s.bind('postgres', fields)
+        b = s.bind('postgres', fields)
+        self.assertIs(a._quoted, b._quoted)
+        self.assertEqual(a._quoted, {'1': '"id"', '2': '"we""ird"'})
+        self.assertIsNot(s.bind('mysql', fields)._quoted, a._quoted)
+        self.assertIs(s.bind('postgres', dict(fields))._quoted, a._quoted)
+        self.assertIsNot(s.bind('postgres', {**fields, 2: 'other'})._quoted, a._quoted)
+
+    def test_unknown_fields_rejected_at_parse(self):
+        p = DSLParser(ast_cache_size=8)
+        query = '{:where [:and [:= [:field 9] 1] [:macro "m"]]}'
+        macros = {'m': '[:< [:field 7] 1]'}
+        with self.assertRaises(SyntaxError) as cm:
+            p.generate_sql(dialect='mysql', fields=FIELDS, query=query, macros=macros)
+        self.assertEqual(str(cm.exception), 'Unknown field id(s) 7, 9')
+        with self.assertRaises(SyntaxError):
+            p.parse_query(query, macros, fields=FIELDS)
+        ast, _ = p.parse_query(query, macros)
+        self.assertEqual(ast.children[1].children[0].value, '7')
+        res = p.generate_sql(dialect='mysql', fields={7: 'a', 9: 'b'}, query=query, macros=macros)
+        self.assertEqual(res, '"SELECT * FROM data WHERE `b` = 1 AND `a` < 1;"')
+
+    def test_field_ids_are_normalized(self):
+        p = DSLParser()
+        self.assertEqual(p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:= [:field 004] 1]}'),
+                         '"SELECT * FROM data WHERE "age" = 1;"')
+
+    def test_fields_edited_in_place(self):
+        fields = dict(FIELDS)
+        query = '{:where [:= [:field 2] "joe"]}'
+        self.assertEqual(DSLParser().generate_sql('postgres', fields, query), '"SELECT * FROM data WHERE "name" = \'joe\';"')
+        fields[2] = 'full_name'
+        self.assertEqual(DSLParser().generate_sql('postgres', fields, query), '"SELECT * FROM data WHERE "full_name" = \'joe\';"')
+
+
+class UpperCaseSerializer(ASTSerializer):
+    def serialize_literal(self, node):
+        return super().serialize_literal(node).upper()
+
+
+class TestRegistry(unittest.TestCase):
+    QUERY = '{:where [:and [:= [:field 2] "a"] [:like [:field 2] "b%"]]}'
+
+    @staticmethod
+    def parse_like(ctx):
+        return Node('DSL_OP', ':like', ctx.parse_field(), ctx.parse_literal())
+
+    @staticmethod
+    def serialize_like(serializer, node, l, r):
+        return f'{l} LIKE {r}'
+
+    def test_shared_by_default(self):
+        a, b = DSLParser(), DSLParser(cache_size=4)
+        self.assertIs(a.registry, Registry.builtin())
+        self.assertIs(a.registry, b.registry)
+        self.assertIs(a.serializer.operator_to_str_map, b.serializer.operator_to_str_map)
+        self.assertIs(a.operators, a.registry.parse_operators)
+
+    def test_immutable(self):
+        r = Registry.builtin()
+        with self.assertRaises(AttributeError):
+            r.dialects = {}
+        with self.assertRaises(TypeError):
+            r.operator_to_str_map[':like'] = self.serialize_like
+        with self.assertRaises(TypeError):
+            r.parse_operators[':like'] = self.parse_like
+
+    def test_extending_copies(self):
+        p, other = DSLParser(), DSLParser()
+        p.add_operator(':like', self.parse_like, self.serialize_like)
+        p.add_dialect('test', {'neq': '!='})
+        self.assertIsNot(p.registry, other.registry)
+        self.assertIs(other.registry, Registry.builtin())
+        self.assertNotIn(':like', Registry.builtin().parse_operators)
+        self.assertNotIn('test', Registry.builtin().dialects)
+        self.assertEqual(p.serializer.added_operators, {':like'})
+        self.assertEqual(p.generate_sql('test', FIELDS, self.QUERY), '"SELECT * FROM data WHERE "name" = \'a\' AND "name" LIKE \'b%\';"')
+        with self.assertRaises(SyntaxError):
+            other.generate_sql('postgres', FIELDS, self.QUERY)
+        with self.assertRaisesRegex(Exception, 'DSLOperator operator exists'):
+            p.add_operator(':like', self.parse_like, self.serialize_like)
+        with self.assertRaisesRegex(Exception, 'ASTSerializer operator exists'):
+            p.serializer.add_operator(':=', self.serialize_like)
+        with self.assertRaises(RuntimeWarning):
+            p.add_dialect('postgres', {})
+
+    def test_shared_custom_registry(self):
+        registry = Registry.builtin().with_operator(':like', self.parse_like, self.serialize_like)
+        parsers = [DSLParser(registry=registry) for _ in range(3)]
+        self.assertTrue(all(p.registry is registry for p in parsers))
+        self.assertEqual(len({p.generate_sql('mysql', FIELDS, self.QUERY) for p in parsers}), 1)
+
+    def test_pickle(self):
+        self.assertIs(pickle.loads(pickle.dumps(Registry.builtin())), Registry.builtin())
+        p = DSLParser()
+        p.add_operator(':like', TestRegistry.parse_like, TestRegistry.serialize_like)
+        copy = pickle.loads(pickle.dumps(p))
+        self.assertEqual(copy.generate_sql('postgres', FIELDS, self.QUERY), p.generate_sql('postgres', FIELDS, self.QUERY))
+        self.assertIs(pickle.loads(pickle.dumps(DSLParser())).registry, Registry.builtin())
+
+    def test_serializer_subclass_keeps_overrides(self):
+        s = UpperCaseSerializer()
+        self.assertIs(s.registry, Registry.builtin(UpperCaseSerializer))
+        self.assertIsNot(s.registry, Registry.builtin())
+        ast, _ = DSLParser().parse_query('{:where [:= [:field 2] "abc"]}')
+        self.assertEqual(s.bind('postgres', FIELDS).serialize_ast(ast), 'SELECT * FROM data WHERE "name" = \'ABC\';')
+
+
+class TestOperatorSpec(unittest.TestCase):
+    SPECS = (
+        OperatorSpec(':between', ('field', 'literal', 'literal'), '{0} BETWEEN {1} AND {2}'),
+        OperatorSpec(':starts-with', ('field', 'literal'), "{0} LIKE {1} || '%'", {'mysql': "{0} LIKE CONCAT({1}, '%')"}),
+        OperatorSpec(':coalesce-eq', ('value', 'value'), 'COALESCE({rest}) = {0}', variadic=True),
+        OperatorSpec(':none-of', ('where',), 'NOT ({args})', {'mysql': 'NOT {0}'}, variadic=True),
+    )
+
+    def parser(self):
+        p = DSLParser()
+        p.add_operators(*self.SPECS)
+        return p
+
+    def test_templates(self):
+        p = self.parser()
+        cases = [
+            ('[:between [:field 4] 18 30]', '"age" BETWEEN 18 AND 30', '`age` BETWEEN 18 AND 30'),
+            ('[:starts-with [:field 2] "ab"]', '"name" LIKE \'ab\' || \'%\'', "`name` LIKE CONCAT('ab', '%')"),
+            ('[:coalesce-eq 3 [:field 1] [:field 4] nil]', 'COALESCE("id", "age", NULL) = 3', 'COALESCE(`id`, `age`, NULL) = 3'),
+            ('[:none-of [:or [:= [:field 1] 1] [:= [:field 1] 2]]]', 'NOT (("id" = 1 OR "id" = 2))', 'NOT (`id` = 1 OR `id` = 2)'),
+        ]
+        for where, postgres, mysql in cases:
+            query = '{:where ' + where + '}'
+            self.assertEqual(p.generate_sql('postgres', FIELDS, query), f'"SELECT * FROM data WHERE {postgres};"')
+            self.assertEqual(p.generate_sql('mysql', FIELDS, query), f'"SELECT * FROM data WHERE {mysql};"')
+
+    def test_dispatched_like_builtins(self):
+        p = self.parser()
+        spec = self.SPECS[0]
+        self.assertEqual(p.operators[':between'], spec.parse)
+        self.assertEqual(p.serializer.operator_to_str_map[':between'], spec.serialize)
+        self.assertEqual(p.serializer.added_operators, {s.op_id for s in self.SPECS})
+        ast, _ = p.parse_query('{:where [:between [:field 4] 18 30]}')
+        self.assertEqual(tuple(p.serializer.bind('postgres', FIELDS).serialize_op(ast)), (ast.left, ' BETWEEN ', ast.children[1], ' AND ', ast.children[2]))
+
+    def test_parameterized_and_nested(self):
+        p = self.parser()
+        query = '{:where [:and [:between [:field 4] 18 30] [:none-of [:starts-with [:field 2] "a"] [:= [:field 1] 5]]]}'
+        self.assertEqual(p.generate_sql('postgres', FIELDS, query, parameterize=True),
+                         ('"SELECT * FROM data WHERE "age" BETWEEN $1 AND $2 AND NOT ("name" LIKE $3 || \'%\', "id" = $4);"', (18, 30, 'a', 5)))
+
+    def test_parse_errors(self):
+        p = self.parser()
+        for where, msg in (('[:between [:field 4] 18]', r'Expected 3 arg\(s\) to ":between" \(field, literal, literal\)'),
+                           ('[:between 4 18 30]', 'Expected 3 arg'),
+                           ('[:between [:field 4] 18 [:field 1]]', 'Expected 3 arg'),
+                           ('[:coalesce-eq 3]', r'Expected 2\+ arg'),
+                           ('[:between [:field 4] 18 30 40]', 'DSL_CLOSE_BRACKET')):
+            with self.assertRaisesRegex(SyntaxError, msg):
+                p.parse_query('{:where ' + where + '}')
+
+    def test_invalid_specs(self):
+        for args, template, variadic in ((('field',), '{1}', False), (('field',), '{rest}', False), (('field',), '{x}', False),
+                                         (('column',), '{0}', False), ((), 'TRUE', False)):
+            with self.assertRaises(RuntimeError):
+                OperatorSpec(':op', args, template, variadic=variadic)
+        with self.assertRaisesRegex(Exception, 'DSLOperator operator exists'):
+            DSLParser().add_operators(OperatorSpec(':=', ('field', 'value'), '{0} = {1}'))
+
+    def test_pickle(self):
+        p = self.parser()
+        copy = pickle.loads(pickle.dumps(p))
+        query = '{:where [:starts-with [:field 2] "ab"]}'
+        self.assertEqual(copy.generate_sql('mysql', FIELDS, query), p.generate_sql('mysql', FIELDS, query))
+
+
+class TestQueryClauses(unittest.TestCase):
+    QUERY = ('{:where [:= [:field 2] "smith, joe"], :fields [[:field 1] [:field 2]], '
+             ':order-by [[:desc [:field 4]] [:asc [:field 1]]], :limit 10, :offset 20}')
+
+    def test_parse(self):
+        p = DSLParser()
+        q = p.parse(self.QUERY)
+        self.assertEqual((q.limit, q.offset), (10, 20))
+        self.assertEqual([(f.value, d) for f, d in q.order_by], [('4', 'DESC'), ('1', 'ASC')])
+        self.assertEqual([f.value for f in q.fields], ['1', '2'])
+        self.assertEqual(q.where.right.value, '"smith, joe"')
+        self.assertEqual(repr(p.parse(self.QUERY, stream=True)), repr(q))
+        self.assertEqual(p.parse('{}'), Query())
+
+    def test_commas_and_order_are_free(self):
+        p = DSLParser()
+        a = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:limit 3 :where [:= [:field 2] "a,b"]}')
+        b = p.generate_sql(dialect='postgres', fields=FIELDS, query='{:where [:= [:field 2] "a,b"],, :limit 3,}')
+        self.assertEqual(a, b)
+        self.assertEqual(a, '"SELECT * FROM data WHERE "name" = \'a,b\' LIMIT 3;"')
+
+    def test_dialects(self):
+        p = DSLParser()
+        expected = {
+            'postgres': '"SELECT "id", "name" FROM data WHERE "name" = \'smith, joe\' ORDER BY "age" DESC, "id" ASC LIMIT 10 OFFSET 20;"',
+            'mysql': '"SELECT `id`, `name` FROM data WHERE `name` = \'smith, joe\' ORDER BY `age` DESC, `id` ASC LIMIT 10 OFFSET 20;"',
+            'sqlserver': '"SELECT "id", "name" FROM data WHERE "name" = \'smith, joe\' ORDER BY "age" DESC, "id" ASC OFFSET 20 ROWS FETCH NEXT 10 ROWS ONLY;"',
+        }
+        for dialect, sql in expected.items():
+            self.assertEqual(p.generate_sql(dialect=dialect, fields=FIELDS, query=self.QUERY), sql)
+
+    def test_offset_without_limit(self):
+        p = DSLParser()
+        expected = {
+            'postgres': '"SELECT * FROM data OFFSET 5;"',
+            'mysql': '"SELECT * FROM data LIMIT 18446744073709551615 OFFSET 5;"',
+            'sqlserver': '"SELECT * FROM data ORDER BY (SELECT NULL) OFFSET 5 ROWS;"',
+        }
+        for dialect, sql in expected.items():
+            self.assertEqual(p.generate_sql(dialect=dialect, fields=FIELDS, query='{:offset 5}'), sql)
+        res = p.generate_sql(dialect='sqlserver', fields=FIELDS, query='{:limit 5 :order-by [[:asc [:field 3]]]}')
+        self.assertEqual(res, '"SELECT TOP 5 * FROM data ORDER BY "date_joined" ASC;"')
+
+    def test_template_without_clause(self):
+        p = DSLParser()
+        p.add_dialect('old', {'template': 'SELECT {columns} FROM data {where_str} {limit_str}'})
+        self.assertEqual(p.generate_sql(dialect='old', fields=FIELDS, query='{:limit 1}'), '"SELECT * FROM data LIMIT 1;"')
+        with self.assertRaisesRegex(RuntimeError, r'template has no \{order_str\}'):
+            p.generate_sql(dialect='old', fields=FIELDS, query='{:order-by [[:asc [:field 1]]]}')
+
+    def test_template_predating_clauses(self):
+        p = DSLParser()
+        p.add_dialect('old', {'template': 'SELECT * FROM data {where_str} {limit_str}'})
+        res = p.generate_sql(dialect='old', fields=FIELDS, query='{:where [:= [:field 1] 1], :limit 1}')
+        self.assertEqual(res, '"SELECT * FROM data WHERE "id" = 1 LIMIT 1;"')
+        self.assertEqual(p.generate_sql(dialect='old', fields=FIELDS, query='{}'), '"SELECT * FROM data;"')
+        for query in ('{:fields [[:field 1]]}', '{:offset 2}', '{:order-by [[:asc [:field 1]]]}'):
+            with self.assertRaises(RuntimeError, msg=query):
+                p.generate_sql(dialect='old', fields=FIELDS, query=query)
+
+    def test_malformed(self):
+        p = DSLParser()
+        for query in ('{:foo 1}', '{:limit 1} x', '{:limit 1', ':limit 1}', '{:where}', '{:where [:= [:field 1]]}',
+                      '{:order-by [[:up [:field 1]]]}', '{:fields []}', '{:fields [1]}'):
+            with self.assertRaises(SyntaxError, msg=query):
+                p.parse(query)
+        with self.assertRaisesRegex(Exception, 'at most 1 `offset`'):
+            p.parse('{:offset 1 :offset 2}')
+        with self.assertRaisesRegex(Exception, 'unsigned int value for `limit`'):
+            p.parse('{:limit -1}')
+
+    def test_unknown_fields(self):
+        p = DSLParser()
+        for query in ('{:fields [[:field 9]]}', '{:order-by [[:asc [:field 9]]]}'):
+            with self.assertRaisesRegex(SyntaxError, 'Unknown field id'):
+                p.generate_sql(dialect='postgres', fields=FIELDS, query=query)
+
+
+class TestInListStrategies(unittest.TestCase):
+    QUERY = '{:where [:and [:= [:field 1] 1 2 3 4 5] [:!= [:field 2] "a" "b\'c" nil]]}'
+
+    def parser(self, strategy, **rules):
+        p = DSLParser()
+        p.add_dialect('t', {'in_strategy': strategy, 'in_threshold': 3, **rules})
+        return p
+
+    def test_below_threshold(self):
+        p = self.parser('chunk', in_threshold=6)
+        res = p.generate_sql(dialect='t', fields=FIELDS, query=self.QUERY)
+        self.assertEqual(res, '"SELECT * FROM data WHERE "id" IN (1, 2, 3, 4, 5) AND "name" NOT IN (\'a\', \'b\'\'c\', NULL);"')
+
+    def test_chunk(self):
+        p = self.parser('chunk', in_chunk_size=2)
+        res = p.generate_sql(dialect='t', fields=FIELDS, query=self.QUERY, parameterize=True)
+        self.assertEqual(res[0], '"SELECT * FROM data WHERE ("id" IN (?, ?) OR "id" IN (?, ?) OR "id" IN (?)) '
+                                 'AND ("name" NOT IN (?, ?) AND "name" NOT IN (NULL));"')
+        self.assertEqual(res[1], (1, 2, 3, 4, 5, 'a', "b'c"))
+
+    def test_any(self):
+        p = self.parser('any')
+        res = p.generate_sql(dialect='t', fields=FIELDS, query=self.QUERY)
+        self.assertEqual(res, '"SELECT * FROM data WHERE "id" = ANY(ARRAY[1, 2, 3, 4, 5]) AND "name" <> ALL(ARRAY[\'a\', \'b\'\'c\', NULL]);"')
+        res = p.generate_sql(dialect='t', fields=FIELDS, query=self.QUERY, parameterize=True)
+        self.assertEqual(res, ('"SELECT * FROM data WHERE "id" = ANY(?) AND "name" <> ALL(?);"', ([1, 2, 3, 4, 5], ['a', "b'c", None])))
+        # Fields can't be bound in an array
+        res = p.generate_sql(dialect='t', fields=FIELDS, query='{:where [:= [:field 1] 1 2 [:field 4]]}', parameterize=True)
+        self.assertEqual(res, ('"SELECT * FROM data WHERE ("id" IN (?, ?, "age"));"', (1, 2)))
+
+    def test_values(self):
+        p = self.parser('values')
+        res = p.generate_sql(dialect='t', fields=FIELDS, query=self.QUERY, parameterize=True)
+        self.assertEqual(res, ('"SELECT * FROM data WHERE "id" IN (SELECT v FROM (VALUES (1), (2), (3), (4), (5)) AS _v(v)) '
+                               'AND "name" NOT IN (SELECT v FROM (VALUES (\'a\'), (\'b\'\'c\'), (NULL)) AS _v(v));"', ()))
+
+    def test_dialect_defaults(self):
+        p = DSLParser()
+        query = '{:where [:= [:field 1] ' + ' '.join(map(str, range(2500))) + ']}'
+        sql, params = p.generate_sql(dialect='postgres', fields=FIELDS, query=query, parameterize=True)
+        self.assertEqual((sql, params), ('"SELECT * FROM data WHERE "id" = ANY($1);"', (list(range(2500)),)))
+        sql, params = p.generate_sql(dialect='mysql', fields=FIELDS, query=query, parameterize=True)
+        self.assertEqual((sql.count(' OR '), len(params)), (2, 2500))
+        sql, params = p.generate_sql(dialect='sqlserver', fields=FIELDS, query=query, parameterize=True)
+        self.assertTrue(sql.startswith('"SELECT * FROM data WHERE "id" IN (SELECT v FROM (VALUES (0), (1), '))
+        self.assertEqual(params, ())
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(RuntimeError):
+            DSLParser().add_dialect('t', {'in_strategy': 'temp_table'})
+
+
+class TestIncremental(unittest.TestCase):
+    MACROS = {'m': '[:or [:= [:field 1] 1] [:is-empty [:field 3]]]'}
+
+    def query(self, values):
+        terms = ' '.join(f'[:or [:= [:field 1] {v}] [:and [:< [:field 4] {i}] [:!= [:field 2] "x{i}"]]]'
+                         for i, v in enumerate(values))
+        return '{:where [:and ' + terms + ' [:not [:macro "m"]]], :limit 5}'
+
+    def test_matches_generate_sql(self):
+        rnd = random.Random(7)
+        for ast_cache_size in (None, 8):
+            p = DSLParser(ast_cache_size=ast_cache_size)
+            for dialect in ('postgres', 'mysql', 'sqlserver'):
+                values = list(range(20))
+                res = None
+                for _ in range(30):
+                    values[rnd.randrange(len(values))] = rnd.randrange(5)
+                    query = self.query(values)
+                    res = p.compile(dialect, FIELDS, query, self.MACROS, previous=res)
+                    self.assertEqual(res.sql, p.generate_sql(dialect, FIELDS, query, self.MACROS))
+
+    def test_reuses_unchanged_subtrees(self):
+        p = DSLParser()
+        values = list(range(10))
+        first = p.compile('postgres', FIELDS, self.query(values), self.MACROS)
+        self.assertEqual(first.reused, 0)
+        values[3] = 'x'
+        second = p.compile('postgres', FIELDS, self.query(values), self.MACROS, previous=first)
+        # 9 untouched terms, the :and of the edited term and the :not [:macro "m"]
+        self.assertEqual(second.reused, 11)
+        self.assertIs(second.memo, first.memo)
+        self.assertEqual(p.compile('postgres', FIELDS, self.query(values), self.MACROS, previous=second).reused, 1)
+
+    def test_context_change(self):
+        p = DSLParser()
+        query = self.query(range(3))
+        first = p.compile('postgres', FIELDS, query, self.MACROS)
+        for dialect, fields in (('mysql', FIELDS), ('postgres', {**FIELDS, 1: 'uid'})):
+            res = p.compile(dialect, fields, query, self.MACROS, previous=first)
+            self.assertEqual(res.reused, 0)
+            self.assertIsNot(res.memo, first.memo)
+            self.assertEqual(res.sql, p.generate_sql(dialect, fields, query, self.MACROS))
+        # Equal fields quote the same
+        self.assertEqual(p.compile('postgres', dict(FIELDS), query, self.MACROS, previous=first).reused, 1)
+
+    def test_pruning(self):
+        p = DSLParser()
+        s = p.serializer.bind('postgres', FIELDS)
+        memo = SubtreeMemo(None, max_unused=1)
+        for i in range(300):
+            ast, _ = p.parse_query(self.query([i, i + 1, 2]), self.MACROS)
+            self.assertEqual(s.postorder_memo(ast, memo), s.postorder_ast(ast))
+        self.assertLess(len(memo.ids), 3000)
+        with self.assertRaises(RuntimeError):
+            s.serialize_ast(ast, parameterize=True, memo=memo)
+
+
+class TestStore(unittest.TestCase):
+    MACROS = {
+        'a': '[:and [:= [:field 1] 1] [:= [:field 2] "x, é"]]',
+        'b': '[:or [:macro "a"] [:macro "a"]]',
+        'c': '[:and [:macro "b"] [:macro "b"]]',
+    }
+    QUERIES = {
+        'k1': '{:where [:macro "c"], :limit 200, :offset 3, :order-by [[:desc [:field 1]]], :fields [[:field 1] [:field 2]]}',
+        'k2': '{:where [:= [:field 4] 25 26 27]}',
+        'k0': '{:limit 5}',
+        'é': '{:where [:not [:is-empty [:field 3]]]}',
+        'deep': '{:where ' + '[:not ' * 2000 + '[:= [:field 1] 1]' + ']' * 2000 + '}',
+    }
+
+    def setUp(self):
+        import store
+        self.store = store
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.path = os.path.join(d.name, 'queries.dslq')
+        self.lib = MacroLibrary(self.MACROS)
+        self.assertEqual(store.compile_store(self.path, self.QUERIES, self.lib), len(self.QUERIES))
+
+    def test_round_trip(self):
+        p = DSLParser()
+        with self.store.Store(self.path) as s:
+            self.assertEqual(len(s), 5)
+            self.assertEqual(s.keys(), sorted(self.QUERIES, key=str.encode))
+            self.assertEqual([k for k, _ in s.items()], s.keys())
+            for key, q in self.QUERIES.items():
+                self.assertEqual(repr(s[key]), repr(p.parse(q, self.lib)))
+                for dialect in ('postgres', 'mysql', 'sqlserver'):
+                    self.assertEqual(s.generate_sql(dialect, FIELDS, key), p.generate_sql(dialect, FIELDS, q, self.lib))
+            self.assertEqual(s.generate_sql('postgres', FIELDS, 'k2', parameterize=True),
+                             p.generate_sql('postgres', FIELDS, self.QUERIES['k2'], parameterize=True))
+            self.assertNotIn('k3', s)
+            self.assertIsNone(s.get('k3'))
+            with self.assertRaises(KeyError):
+                s['k3']
+
+    def test_shared_subtrees_stored_once(self):
+        with self.store.Store(self.path) as s:
+            where = s['k1'].where
+            self.assertIs(where.children[0], where.children[1])
+            self.assertIs(where.children[0].children[0], where.children[0].children[1])
+        # Macro "a" is expanded 4 times (28 nodes, 3 bytes each), but written once
+        w = self.store.StoreWriter()
+        w.add('k1', DSLParser().parse(self.QUERIES['k1'], self.lib))
+        self.assertLess(len(w._records['k1']), 50)
+
+    def test_rejects_bad_files(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for bad, msg in ((b'XXXX' + data[4:], 'Not a query store'), (data[:4] + b'\x09' + data[5:], 'Unsupported query store version 9'),
+                         (data[:-1], 'Truncated'), (b'', 'Not a query store')):
+            with open(self.path, 'wb') as f:
+                f.write(bad)
+            with self.assertRaisesRegex(RuntimeError, msg):
+                self.store.Store(self.path)
+
+
+class TestShapeCache(unittest.TestCase):
+
+    def query(self, name, age, limit = 10):
+        return f'{{:where [:and [:= [:field 2] {name}] [:> [:field 4] {age}]], :limit {limit}}}'
+
+    def test_shape_cache_is_opt_in(self):
+        self.assertIsNone(DSLParser().shape_cache)
+
+    def test_query_shape(self):
+        shape, literals = query_shape('{:where [:and [:= [:field 2] "a b"] [:macro "m"] [:!= [:field 3] nil]], :limit 5}')
+        self.assertEqual(shape, '{:where [:and [:= [:field 2] \x00"] [:macro "m"] [:!= [:field 3] nil]], :limit \x00}')
+        self.assertEqual(literals, ['"a b"', '5'])
+        self.assertEqual(query_shape(self.query('"x"', 1))[0], query_shape(self.query('"yy"', 22, 7))[0])
+        self.assertNotEqual(query_shape(self.query('"x"', 1))[0], query_shape(self.query('x', 1))[0])
+
+    def test_same_result_as_compiling(self):
+        p = DSLParser(shape_cache_size=16)
+        ref = DSLParser()
+        for dialect in ('postgres', 'mysql', 'sqlserver'):
+            for parameterize in (False, True):
+                for name, age, limit in (('"joe"', 3, 10), ('"o\'brien"', 4.5, '007'), ('bob', -1, 0)):
+                    q = self.query(name, age, limit)
+                    self.assertEqual(p.generate_sql(dialect, FIELDS, q, parameterize=parameterize),
+                                     ref.generate_sql(dialect, FIELDS, q, parameterize=parameterize))
+        stats = p.shape_cache.stats()
+        # Quoted strings and bare literals make different shapes
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (6, 12, 12))
+
+    def test_fields_edited_in_place(self):
+        p = DSLParser(shape_cache_size=16)
+        fields = dict(FIELDS)
+        p.generate_sql('postgres', fields, self.query('"a"', 1))
+        fields[2] = 'full_name'
+        res = p.generate_sql('postgres', fields, self.query('"b"', 2))
+        self.assertEqual(res, '"SELECT * FROM data WHERE "full_name" = \'b\' AND "age" > 2 LIMIT 10;"')
+
+    def test_in_list_strategies(self):
+        p = DSLParser(shape_cache_size=16)
+        ref = DSLParser()
+        for strategy in ('any', 'chunk', 'values'):
+            for x in (p, ref):
+                x.add_dialect(strategy, {'in_strategy': strategy, 'in_threshold': 3, 'in_chunk_size': 2})
+        for values in ('1 "it\'s" "b" 5', '7 "o\'\'k" "c" 8'):
+            q = f'{{:where [:= [:field 2] {values}]}}'
+            for strategy in ('any', 'chunk', 'values'):
+                for parameterize in (False, True):
+                    self.assertEqual(p.generate_sql(strategy, FIELDS, q, parameterize=parameterize),
+                                     ref.generate_sql(strategy, FIELDS, q, parameterize=parameterize))
+        self.assertEqual(p.shape_cache.stats()['hits'], 6)
+
+    def test_hits_skip_parsing(self):
+        p = DSLParser(shape_cache_size=16)
+        p.generate_sql('postgres', FIELDS, self.query('"joe"', 3))
+        p.operators = {}
+        self.assertEqual(p.generate_sql('postgres', FIELDS, self.query('"ann"', 40, 2)),
+                         '"SELECT * FROM data WHERE "name" = \'ann\' AND "age" > 40 LIMIT 2;"')
+
+    def test_invalid_literals(self):
+        p = DSLParser(shape_cache_size=16)
+        p.generate_sql('postgres', FIELDS, self.query('"joe"', 3))
+        with self.assertRaisesRegex(Exception, 'Expected unsigned int value for `limit`, got x'):
+            p.generate_sql('postgres', FIELDS, self.query('"joe"', 3, 'x'))
+
+    def test_keyed_on_dialect_fields_and_macros(self):
+        p = DSLParser(shape_cache_size=16)
+        macros = MacroLibrary({'m': '[:= [:field 1] 1]'})
+        q = '{:where [:and [:macro "m"] [:= [:field 2] "joe"]]}'
+        p.generate_sql('postgres', FIELDS, q, macros)
+        p.generate_sql('mysql', FIELDS, q, macros)
+        fields = {**FIELDS, 2: 'full_name'}
+        self.assertIn('"full_name" = \'ann\'', p.generate_sql('postgres', fields, q.replace('joe', 'ann'), macros))
+        macros.set('m', '[:= [:field 1] 2]')
+        self.assertIn('"id" = 2', p.generate_sql('postgres', FIELDS, q, macros))
+        self.assertEqual(p.shape_cache.stats()['hits'], 0)
+        p.add_dialect('test', {'field-delim': '_'})
+        self.assertEqual(len(p.shape_cache), 0)
+
+    def test_macro_expansion_limits(self):
+        p = DSLParser(shape_cache_size=16)
+        macros = MacroLibrary({'m': '[:= [:field 1] 1]'}, max_size=60)
+        q = '{:where [:and [:macro "m"] [:= [:field 2] "%s"]]}'
+        p.generate_sql('postgres', FIELDS, q % 'joe', macros)
+        with self.assertRaisesRegex(RuntimeError, 'exceeds max_size'):
+            p.generate_sql('postgres', FIELDS, q % ('x' * 40), macros)
+        with self.assertRaisesRegex(RuntimeError, 'exceeds max_size'):
+            DSLParser().generate_sql('postgres', FIELDS, q % ('x' * 40), macros)
+
+    def test_bypassed_when_values_matter(self):
+        p = DSLParser(shape_cache_size=16)
+        q = '{:where [:or [:= [:field 1] 1] [:= [:field 1] 1]]}'
+        self.assertEqual(p.generate_sql('postgres', FIELDS, q, optimize=True),
+                         DSLParser().generate_sql('postgres', FIELDS, q, optimize=True))
+        p.generate_sql('postgres', FIELDS, q, shared=True)
+        self.assertEqual(len(p.shape_cache), 0)
+
+    def test_untemplatable_shapes(self):
+        def parse_echo(ctx):
+            # Turns its literal into a field name, the value matters
+            field = ctx.parse_field()
+            c = ctx.current
+            ctx.advance()
+            return Node('DSL_OP', ':echo', field, Node('DSL_LITERAL', ctx.token_text(c)))
+
+        p = DSLParser(shape_cache_size=16)
+        p.add_operator(':echo', parse_echo, lambda s, node, left, right: f'{left} = {right}')
+        for value in ('1', '2'):
+            self.assertEqual(p.generate_sql('postgres', FIELDS, f'{{:where [:echo [:field 1] {value}]}}'),
+                             f'"SELECT * FROM data WHERE "id" = {value};"')
+        self.assertIs(next(iter(p.shape_cache._data.values()))[0], False)
+
+    def test_metrics(self):
+        from metrics import MetricsAggregator
+        p = DSLParser(shape_cache_size=16)
+        metrics = MetricsAggregator()
+        p.add_listener(metrics)
+        for age in range(3):
+            p.generate_sql('postgres', FIELDS, self.query('"joe"', age))
+        snap = metrics.snapshot()
+        self.assertEqual(snap['counters']['shape_cache.hit'], 2)
+        self.assertEqual(snap['counters']['shape_cache.miss'], 1)
+        self.assertEqual(snap['histograms']['latency.shape']['count'], 3)
+
+
+class TestMultiDialect(unittest.TestCase):
+    DIALECTS = ('postgres', 'mysql', 'sqlserver', 'bang', 'chunked')
+    QUERIES = (
+        '{:where [:and [:= [:field 2] "o\'brien"] [:!= [:field 4] 5] [:or [:not [:= [:field 3] nil]] [:!= nil [:field 1]]]], '
+        ':limit 10, :offset 3, :order-by [[:desc [:field 1]]]}',
+        '{:where [:or [:= [:field 2] 1 "it\'s" [:field 3] 4 5] [:!= [:field 1] 1 2 3 4] [:starts-with [:field 2] "ab"]], '
+        ':fields [[:field 1] [:field 2]]}',
+        '{:limit 3}',
+    )
+
+    def setUp(self):
+        self.p = DSLParser()
+        self.p.add_dialect('bang', {'neq': '!=', 'field-delim': '|', 'in_strategy': 'any', 'in_threshold': 3})
+        self.p.add_dialect('chunked', {'in_strategy': 'chunk', 'in_threshold': 3, 'in_chunk_size': 2})
+        self.p.add_operators(OperatorSpec(':starts-with', ('field', 'literal'), "{0} LIKE {1} || '%'",
+                                          {'mysql': "{0} LIKE CONCAT({1}, '%')"}))
+
+    def test_same_as_one_dialect_at_a_time(self):
+        for query in self.QUERIES:
+            for parameterize in (False, True):
+                res = self.p.generate_sql_multi(self.DIALECTS, FIELDS, query, parameterize=parameterize)
+                self.assertEqual(list(res), list(self.DIALECTS))
+                for dialect in self.DIALECTS:
+                    self.assertEqual(res[dialect], self.p.generate_sql(dialect, FIELDS, query, parameterize=parameterize))
+
+    def test_single_traversal(self):
+        calls = []
+
+        class CountingSerializer(ASTSerializer):
+            def serialize_literal(self, node):
+                calls.append(self.dialect)
+                return super().serialize_literal(node)
+
+        s = CountingSerializer()
+        query = self.p.parse('{:where [:and [:= [:field 2] "joe"] [:!= [:field 4] 5]], :limit 1}')
+        res = s.serialize_multi(query, ('postgres', 'mysql', 'sqlserver'), FIELDS)
+        self.assertEqual(res[2], 'SELECT TOP 1 * FROM data WHERE "name" = \'joe\' AND "age" <> 5;')
+        # Literals are rendered once per way of escaping strings (mysql doubles backslashes too) and shared
+        # by the dialects escaping alike, unless each dialect binds its own params
+        self.assertEqual(len(calls), 4)
+        calls.clear()
+        s.serialize_multi(self.p.parse('{:where [:= [:field 2] "joe"]}'), ('postgres', 'mysql'), FIELDS, parameterize=True)
+        self.assertEqual(calls, ['postgres', 'mysql'])
+
+    def test_lanes(self):
+        s = self.p.serializer
+        ast = self.p.parse('{:where [:and [:!= [:field 1] 1 2 3] [:= [:field 2] nil]]}').where
+        lanes = [s.bind(d, FIELDS) for d in ('postgres', 'bang', 'chunked')]
+        self.assertEqual(s.postorder_lanes(ast, lanes), [
+            '"id" NOT IN (1, 2, 3) AND "name" IS NULL',
+            '|id| <> ALL(ARRAY[1, 2, 3]) AND |name| IS NULL',
+            '("id" NOT IN (1, 2) AND "id" NOT IN (3)) AND "name" IS NULL',
+        ])
+
+    def test_errors(self):
+        with self.assertRaisesRegex(RuntimeError, 'Unsupported dialect "nope"'):
+            self.p.generate_sql_multi(('postgres', 'nope'), FIELDS, self.QUERIES[0])
+        with self.assertRaisesRegex(SyntaxError, 'Unknown field id'):
+            self.p.generate_sql_multi(('postgres', 'mysql'), FIELDS, '{:where [:= [:field 9] 1]}')
+
+
+class TestEvaluator(unittest.TestCase):
+    COLUMNS = {
+        'id': [1, 2, 3, None, 5],
+        'name': ['joe', None, "o'brien", 'ann', 'joe'],
+        'date_joined': [None, None, '2020-01-01', None, '2021-06-30'],
+        'age': [30, None, 5, 40, 17],
+    }
+
+    def setUp(self):
+        self.p = DSLParser()
+        self.e = Evaluator(FIELDS)
+
+    def where(self, clause):
+        return self.p.parse('{:where %s}' % clause).where
+
+    def truth(self, clause, columns=None):
+        return self.e.compile(self.where(clause)).truth(columns or self.COLUMNS)
+
+    def test_mask(self):
+        pred = self.p.predicate(FIELDS, '{:where [:and [:= [:field 2] "joe"] [:> [:field 4] 18]]}')
+        self.assertEqual(pred(self.COLUMNS), [True, False, False, False, False])
+        self.assertEqual(pred.columns, ('name', 'age'))
+        self.assertEqual(self.p.predicate(FIELDS, '{:limit 1}')(self.COLUMNS), [True] * 5)
+
+    def test_three_valued_logic(self):
+        self.assertEqual(self.truth('[:> [:field 4] 18]'), [True, None, False, True, False])
+        self.assertEqual(self.truth('[:not [:> [:field 4] 18]]'), [False, None, True, False, True])
+        self.assertEqual(self.truth('[:or [:> [:field 4] 18] [:= [:field 1] 2]]'), [True, True, False, True, False])
+        self.assertEqual(self.truth('[:and [:> [:field 4] 18] [:= [:field 1] 1]]'), [True, False, False, None, False])
+        self.assertEqual(self.truth('[:< 18 [:field 4]]'), self.truth('[:> [:field 4] 18]'))
+
+    def test_nil(self):
+        self.assertEqual(self.truth('[:= [:field 3] nil]'), [True, True, False, True, False])
+        self.assertEqual(self.truth('[:!= nil [:field 3]]'), [False, False, True, False, True])
+        self.assertEqual(self.truth('[:is-empty [:field 2]]'), [False, True, False, False, False])
+        self.assertEqual(self.truth('[:not [:not-empty [:field 2]]]'), [False, True, False, False, False])
+
+    def test_in_lists(self):
+        self.assertEqual(self.truth('[:= [:field 1] 1 3 4]'), [True, False, True, None, False])
+        self.assertEqual(self.truth('[:!= [:field 1] 1 3]'), [False, True, False, None, True])
+        # x IN (1, NULL) is never FALSE, x NOT IN (1, NULL) never TRUE
+        self.assertEqual(self.truth('[:= [:field 1] 1 nil]'), [True, None, None, None, None])
+        self.assertEqual(self.truth('[:!= [:field 1] 1 nil]'), [False, None, None, None, None])
+        self.assertEqual(self.truth('[:= [:field 2] "o\'brien" [:field 2]]'), [True, None, True, True, True])
+
+    def test_same_as_rows(self):
+        random.seed(7)
+        n = 200
+        columns = {
+            'id': [random.choice([None, 1, 2, 3]) for _ in range(n)],
+            'name': [random.choice([None, 'a', 'b']) for _ in range(n)],
+            'date_joined': [random.choice([None, '2020', '2021']) for _ in range(n)],
+            'age': [random.choice([None, 5, 10, 20]) for _ in range(n)],
+        }
+        rows = [{k: v[i] for k, v in columns.items()} for i in range(n)]
+        for clause in ('[:or [:not [:= [:field 1] 2 nil]] [:and [:>= [:field 4] 10] [:!= [:field 2] "a"]]]',
+                       '[:not [:or [:is-empty [:field 3]] [:< [:field 1] [:field 4]]]]',
+                       '[:and [:!= [:field 4] 5 "x"] [:not-empty [:field 2]] [:<= 2 [:field 1]]]'):
+            ast = self.where(clause)
+            self.assertEqual(self.e.compile(ast).truth(columns), list(self.e.evaluate_rows(ast, rows)))
+
+    def test_errors(self):
+        with self.assertRaisesRegex(SyntaxError, 'Unknown field id 9'):
+            self.e.compile(self.where('[:= [:field 9] 1]'))
+        with self.assertRaisesRegex(RuntimeError, 'Missing column "age"'):
+            self.e.evaluate(self.where('[:= [:field 4] 1]'), {'id': [1]})
+        with self.assertRaisesRegex(RuntimeError, 'Column "age" has 1 rows, expected 2'):
+            self.e.evaluate(self.where('[:= [:field 4] 1]'), {'id': [1, 2], 'age': [1]})
+        self.p.add_operators(OperatorSpec(':starts-with', ('field', 'literal'), "{0} LIKE {1} || '%'"))
+        with self.assertRaisesRegex(RuntimeError, 'Operator ":starts-with" can\'t be evaluated'):
+            self.e.compile(self.where('[:starts-with [:field 2] "j"]'))
+
+    def test_deep_nesting(self):
+        clause = '[:= [:field 1] 1]'
+        for _ in range(5000):
+            clause = f'[:not {clause}]'
+        ast = self.p.parse('{:where %s}' % clause).where
+        self.assertEqual(self.e.evaluate(ast, self.COLUMNS), [True, False, False, False, False])
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_numpy(self):
+        columns = {
+            'id': np.array([1, 2, 3, 0, 5]),
+            'name': np.array(['joe', None, "o'brien", 'ann', 'joe'], dtype=object),
+            'date_joined': np.array(['NaT', 'NaT', '2020-01-01', 'NaT', '2021-06-30'], dtype='datetime64[D]'),
+            'age': np.array([30, np.nan, 5, 40, 17]),
+        }
+        columns['id'] = np.ma.masked_array(columns['id'], mask=[0, 0, 0, 1, 0])
+        for clause in ('[:and [:= [:field 2] "joe"] [:> [:field 4] 18]]', '[:not [:> [:field 4] 18]]',
+                       '[:= [:field 3] nil]', '[:= [:field 1] 1 nil]', '[:!= [:field 1] 1 3]',
+                       '[:or [:not-empty [:field 2]] [:< 3 [:field 1]]]'):
+            pred = self.e.compile(self.where(clause))
+            res = pred(columns)
+            self.assertIsInstance(res, np.ndarray)
+            self.assertEqual(res.tolist(), pred(self.COLUMNS))
+            self.assertEqual(list(pred.truth(columns)), pred.truth(self.COLUMNS))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,61 +1,87 @@
 import re
-import random
+
+# Matches ':macro' followed by a double-quoted macro id
+MACRO_REF_RE = re.compile(r':macro\s+"([^"]+)"')
+# Matches a whole [:macro "<macro_id>"] where-clause
+MACRO_CLAUSE_RE = re.compile(r'\[:macro\s+"([^"]+)"\]')
+
+
+def macro_refs(macro_str):
+  """
+  Ids of the macros referenced by `macro_str`, in order of first appearance
+  """
+  return list(dict.fromkeys(MACRO_REF_RE.findall(macro_str)))
 
 def build_neighbors_map(macro_map):
   """
   Build adjacency map for a macro_id graph
   """
-  def match_neighbors(macro_str):
-    # Define the regex pattern to match ':macro' followed by a double-quoted string
-    pattern = r':macro\s+"([^"]+)"'
-    return re.findall(pattern, macro_str)
-  return {key: match_neighbors(val) for key, val in macro_map.items()}
+  return {key: macro_refs(val) for key, val in macro_map.items()}
 
-def has_cycle(macro_map):
+def has_cycle(macro_map, neighbors = None):
   """
   Detect if the input macro_map contains a cycle
 
   Conceptually this encodes the macro map into an adjacency list graph representation
   We then DFS the map maintaining node states as unexplored, in_process, and visited
   If we see an in_process node while actively exploring, there's a cycle
+
+  The DFS runs on an explicit stack in the insertion order of `macro_map`, so it is linear in the
+  size of the graph, deterministic and not bound by the recursion limit
+
+  :param neighbors: A prebuilt adjacency map, see `build_neighbors_map`
   """
-  neighbors = build_neighbors_map(macro_map)
+  if neighbors is None:
+    neighbors = build_neighbors_map(macro_map)
   visited = set()
   in_process = set()
 
-  def dfs(macro_id, visited, in_process, unexplored, neighbors):
-    in_process.add(macro_id)
-    res = False
-    for n in neighbors[macro_id]:
-      if n in in_process:
-        res = True
-      elif n not in visited:
-        if dfs(n, visited, in_process, unexplored, neighbors):
-          res = True
-    visited.add(macro_id)
-    in_process.remove(macro_id)
-    unexplored.remove(macro_id)
-    return res
-
-  unexplored = set(neighbors.keys())
-  res = False
-  while len(unexplored):
-    start = random.choice(list(unexplored))
-    if dfs(start, visited, in_process, unexplored, neighbors):
-      res = True
-      break
-  return res
+  for start in neighbors:
+    if start in visited:
+      continue
+    in_process.add(start)
+    stack = [(start, iter(neighbors[start]))]
+    while stack:
+      macro_id, it = stack[-1]
+      for n in it:
+        if n in in_process:
+          return True
+        if n not in visited and n in neighbors:
+          in_process.add(n)
+          stack.append((n, iter(neighbors[n])))
+          break
+      else:
+        stack.pop()
+        in_process.remove(macro_id)
+        visited.add(macro_id)
+  return False
+
+def reaches(neighbors, sources, target):
+  """
+  Whether `target` is reachable from any of the `sources` in the adjacency map `neighbors`
+  """
+  seen = set()
+  stack = list(sources)
+  while stack:
+    n = stack.pop()
+    if n == target:
+      return True
+    if n in seen:
+      continue
+    seen.add(n)
+    stack.extend(neighbors.get(n, ()))
+  return False
 
 def reduce_macros(where_raw: str, macro_map: dict) -> str:
-  # Regex pattern to match [:macro "<macro_id>"]
-  pattern = r'\[:macro\s+"([^"]+)"\]'
-  
   # Function to replace a match with the corresponding value from the dictionary
   def replace_match(match):
       macro_id = match.group(1)  # Extract the macro_id from the match
       return macro_map.get(macro_id, match.group(0))  # Replace with the macro value, or keep original if not found
-  
+
   while ':macro' in where_raw:
-    # Use re.sub to substitute all matches with corresponding macro values
-    where_raw = re.sub(pattern, replace_match, where_raw)
+    # Substitute all matches with corresponding macro values, stop once nothing is left to expand
+    reduced = MACRO_CLAUSE_RE.sub(replace_match, where_raw)
+    if reduced == where_raw:
+      break
+    where_raw = reduced
   return where_raw